@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+"""
+Python command line tool for maintenance tasks on an existing
+Midjourney archive:
+- rebuild-index: repopulate the archive manifest from the files on disk
+- store-report: show how much the content-addressed image store saves
+- convert: convert job metadata between the per-file and packed storage layouts
+- train-dictionary: train the zstd dictionary for compressed packed shards
+- compression-report: measure the compression ratio and speed of the shard codecs
+- build-search-index: build the full-text prompt search index from the archive
+- search: ranked full-text search over the archived prompts
+- derivatives: create preview images of all downloaded images
+- export: export the job metadata to Parquet or Arrow files partitioned by month
+- reformat: rewrite the metadata files with the current JSON indentation and prompt layout
+- verify: check the downloaded images and queue corrupt ones for download again
+"""
+
+import argparse
+import collections
+import datetime as dt
+import logging
+import time
+from pathlib import Path
+
+from mj_archive import import_script, is_shard_path, iter_job_files
+from mj_codecs import COMPRESSIONS, ZstdCompression, get_codec, train_zstd_dictionary, zstd_dictionary_path
+from mj_derivatives import DERIVATIVE_FORMATS, DerivativeGenerator, parse_sizes
+from mj_export import EXPORT_FORMATS, export_archive
+from mj_manifest import ArchiveManifest
+from mj_reformat import REFORMAT_ERROR_STATS, reformat_archive
+from mj_storage import STORAGE_LAYOUTS, ZSTD_TRAINING_SAMPLES, convert_archive, sample_jobs, train_archive_dictionary
+from mj_verify import ImageVerifier
+
+_log = logging.getLogger(__name__)
+
+
+def rebuild_index(args) -> int:
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        indexed = manifest.rebuild()
+    finally:
+        manifest.close()
+    _log.info(f"Indexed {indexed} jobs into {manifest.path}")
+    return 0
+
+
+def store_report(args) -> int:
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        report = manifest.store_report()
+    finally:
+        manifest.close()
+    print(f"Store objects:   {report['objects']} ({report['stored_bytes']} bytes) from {report['urls']} URLs")
+    print(f"Linked files:    {report['linked_files']} ({report['linked_bytes']} bytes as separate copies)")
+    print(f"Bytes saved:     {report['bytes_saved']}")
+    for method, count in sorted(report["link_methods"].items()):
+        print(f"Links by {method + ':':<9} {count}")
+    return 0
+
+
+def convert(args) -> int:
+    archiver_class = import_script("mj-metadata-archiver.py").MidjourneyMetadataArchiver
+    if args.compression != "none" and args.to != "packed":
+        _log.error("--compression only applies to --to packed.")
+        return 1
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        if manifest.is_empty():
+            manifest.rebuild()
+        if args.compression == "zstd" and not zstd_dictionary_path(args.archive_root).exists():
+            try:
+                train_archive_dictionary(args.archive_root)
+            except ValueError as e:
+                _log.warning(f"{e}. Jobs are compressed without a dictionary until enough were written.")
+        convert_archive(
+            args.archive_root,
+            manifest,
+            to_layout=args.to,
+            json_indent=args.json_indent if args.json_indent > 0 else None,
+            render_prompt=archiver_class.render_prompt_text,
+            compression=args.compression,
+        )
+    finally:
+        manifest.close()
+    return 0
+
+
+def train_dictionary(args) -> int:
+    try:
+        dictionary_path = train_archive_dictionary(args.archive_root, args.samples)
+    except (FileExistsError, ValueError) as e:
+        _log.error(str(e))
+        return 1
+    _log.info(f"Trained zstd dictionary {dictionary_path}")
+    return 0
+
+
+def _measure_codec(codec, samples: list[bytes]) -> tuple[int, float, float]:
+    """
+    Compressed size, compression and decompression time of the samples as separate frames.
+    """
+    start = time.perf_counter()
+    frames = [codec.compress(sample) for sample in samples]
+    compress_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for frame in frames:
+        codec.decompress(frame)
+    decompress_seconds = time.perf_counter() - start
+    return sum(len(frame) for frame in frames), compress_seconds, decompress_seconds
+
+
+def compression_report(args) -> int:
+    shard_sizes = collections.Counter()
+    shard_counts = collections.Counter()
+    for path in iter_job_files(args.archive_root, include_shards=True):
+        if is_shard_path(path):
+            shard_counts[path.name] += 1
+            shard_sizes[path.name] += path.stat().st_size
+    for name in sorted(shard_counts):
+        print(f"Shards {name + ':':<16} {shard_counts[name]} ({shard_sizes[name]} bytes)")
+
+    samples = sample_jobs(args.archive_root, args.samples)
+    if not samples:
+        _log.error(f"No jobs found in {args.archive_root}")
+        return 1
+
+    codecs = [(name, get_codec(name, args.archive_root)) for name in ("none", "gzip")]
+    try:
+        codecs.append(("zstd", ZstdCompression()))
+        dictionary_path = zstd_dictionary_path(args.archive_root)
+        if dictionary_path.exists():
+            codecs.append(("zstd+dictionary", ZstdCompression(dictionary=dictionary_path.read_bytes())))
+        elif len(samples) >= 2:
+            # Train on every other job and measure on the rest, so the ratio is not flattered
+            dictionary = train_zstd_dictionary(samples[::2])
+            samples = samples[1::2]
+            codecs.append(("zstd+dictionary", ZstdCompression(dictionary=dictionary)))
+    except (ImportError, ValueError) as e:
+        _log.warning(str(e))
+
+    raw_bytes = sum(len(sample) for sample in samples)
+    print(f"Measured on {len(samples)} jobs ({raw_bytes} bytes), one frame per job:")
+    print(f"{'Codec':<16} {'Bytes':>12} {'Ratio':>7} {'Compress MB/s':>14} {'Decompress MB/s':>16}")
+    for name, codec in codecs:
+        size, compress_seconds, decompress_seconds = _measure_codec(codec, samples)
+        print(
+            f"{name:<16} {size:>12} {raw_bytes / size:>7.2f} "
+            f"{raw_bytes / 1e6 / max(compress_seconds, 1e-9):>14.1f} "
+            f"{raw_bytes / 1e6 / max(decompress_seconds, 1e-9):>16.1f}"
+        )
+    return 0
+
+
+def build_search_index(args) -> int:
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        if not manifest.search_available:
+            _log.error("Prompt search needs SQLite with the FTS5 extension.")
+            return 1
+        manifest.rebuild_search_index()
+    finally:
+        manifest.close()
+    return 0
+
+
+def search(args) -> int:
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        if not manifest.search_available:
+            _log.error("Prompt search needs SQLite with the FTS5 extension.")
+            return 1
+        if manifest.is_empty():
+            manifest.rebuild()
+        elif manifest.search_index_count() < manifest.job_count():
+            # Manifests from before prompt search have jobs but no search index yet
+            manifest.rebuild_search_index()
+        job_types = {job_type.strip() for job_type in args.type.split(",") if job_type.strip()} if args.type else None
+        start = time.perf_counter()
+        hits = manifest.search_prompts(" ".join(args.query), args.since, args.until, job_types, args.limit)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    finally:
+        manifest.close()
+    for hit in hits:
+        print(f"{hit.enqueue_time[:19]}  {hit.type or '-':<8} {hit.job_id}  {hit.json_path}")
+        print(f"    {hit.snippet}")
+    _log.info(f"{len(hits)} hits in {elapsed_ms:.1f} ms")
+    return 0
+
+
+def derivatives(args) -> int:
+    try:
+        sizes = parse_sizes(args.sizes)
+    except ValueError as e:
+        _log.error(f"Invalid --sizes: {e}")
+        return 1
+    if not sizes:
+        _log.error("--sizes must list at least one size.")
+        return 1
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        if manifest.is_empty():
+            manifest.rebuild()
+        generator = DerivativeGenerator(
+            manifest, sizes, image_format=args.format, quality=args.quality, workers=args.workers or None
+        )
+        try:
+            image_paths = manifest.downloaded_image_paths()
+            _log.info(f"Creating {args.format} previews of {len(image_paths)} images with {generator.workers} processes")
+            for image_path in image_paths:
+                generator.submit(image_path)
+        finally:
+            generator.close()
+    finally:
+        manifest.close()
+    _log.info(f"Derivatives finished. Stats: {generator.stats}")
+    return 1 if generator.has_errors() else 0
+
+
+def export(args) -> int:
+    try:
+        stats = export_archive(args.archive_root, args.output_dir.resolve(), export_format=args.format, full=args.full)
+    except ValueError as e:
+        _log.error(str(e))
+        return 1
+    _log.info(f"Export finished. Stats: {stats}")
+    return 0
+
+
+def reformat(args) -> int:
+    start = time.perf_counter()
+    stats = reformat_archive(
+        args.archive_root,
+        json_indent=args.json_indent if args.json_indent > 0 else None,
+        workers=args.workers or None,
+    )
+    _log.info(f"Reformat finished in {time.perf_counter() - start:.1f} s. Stats: {stats}")
+    return 1 if any(stats[key] for key in REFORMAT_ERROR_STATS) else 0
+
+
+def verify(args) -> int:
+    manifest = ArchiveManifest(args.archive_root)
+    try:
+        if manifest.is_empty():
+            manifest.rebuild()
+        verifier = ImageVerifier(manifest, workers=args.workers, requeue=not args.report_only)
+        start = time.perf_counter()
+        verifier.verify_all()
+        report = manifest.image_check_report()
+    finally:
+        manifest.close()
+    elapsed = time.perf_counter() - start
+    _log.info(
+        f"Verify finished in {elapsed:.1f} s, {verifier.stats['verified_bytes'] / 1e6 / max(elapsed, 1e-3):.1f} MB/s hashed. "
+        f"Stats: {verifier.stats}"
+    )
+    _log.info(f"{report['checked']} images verified in total, {report['failed']} of them failed verification.")
+    if verifier.stats["requeued"]:
+        _log.info(f"Run mj-downloader.py to download the {verifier.stats['requeued']} requeued images again.")
+    return 1 if verifier.has_errors() or verifier.stats["corrupt"] or verifier.stats["missing"] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Maintenance tasks for a Midjourney archive.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--archive-root",
+        type=Path,
+        default=Path.cwd() / "mj-archive",
+        help="Root directory of the Midjourney metadata archive.",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging level.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild-index",
+        help="Rebuild the archive manifest from the JSON metadata files on disk.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    rebuild_parser.set_defaults(func=rebuild_index)
+
+    store_report_parser = subparsers.add_parser(
+        "store-report",
+        help="Show the size of the content-addressed image store and the bytes saved by deduplication.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    store_report_parser.set_defaults(func=store_report)
+
+    convert_parser = subparsers.add_parser(
+        "convert",
+        help="Convert job metadata between the per-file and packed storage layouts.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    convert_parser.add_argument(
+        "--to",
+        type=str,
+        required=True,
+        choices=STORAGE_LAYOUTS,
+        help="Storage layout to convert the archive to.",
+    )
+    convert_parser.add_argument(
+        "--json-indent",
+        type=int,
+        default=2,
+        help="Indentation of the JSON files written when converting to 'files'. Use 0 for compact JSON.",
+    )
+    convert_parser.add_argument(
+        "--compression",
+        type=str,
+        default="none",
+        choices=COMPRESSIONS,
+        help="Compression of the shards written when converting to 'packed'. Existing shards with "
+             "another compression are recompressed.",
+    )
+    convert_parser.set_defaults(func=convert)
+
+    train_parser = subparsers.add_parser(
+        "train-dictionary",
+        help="Train the archive's zstd dictionary on its jobs, before writing zstd compressed shards.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    train_parser.add_argument(
+        "--samples",
+        type=int,
+        default=ZSTD_TRAINING_SAMPLES,
+        help="Number of jobs to train the dictionary on.",
+    )
+    train_parser.set_defaults(func=train_dictionary)
+
+    report_parser = subparsers.add_parser(
+        "compression-report",
+        help="Show the packed shards on disk and measure ratio and speed of each compression on the archive's jobs.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    report_parser.add_argument(
+        "--samples",
+        type=int,
+        default=5000,
+        help="Number of jobs to measure on.",
+    )
+    report_parser.set_defaults(func=compression_report)
+
+    build_search_parser = subparsers.add_parser(
+        "build-search-index",
+        help="Build the full-text prompt search index from the metadata in the archive.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    build_search_parser.set_defaults(func=build_search_index)
+
+    search_parser = subparsers.add_parser(
+        "search",
+        help="Search the archived prompts, best matches first.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    search_parser.add_argument(
+        "query",
+        nargs="+",
+        help="Words to search for in prompts, full commands and job types. SQLite FTS5 syntax is supported, "
+             "e.g. 'cat AND (dog OR bird)', '\"a red car\"', 'neon*' or 'full_command:ar'.",
+    )
+    search_parser.add_argument(
+        "--since",
+        type=dt.date.fromisoformat,
+        default=None,
+        help="Only return jobs enqueued on or after this day (YYYY-MM-DD).",
+    )
+    search_parser.add_argument(
+        "--until",
+        type=dt.date.fromisoformat,
+        default=None,
+        help="Only return jobs enqueued on or before this day (YYYY-MM-DD).",
+    )
+    search_parser.add_argument(
+        "--type",
+        type=str,
+        default="",
+        help="Comma-separated job types to return, e.g. 'upscale,grid'. Empty for all types.",
+    )
+    search_parser.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="Maximum number of results.",
+    )
+    search_parser.set_defaults(func=search)
+
+    derivatives_parser = subparsers.add_parser(
+        "derivatives",
+        help="Create preview images of all downloaded images, skipping those whose source did not change.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    derivatives_parser.add_argument(
+        "--sizes",
+        type=str,
+        required=True,
+        help="Comma-separated sizes in pixels of the previews, e.g. '256,1024'. Each preview fits into a square of that size.",
+    )
+    derivatives_parser.add_argument(
+        "--format",
+        type=str,
+        default="webp",
+        choices=tuple(DERIVATIVE_FORMATS),
+        help="Image format of the previews.",
+    )
+    derivatives_parser.add_argument(
+        "--quality",
+        type=int,
+        default=80,
+        help="Encoder quality of the previews (1-100).",
+    )
+    derivatives_parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of processes creating previews. Use 0 for one per CPU.",
+    )
+    derivatives_parser.set_defaults(func=derivatives)
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Export the job metadata to columnar files partitioned by month, appending the jobs archived "
+             "since the previous export.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    export_parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=Path.cwd() / "mj-export",
+        help="Directory of the export. Keep it outside the archive root, whose metadata files it would mix with.",
+    )
+    export_parser.add_argument(
+        "--format",
+        type=str,
+        default="parquet",
+        choices=tuple(EXPORT_FORMATS),
+        help="File format of the export: Parquet (zstd-compressed) or Arrow IPC.",
+    )
+    export_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Export all jobs again and replace the earlier part files.",
+    )
+    export_parser.set_defaults(func=export)
+
+    reformat_parser = subparsers.add_parser(
+        "reformat",
+        help="Rewrite every .json and .prompt.txt file from the JSON on disk, with the current prompt layout "
+             "and --json-indent, without any API request. Files whose content would not change are not touched.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    reformat_parser.add_argument(
+        "--json-indent",
+        type=int,
+        default=2,
+        help="Indentation of the JSON files, like mj-metadata-archiver.py --json-indent. Use 0 for compact JSON.",
+    )
+    reformat_parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of processes reformatting files. Use 0 for one per CPU.",
+    )
+    reformat_parser.set_defaults(func=reformat)
+
+    verify_parser = subparsers.add_parser(
+        "verify",
+        help="Check the format and hash of the downloaded images that changed since their last check, and "
+             "queue corrupt or missing images for download again.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    verify_parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads reading and hashing images.",
+    )
+    verify_parser.add_argument(
+        "--report-only",
+        action="store_true",
+        help="Only report corrupt and missing images; don't delete them or queue them for download.",
+    )
+    verify_parser.set_defaults(func=verify)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    )
+
+    args.archive_root = args.archive_root.resolve()
+    if not args.archive_root.is_dir():
+        _log.error(f"Archive root directory not found or is not a directory: {args.archive_root}")
+        return 1
+
+    try:
+        return args.func(args)
+    except ImportError as e: # A compressed shard needs a codec that is not installed
+        _log.error(str(e))
+        return 1
+    except KeyboardInterrupt:
+        _log.info("Caught KeyboardInterrupt. Exiting.")
+        return 1
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    exit(exit_status)
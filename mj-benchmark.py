@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Python command line tool to benchmark mj-metadata-archiver.py and
+mj-downloader.py offline, against a local stand-in for the Midjourney
+API and image CDN (see mj_standin.py).
+
+For every archive size, the real scripts crawl a synthetic archive of
+that many jobs and then download the images of its newest jobs. It
+reports jobs/sec for the crawl, images/sec and MB/s for the downloads
+and the peak RSS of each, and compares them to a saved baseline.
+"""
+
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from mj_archive import SCRIPTS_DIR
+from mj_standin import StandInArchive, StandInServer
+
+_log = logging.getLogger(__name__)
+
+# Compared against the baseline: metric name -> whether higher values are better
+BENCHMARK_METRICS = {
+    "crawl_jobs_per_sec": True,
+    "crawl_peak_rss_mb": False,
+    "download_images_per_sec": True,
+    "download_mb_per_sec": True,
+    "download_peak_rss_mb": False,
+}
+
+
+def run_phase(command: list[str], log_path: Path) -> tuple[float, float | None, int]:
+    """
+    Run one of the scripts. Returns its wall time in seconds, its peak RSS in MB
+    (None where the platform can't tell) and its exit status.
+    """
+    _log.debug(f"Running: {shlex.join(command)}")
+    with log_path.open("w", encoding="utf-8") as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            _, status, rusage = os.wait4(process.pid, 0)
+            seconds = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in KiB on Linux and in bytes on macOS
+            peak_rss_bytes = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+            peak_rss_mb = peak_rss_bytes / 1e6
+        else:
+            process.wait()
+            seconds = time.perf_counter() - start
+            peak_rss_mb = None
+    if process.returncode != 0:
+        _log.error(f"{Path(command[1]).name} exited with status {process.returncode}, see {log_path}")
+    return seconds, peak_rss_mb, process.returncode
+
+
+def benchmark_size(job_count: int, args, work_dir: Path) -> dict:
+    archive = StandInArchive(job_count, listing_cap=args.listing_cap or None)
+    server = StandInServer(
+        archive,
+        page_latency=args.page_latency,
+        image_latency=args.image_latency,
+        jitter=args.jitter,
+        image_size=args.image_size,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+    )
+    archive_root = work_dir / f"archive-{job_count}"
+    shutil.rmtree(archive_root, ignore_errors=True)
+    archive_root.mkdir(parents=True)
+    result = {}
+    server.start()
+    try:
+        crawl_command = [
+            sys.executable, str(SCRIPTS_DIR / "mj-metadata-archiver.py"),
+            "--archive-root", str(archive_root),
+            "--user-id", "benchmark",
+            "--session-token", "benchmark",
+            "--job-type", "all",
+            "--api-base-url", server.base_url,
+            "--log-level", "WARNING",
+            # The archiver expects the same cap as the stand-in; --archiver-args can still override it
+            *(("--listing-cap", str(args.listing_cap)) if args.listing_cap else ()),
+            *shlex.split(args.archiver_args),
+        ]
+        _log.info(f"{job_count} jobs: crawling")
+        seconds, peak_rss_mb, status = run_phase(crawl_command, work_dir / f"crawl-{job_count}.log")
+        result.update({
+            "crawl_seconds": round(seconds, 3),
+            "crawl_jobs": server.stats["jobs"],
+            "crawl_jobs_per_sec": round(server.stats["jobs"] / seconds, 1),
+            "crawl_peak_rss_mb": peak_rss_mb and round(peak_rss_mb, 1),
+            "crawl_exit_status": status,
+        })
+        if server.stats["jobs"] != job_count:
+            _log.warning(f"Crawl archived {server.stats['jobs']} of {job_count} jobs")
+
+        if args.download_jobs > 0:
+            # Only the days of the newest jobs are downloaded; the walker still sees the whole tree
+            since = archive.enqueue_time(max(0, job_count - args.download_jobs)).date()
+            download_command = [
+                sys.executable, str(SCRIPTS_DIR / "mj-downloader.py"),
+                "--archive-root", str(archive_root),
+                "--job-types-to-download", "all",
+                "--since", since.isoformat(),
+                "--workers", str(args.workers),
+                "--log-level", "WARNING",
+                *shlex.split(args.downloader_args),
+            ]
+            server.reset_stats()
+            _log.info(f"{job_count} jobs: downloading images since {since}")
+            seconds, peak_rss_mb, status = run_phase(download_command, work_dir / f"download-{job_count}.log")
+            result.update({
+                "download_seconds": round(seconds, 3),
+                "download_images": server.stats["images"],
+                "download_bytes": server.stats["image_bytes"],
+                "download_images_per_sec": round(server.stats["images"] / seconds, 1),
+                "download_mb_per_sec": round(server.stats["image_bytes"] / 1e6 / seconds, 2),
+                "download_peak_rss_mb": peak_rss_mb and round(peak_rss_mb, 1),
+                "download_exit_status": status,
+            })
+    finally:
+        server.stop()
+        if not args.keep_archives:
+            shutil.rmtree(archive_root, ignore_errors=True)
+    return result
+
+
+def print_results(results: dict, baseline: dict | None, tolerance: float) -> int:
+    """
+    Print the results next to the baseline. Returns the number of metrics that
+    are worse than the baseline by more than `tolerance` percent.
+    """
+    regressions = 0
+    print(f"{'Jobs':>8}  {'Metric':<24} {'Result':>12} {'Baseline':>12} {'Change':>8}")
+    for size, metrics in results["sizes"].items():
+        baseline_metrics = (baseline or {}).get("sizes", {}).get(size, {})
+        for metric, higher_is_better in BENCHMARK_METRICS.items():
+            value = metrics.get(metric)
+            if value is None:
+                continue
+            baseline_value = baseline_metrics.get(metric)
+            change = ""
+            if baseline_value:
+                change_percent = (value - baseline_value) / baseline_value * 100
+                change = f"{change_percent:+.1f}%"
+                if (-change_percent if higher_is_better else change_percent) > tolerance:
+                    change += " !"
+                    regressions += 1
+            baseline_text = "-" if baseline_value is None else str(baseline_value)
+            print(f"{size:>8}  {metric:<24} {value:>12} {baseline_text:>12} {change:>8}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the archiver and the downloader against a local stand-in for the Midjourney API and CDN.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        default="1000,10000",
+        help="Comma-separated archive sizes in jobs to benchmark, e.g. '1000,10000,100000,500000'.",
+    )
+    parser.add_argument(
+        "--page-latency",
+        type=float,
+        default=0.05,
+        help="Seconds the stand-in API takes to answer a job listing request.",
+    )
+    parser.add_argument(
+        "--image-latency",
+        type=float,
+        default=0.01,
+        help="Seconds the stand-in CDN takes before sending an image.",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.01,
+        help="Random extra latency in seconds, up to this much, added to every response.",
+    )
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        default=64 * 1024,
+        help="Size of the synthetic images in bytes.",
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Share of requests the stand-in answers with 429 and a Retry-After of one second.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Share of requests the stand-in answers with 503.",
+    )
+    parser.add_argument(
+        "--listing-cap",
+        type=int,
+        default=0,
+        help="End every job listing of the stand-in after this many jobs, like the real API does after about 2500. "
+             "Use 0 for no cap; a capped archive needs '--archiver-args --partitioned' to be crawled completely.",
+    )
+    parser.add_argument(
+        "--download-jobs",
+        type=int,
+        default=2000,
+        help="Download the images of about this many of the newest jobs, by whole days. Use 0 to skip downloads.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of concurrent downloads (mj-downloader.py --workers).",
+    )
+    parser.add_argument(
+        "--archiver-args",
+        type=str,
+        default="",
+        help="Extra arguments for mj-metadata-archiver.py, e.g. '--storage packed --prefetch-pages 2'.",
+    )
+    parser.add_argument(
+        "--downloader-args",
+        type=str,
+        default="",
+        help="Extra arguments for mj-downloader.py, e.g. '--dedupe-store'.",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=None,
+        help="Directory for the benchmark archives and logs. A temporary directory by default.",
+    )
+    parser.add_argument(
+        "--keep-archives",
+        action="store_true",
+        help="Keep the archives written by the benchmark in the work directory.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="Results of an earlier run (see --save-results) to compare against.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=10.0,
+        help="Percentage by which a metric may be worse than the baseline before it counts as a regression.",
+    )
+    parser.add_argument(
+        "--save-results",
+        type=Path,
+        default=None,
+        help="Write the results as JSON to this file, e.g. to use them as the baseline of later runs.",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging level.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    )
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    except ValueError:
+        _log.error(f"--sizes must be comma-separated numbers of jobs, got '{args.sizes}'")
+        return 1
+
+    baseline = None
+    if args.baseline is not None:
+        try:
+            baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as e:
+            _log.error(f"Cannot read baseline {args.baseline}: {e}")
+            return 1
+
+    config = {
+        "page_latency": args.page_latency,
+        "image_latency": args.image_latency,
+        "jitter": args.jitter,
+        "image_size": args.image_size,
+        "throttle_rate": args.throttle_rate,
+        "error_rate": args.error_rate,
+        "listing_cap": args.listing_cap,
+        "download_jobs": args.download_jobs,
+        "workers": args.workers,
+        "archiver_args": args.archiver_args,
+        "downloader_args": args.downloader_args,
+    }
+    if baseline is not None and baseline.get("config") != config:
+        _log.warning(f"The baseline was measured with different settings: {baseline.get('config')}")
+    results = {"created": dt.datetime.now().isoformat(timespec="seconds"), "config": config, "sizes": {}}
+
+    temporary_dir = None
+    if args.work_dir is None:
+        temporary_dir = tempfile.TemporaryDirectory(prefix="mj-benchmark-")
+        work_dir = Path(temporary_dir.name)
+    else:
+        work_dir = args.work_dir.resolve()
+        work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        for job_count in sizes:
+            results["sizes"][str(job_count)] = benchmark_size(job_count, args, work_dir)
+    except KeyboardInterrupt:
+        _log.info("Caught KeyboardInterrupt. Reporting the sizes benchmarked so far.")
+    finally:
+        if temporary_dir is not None:
+            temporary_dir.cleanup()
+
+    regressions = print_results(results, baseline, args.tolerance)
+    if args.save_results is not None:
+        args.save_results.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+        _log.info(f"Results saved to {args.save_results}")
+    failed_phases = sum(
+        1 for metrics in results["sizes"].values() for key, value in metrics.items() if key.endswith("_exit_status") and value
+    )
+    if regressions:
+        _log.warning(f"{regressions} metrics regressed by more than {args.tolerance}% against the baseline.")
+    return 1 if regressions or failed_phases else 0
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    exit(exit_status)
@@ -4,40 +4,289 @@ Python command line tool to download images linked from
 Midjourney metadata archive.
 """
 
+import argparse
 import collections
+import datetime as dt
+import hashlib
 import json
 import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Set
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from mj_archive import is_shard_path, iter_job_files, read_shard
+from mj_derivatives import DERIVATIVE_FORMATS, DerivativeGenerator, parse_sizes
+from mj_manifest import DOWNLOAD_ORDERS, IMAGE_STATE_DONE, IMAGE_STATE_FAILED, IMAGE_STATE_PENDING, ArchiveManifest
+from mj_metrics import METRICS, write_metrics
+from mj_profiling import RunProfiler
+from mj_ratelimit import AdaptiveLimiter, RateSchedule, SharedTransport, TokenBucket, parse_byte_rate, request_with_retries
+from mj_store import ContentStore
 
 _log = logging.getLogger(__name__)
 
+PART_SUFFIX = ".part"
+
+
+class IncompleteDownloadError(IOError):
+    """
+    The connection ended before the number of bytes announced by the server arrived.
+    """
+
 
 class MidjourneyDownloader:
-    def __init__(self, job_types_to_download: Set[str]):
+    # Stats keys that make the download process exit with an error code
+    ERROR_STATS = (
+        "error_http",
+        "error_connection",
+        "error_timeout",
+        "error_io_write",
+        "error_unexpected_download",
+        "error_incomplete_download",
+        "error_json_decode",
+        "error_file_read",
+        "error_derivative",
+    )
+
+    def __init__(
+        self,
+        job_types_to_download: Set[str],
+        workers: int = 1,
+        manifest: ArchiveManifest | None = None,
+        store: ContentStore | None = None,
+        chunk_size: int = 64 * 1024,
+        max_retries: int = 5,
+        derivatives: DerivativeGenerator | None = None,
+        transport: SharedTransport | None = None,
+        account: str | None = None,
+        bandwidth_budget: TokenBucket | None = None,
+    ):
         self.stats = collections.Counter()
         self.job_types_to_download = job_types_to_download
         if not self.job_types_to_download: # Download all if empty set is passed
             _log.info("No specific job types provided, will attempt to download for all types with image_paths.")
+        self.workers = max(1, workers)
+        self._stats_lock = threading.Lock() # Counter increments are not atomic across worker threads
+        self._sessions: dict[str, requests.Session] = {}
+        self._sessions_lock = threading.Lock()
+        # One adaptive concurrency limit per host, up to the worker count
+        self._limiters: dict[str, AdaptiveLimiter] = {}
+        self.max_retries = max_retries
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots: threading.BoundedSemaphore | None = None
+        self._queued_downloads = 0 # Submitted to the workers and not finished yet
+        self.manifest = manifest
+        self.store = store
+        self.chunk_size = chunk_size
+        # Creates previews of every newly downloaded image in a process pool
+        self.derivatives = derivatives
+        # Session, per-host limiters and budgets shared with the downloaders of other accounts
+        self.transport = transport
+        self.account = account
+        # Bytes per second for all workers together, unless the transport has a budget
+        self.bandwidth_budget = transport.bandwidth_budget if transport is not None else bandwidth_budget
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _get_session(self, url: str) -> requests.Session:
+        """
+        Return the keep-alive session for the URL's host, creating it on first use.
+        Connection pools are sized to the worker count so no worker waits for a socket.
+        """
+        if self.transport is not None:
+            return self.transport.session
+        host = urlsplit(url).netloc
+        with self._sessions_lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[host] = session
+            return session
 
+    def _get_limiter(self, url: str) -> AdaptiveLimiter:
+        host = urlsplit(url).netloc
+        if self.transport is not None:
+            return self.transport.download_limiter(host)
+        with self._sessions_lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = AdaptiveLimiter(host, max_concurrency=self.workers)
+            return limiter
 
-    def walk_archive(self, archive_root: Path):
+    def _set_image_state(
+        self, job_id: str, image_index: int | None, url: str, path: Path, state: str, error: str | None = None
+    ):
+        if self.manifest is not None and image_index is not None:
+            self.manifest.set_image_state(job_id, image_index, url, path, state, error)
+
+    def _image_downloaded(self, job_id: str, image_index: int | None, url: str, path: Path):
+        self._set_image_state(job_id, image_index, url, path, IMAGE_STATE_DONE)
+        if self.derivatives is not None:
+            self.derivatives.submit(path)
+
+    def has_errors(self) -> bool:
+        return any(self.stats.get(key, 0) > 0 for key in self.ERROR_STATS)
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            for limiter in self._limiters.values():
+                self.stats.update(limiter.stats) # Retries and throttling per host
+            self._limiters.clear()
+        if self.transport is None and self.bandwidth_budget is not None:
+            self.stats.update(self.bandwidth_budget.stats)
+            self.bandwidth_budget.stats.clear()
+
+    def walk_archive(
+        self, archive_root: Path, since: dt.date | None = None, until: dt.date | None = None, newest_first: bool = False
+    ):
+        """
+        Download the images of the jobs in the archive, streaming metadata files
+        as they are found. `since`/`until` limit the walk to an inclusive range of days.
+        With `newest_first`, the walk starts with the most recent day.
+        """
         _log.info(f"Walking through archive root: {archive_root}")
-        json_files = list(archive_root.glob("**/*.json"))
-        if not json_files:
-            _log.warning(f"No JSON metadata files found in {archive_root} or its subdirectories.")
+        self._start_workers()
+        found_files = 0
+        try:
+            for job_info_path in iter_job_files(
+                archive_root, since=since, until=until, include_shards=True, newest_first=newest_first
+            ):
+                found_files += 1
+                _log.debug(f"Processing metadata file: {job_info_path}")
+                if is_shard_path(job_info_path):
+                    self.download_from_shard(job_info_path, archive_root)
+                else:
+                    self.download_from_metadata_file(job_info_path)
+            if not found_files:
+                _log.warning(f"No JSON metadata files found in {archive_root} or its subdirectories.")
+        except BaseException:
+            self._stop_workers(cancel=True)
+            raise
+        finally:
+            self._stop_workers()
+
+    def download_queue(
+        self,
+        since: dt.date | None = None,
+        until: dt.date | None = None,
+        max_attempts: int | None = None,
+        order: str = "archived",
+        type_weights: dict[str, float] | None = None,
+    ):
+        """
+        Download the images queued in the manifest: the pending ones and the failed ones
+        with fewer than `max_attempts` attempts. Unlike `walk_archive`, no metadata file is
+        read and only queued images are checked on disk, so a run takes as long as its new work.
+        `order` and `type_weights` prioritize the queue, see `ArchiveManifest.iter_queued_images`.
+        """
+        counts = self.manifest.image_state_counts()
+        _log.info(
+            f"Download queue: {counts.get(IMAGE_STATE_PENDING, 0)} pending and "
+            f"{counts.get(IMAGE_STATE_FAILED, 0)} failed images, {counts.get(IMAGE_STATE_DONE, 0)} done."
+        )
+        given_up = self.manifest.failed_image_count(min_attempts=max_attempts) if max_attempts else 0
+        if given_up:
+            _log.warning(f"Not retrying {given_up} images that failed {max_attempts} times, see --max-attempts.")
+        self._start_workers()
+        try:
+            queued_images = self.manifest.iter_queued_images(
+                self.job_types_to_download, since, until, max_attempts, order=order, type_weights=type_weights
+            )
+            for image in queued_images:
+                self.stats["queued_images"] += 1
+                if image.attempts:
+                    _log.debug(f"Retrying {image.url} for job {image.job_id}, {image.attempts} failed attempts so far")
+                    self.stats["retried_failed"] += 1
+                if image.path.exists(): # Downloaded by a run that did not update the manifest
+                    _log.debug(f"Image already exists, skipping: {image.path}")
+                    self.stats["skipped_already_exists"] += 1
+                    self._set_image_state(image.job_id, image.image_index, image.url, image.path, IMAGE_STATE_DONE)
+                    continue
+                self._submit_download(image.url, image.path, image.job_id, image.image_index)
+        except BaseException:
+            self._stop_workers(cancel=True)
+            raise
+        finally:
+            self._stop_workers()
+            self.manifest.commit()
+
+    def download_jobs_from_queue(self, job_queue: queue.Queue, stop_event: threading.Event | None = None):
+        """
+        Download the images of `(job_info, job_info_path)` items taken from `job_queue`
+        until a `None` sentinel arrives. Used to download jobs while they are still being
+        crawled; a bounded queue makes the producer wait when downloads fall behind.
+        If `stop_event` is set, remaining items are drained without downloading them.
+        """
+        self._start_workers()
+        try:
+            while True:
+                item = job_queue.get()
+                if item is None:
+                    break
+                if stop_event is not None and stop_event.is_set():
+                    continue
+                job_info, job_info_path = item
+                try:
+                    self.download_job(job_info, job_info_path)
+                except Exception as e:
+                    _log.error(f"Unexpected error downloading images for {job_info_path}: {e}", exc_info=True)
+                    self._count("error_unexpected_download")
+        finally:
+            self._stop_workers(cancel=stop_event is not None and stop_event.is_set())
+
+    def _start_workers(self):
+        if self.workers > 1 and self._executor is None:
+            _log.info(f"Downloading with {self.workers} concurrent workers.")
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mj-download")
+            # Bound the number of queued downloads so the producer doesn't race ahead of the workers
+            self._slots = threading.BoundedSemaphore(self.workers * 2)
+
+    def _stop_workers(self, cancel: bool = False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=cancel) # Wait for in-flight downloads to finish
+            self._executor = None
+            self._slots = None
+
+    def _submit_download(self, url: str, path: Path, job_id: str, image_index: int | None = None):
+        if self._executor is None:
+            self.download_url(url, path, job_id, image_index)
             return
+        self._slots.acquire()
+        with self._stats_lock:
+            METRICS.observe_queue_depth("image_downloads", self._queued_downloads)
+            self._queued_downloads += 1
+        try:
+            future = self._executor.submit(self.download_url, url, path, job_id, image_index)
+        except BaseException:
+            self._download_done()
+            raise
+        future.add_done_callback(lambda _: self._download_done())
 
-        for job_info_path in json_files:
-            _log.debug(f"Processing metadata file: {job_info_path}")
-            self.download_from_metadata_file(job_info_path)
+    def _download_done(self):
+        with self._stats_lock:
+            self._queued_downloads -= 1
+        self._slots.release()
 
     def download_from_metadata_file(self, job_info_path: Path):
         try:
-            job_info_text = job_info_path.read_text(encoding="utf8")
-            job_info = json.loads(job_info_text)
+            with METRICS.time_phase("metadata_read"):
+                job_info_text = job_info_path.read_text(encoding="utf8")
+                job_info = json.loads(job_info_text)
         except json.JSONDecodeError as e:
             _log.error(f"Error decoding JSON from {job_info_path}: {e}")
             self.stats["error_json_decode"] += 1
@@ -47,6 +296,23 @@ class MidjourneyDownloader:
             self.stats["error_file_read"] += 1
             return
 
+        self.download_job(job_info, job_info_path)
+
+    def download_from_shard(self, shard_path: Path, archive_root: Path | None = None):
+        """
+        Download the images of all jobs in a packed day shard, compressed or not.
+        """
+        try:
+            for entry in read_shard(shard_path, archive_root):
+                self.download_job(entry.job_info, entry.job_path)
+        except IOError as e:
+            _log.error(f"Error reading shard {shard_path}: {e}")
+            self.stats["error_file_read"] += 1
+
+    def download_job(self, job_info: dict, job_info_path: Path):
+        """
+        Download the images of an already parsed job whose metadata is stored at `job_info_path`.
+        """
         job_id = job_info.get("id", "unknown_id")
         job_type = job_info.get("type")
 
@@ -107,35 +373,206 @@ class MidjourneyDownloader:
             if download_path.exists():
                 _log.debug(f"Image already exists, skipping: {download_path}")
                 self.stats["skipped_already_exists"] += 1
+                self._set_image_state(job_id, i, image_url, download_path, IMAGE_STATE_DONE)
             else:
-                self.download_url(image_url, download_path, job_id)
+                self._submit_download(image_url, download_path, job_id, i)
 
-    def download_url(self, url: str, path: Path, job_id: str):
+    def download_url(self, url: str, path: Path, job_id: str, image_index: int | None = None):
+        if self.store is None:
+            self._download_url(url, path, job_id, image_index)
+            return
+        with self.store.url_lock(url):
+            self._download_url(url, path, job_id, image_index)
+
+    def _download_url(self, url: str, path: Path, job_id: str, image_index: int | None):
+        if self.store is not None and self._link_from_store(url, path, job_id):
+            self._image_downloaded(job_id, image_index, url, path)
+            return
         _log.info(f"Downloading for job {job_id}: {path.name} from {url}")
         try:
-            with requests.get(url, stream=True, timeout=30) as response: # Added timeout
-                response.raise_for_status()
-                # TODO: Potentially check Content-Type header here to verify image format if extension was guessed
-                with path.open("wb") as f:
-                    for chunk in response.iter_content(chunk_size=8192): # Use a common chunk size
-                        f.write(chunk)
-                self.stats["downloaded_successfully"] += 1
-                _log.debug(f"Successfully downloaded {path.name}")
+            with self._get_limiter(url).slot(self.account):
+                if self.store is not None:
+                    self._download_into_store(url, path, job_id)
+                else:
+                    # Download next to the target and rename on success, so an interrupted
+                    # download never leaves a truncated image that would be skipped forever
+                    part_path = path.with_name(f"{path.name}{PART_SUFFIX}")
+                    self._fetch_to_part_file(url, part_path, job_id)
+                    os.replace(part_path, path)
+            self._count("downloaded_successfully")
+            _log.debug(f"Successfully downloaded {path.name}")
         except requests.exceptions.HTTPError as e:
             _log.error(f"HTTP error downloading {url} for job {job_id}: {e}")
-            self.stats["error_http"] += 1
+            self._count("error_http")
+            error = f"error_http: {e}"
         except requests.exceptions.ConnectionError as e:
             _log.error(f"Connection error downloading {url} for job {job_id}: {e}")
-            self.stats["error_connection"] += 1
+            self._count("error_connection")
+            error = f"error_connection: {e}"
         except requests.exceptions.Timeout as e:
             _log.error(f"Timeout downloading {url} for job {job_id}: {e}")
-            self.stats["error_timeout"] += 1
+            self._count("error_timeout")
+            error = f"error_timeout: {e}"
+        except (IncompleteDownloadError, requests.exceptions.ChunkedEncodingError) as e:
+            _log.error(f"Incomplete download of {url} for job {job_id}: {e}. It will be resumed on the next run.")
+            self._count("error_incomplete_download")
+            error = f"error_incomplete_download: {e}"
         except IOError as e:
             _log.error(f"IO error writing file {path} for job {job_id}: {e}")
-            self.stats["error_io_write"] += 1
+            self._count("error_io_write")
+            error = f"error_io_write: {e}"
         except Exception as e:
             _log.error(f"An unexpected error occurred downloading {url} for job {job_id}: {e}")
-            self.stats["error_unexpected_download"] += 1
+            self._count("error_unexpected_download")
+            error = f"error_unexpected_download: {e}"
+        else:
+            self._image_downloaded(job_id, image_index, url, path)
+            return
+        self._set_image_state(job_id, image_index, url, path, IMAGE_STATE_FAILED, error)
+
+    def _fetch_to_part_file(self, url: str, part_path: Path, job_id: str, hash_content: bool = False) -> tuple[int, str | None]:
+        """
+        Download `url` into `part_path`, resuming from the bytes already in it with a
+        `Range` request. Returns the final size and, if requested, the SHA-256 of the content.
+        Raises IncompleteDownloadError if fewer bytes arrived than the server announced;
+        the partial file is kept so the next attempt can resume it.
+        """
+        resume_from = part_path.stat().st_size if part_path.exists() else 0
+        # Ranges refer to the encoded bytes, so ask for the raw file
+        headers = {"Accept-Encoding": "identity"}
+        if resume_from:
+            headers["Range"] = f"bytes={resume_from}-"
+
+        transport = self.transport
+        response = request_with_retries(
+            self._get_session(url), url, self._get_limiter(url), self.max_retries,
+            budget=transport.request_budget if transport is not None else None, client=self.account,
+            stream=True, timeout=30, headers=headers,
+        )
+        bandwidth_budget = self.bandwidth_budget
+        with response:
+            if resume_from and response.status_code == 416:
+                # The partial file is not a prefix of the current content (e.g. it is already
+                # as large as the image or the image changed): start over
+                _log.debug(f"Server rejected resuming {part_path.name} at byte {resume_from}, restarting download.")
+                part_path.unlink()
+                return self._fetch_to_part_file(url, part_path, job_id, hash_content)
+            response.raise_for_status()
+            # TODO: Potentially check Content-Type header here to verify image format if extension was guessed
+
+            if resume_from and response.status_code == 206:
+                _log.info(f"Resuming download for job {job_id}: {part_path.name} from byte {resume_from}")
+                self._count("resumed_downloads")
+                self._count("bytes_resumed", resume_from)
+                offset, mode = resume_from, "ab"
+            else:
+                offset, mode = 0, "wb" # Server ignored the Range header and sent the whole image
+            expected_size = _expected_size(response, offset)
+
+            hasher = hashlib.sha256() if hash_content else None
+            if hasher is not None and offset:
+                with part_path.open("rb") as f:
+                    for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                        hasher.update(chunk)
+
+            size = offset
+            write_seconds = 0.0
+            with part_path.open(mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if bandwidth_budget is not None:
+                        bandwidth_budget.take(len(chunk), self.account)
+                    write_start = time.perf_counter()
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    write_seconds += time.perf_counter() - write_start
+                    size += len(chunk)
+            METRICS.observe("mj_phase_duration_seconds", write_seconds, phase="image_write")
+            METRICS.count("mj_transferred_bytes_total", size - offset, endpoint=self._get_limiter(url).name)
+
+        if expected_size is not None and size != expected_size:
+            raise IncompleteDownloadError(f"received {size} of {expected_size} bytes")
+        return size, hasher.hexdigest() if hasher is not None else None
+
+    def _link_from_store(self, url: str, path: Path, job_id: str) -> bool:
+        """
+        Link `path` to an earlier download of `url` in the content-addressed store.
+        Returns False if the URL has to be downloaded.
+        """
+        stored = self.store.object_for_url(url)
+        if stored is None:
+            return False
+        object_path, sha256, size = stored
+        try:
+            method = self.store.link(object_path, path, sha256)
+        except OSError as e:
+            _log.warning(f"Could not link {path} to store object {object_path}: {e}. Downloading instead.")
+            return False
+        _log.info(f"Linked for job {job_id}: {path.name} from store ({method}), URL already downloaded")
+        self._count("deduplicated_by_url")
+        self._count("bytes_saved_dedupe", size)
+        return True
+
+    def _download_into_store(self, url: str, path: Path, job_id: str):
+        part_path = self.store.partial_path(url)
+        size, sha256 = self._fetch_to_part_file(url, part_path, job_id, hash_content=True)
+        object_path, is_new = self.store.add(part_path, sha256, size, url, path.suffix.lstrip('.'))
+        self.store.link(object_path, path, sha256)
+        if not is_new:
+            _log.debug(f"Content of {url} for job {job_id} was already in the store")
+            self._count("deduplicated_by_content")
+            self._count("bytes_saved_dedupe", size)
+
+
+def _expected_size(response: requests.Response, offset: int) -> int | None:
+    """
+    Total size of the file announced by the server, or None if it can't be known
+    (no Content-Length, or a content encoding that changes the byte count).
+    """
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    content_range = response.headers.get("Content-Range")
+    if response.status_code == 206 and content_range:
+        total = content_range.rpartition("/")[2]
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        return offset + int(content_length)
+    return None
+
+
+def parse_job_types(job_types: str) -> Set[str]:
+    """
+    Parse a comma-separated `--job-types-to-download` value. An empty set means all types.
+    """
+    job_types_str = job_types.lower()
+    if job_types_str == "" or job_types_str == "all":
+        job_types_set = set() # Empty set means download all
+        _log.info("Will download images for all job types with image_paths.")
+    else:
+        job_types_set = {jt.strip() for jt in job_types_str.split(',') if jt.strip()}
+        _log.info(f"Will download images for job types: {job_types_set}")
+    return job_types_set
+
+
+def parse_type_weights(type_weights: str) -> dict[str, float]:
+    """
+    Parse a comma-separated `--type-weights` value like "upscale=4,grid=1". Types not listed weigh 1.
+    """
+    weights = {}
+    for part in type_weights.split(","):
+        if not part.strip():
+            continue
+        job_type, _, weight = part.partition("=")
+        try:
+            value = float(weight)
+        except ValueError:
+            raise ValueError(f"Invalid weight in '{part.strip()}', expected e.g. 'upscale=4'") from None
+        if value <= 0:
+            raise ValueError(f"Weight of {job_type.strip()} must be positive, got {weight.strip()}")
+        weights[job_type.strip().lower()] = value
+    return weights
 
 
 def main():
@@ -156,6 +593,142 @@ def main():
         help="Comma-separated list of job types to download images for (e.g., 'upscale,grid'). "
              "Provide an empty string or 'all' to download for all types found in metadata. Default: 'upscale'.",
     )
+    parser.add_argument(
+        "--since",
+        type=dt.date.fromisoformat,
+        default=None,
+        help="Only process jobs enqueued on or after this day (YYYY-MM-DD). Older date folders are not scanned.",
+    )
+    parser.add_argument(
+        "--until",
+        type=dt.date.fromisoformat,
+        default=None,
+        help="Only process jobs enqueued on or before this day (YYYY-MM-DD). Newer date folders are not scanned.",
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Read every metadata file in the archive and check every image on disk, instead of only downloading "
+             "the manifest's queue of pending and failed images. Use it for metadata that was added to the "
+             "archive without the manifest, or when images were deleted.",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=5,
+        help="Stop retrying an image from the queue after this many failed runs. Use 0 to retry forever; "
+             "--rescan retries regardless.",
+    )
+    parser.add_argument(
+        "--order",
+        type=str,
+        default="newest",
+        choices=DOWNLOAD_ORDERS,
+        help="Order of the downloads: by the jobs' enqueue time, newest or oldest first, or 'archived' for the "
+             "order the images were queued in. Failed images are retried after all pending ones, those with "
+             "fewer attempts first. With --rescan, the date folders are walked in this order.",
+    )
+    parser.add_argument(
+        "--type-weights",
+        type=str,
+        default="",
+        help="Comma-separated job type weights for --order newest/oldest, e.g. 'upscale=4,grid=1': a job's age "
+             "counts divided by its weight, so an upscale four days old ranks like a grid of today. Unlisted "
+             "types weigh 1. Ignored with --rescan.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of concurrent image downloads. Connections are pooled and kept alive per host.",
+    )
+    parser.add_argument(
+        "--max-bytes-per-second",
+        type=parse_byte_rate,
+        default=0,
+        help="Cap the download bandwidth of all workers together, in bytes per second with an optional k, M "
+             "or G suffix (e.g. '5M'). Use 0 for no cap.",
+    )
+    parser.add_argument(
+        "--bandwidth-schedule",
+        type=str,
+        default="",
+        help="Bandwidth caps by local time of day, e.g. '09:00-18:00=1M,22:00-06:00=20M'; ranges may wrap "
+             "around midnight and the first matching one wins. --max-bytes-per-second applies outside of "
+             "them, and a rate of 0 lifts the cap.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64 * 1024,
+        help="Size in bytes of the chunks images are streamed to disk in.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="How often to retry a throttled (429), failed (5xx) or unanswered image request. Retries honour "
+             "Retry-After and otherwise back off exponentially with jitter; concurrency shrinks while the CDN "
+             "throttles and grows back up to --workers afterwards.",
+    )
+    parser.add_argument(
+        "--dedupe-store",
+        action="store_true",
+        help="Keep each distinct image once in a content-addressed store under <archive-root>/.mj-store "
+             "and hardlink the per-job image files to it. URLs already in the store are not downloaded again.",
+    )
+    parser.add_argument(
+        "--derivative-sizes",
+        type=str,
+        default="",
+        help="Comma-separated sizes in pixels of previews to create next to every newly downloaded image, "
+             "e.g. '256,1024'. Needs the Pillow package. Empty for none; see also 'mj-archive-tool.py derivatives'.",
+    )
+    parser.add_argument(
+        "--derivative-format",
+        type=str,
+        default="webp",
+        choices=tuple(DERIVATIVE_FORMATS),
+        help="Image format of the previews.",
+    )
+    parser.add_argument(
+        "--derivative-quality",
+        type=int,
+        default=80,
+        help="Encoder quality of the previews (1-100).",
+    )
+    parser.add_argument(
+        "--derivative-workers",
+        type=int,
+        default=0,
+        help="Number of processes creating previews. Use 0 for one per CPU.",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=Path,
+        default=None,
+        help="Write request latencies, bytes transferred, phase timings, queue depths and the final stats "
+             "to this file at the end of the run: a JSON report for a .json path, otherwise a Prometheus "
+             "textfile (e.g. for node exporter's textfile collector, use a .prom path).",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run with cProfile (all threads) and time the main stages; the results are written "
+             "to a timestamped directory under --profile-dir.",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace memory allocations with tracemalloc and write the top allocators and the peak to the "
+             "profile directory. Slows the run down considerably.",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        default=Path.cwd() / "mj-profiles",
+        help="Directory for the results of --profile and --trace-memory.",
+    )
     parser.add_argument(
         "--log-level",
         type=str,
@@ -170,39 +743,117 @@ def main():
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
     )
 
+    started = time.time()
+    if args.metrics_out is not None:
+        METRICS.enable()
+
     archive_root_path = args.archive_root.resolve()
     if not archive_root_path.is_dir():
         _log.error(f"Archive root directory not found or is not a directory: {archive_root_path}")
         return 1
 
-    job_types_str = args.job_types_to_download.lower()
-    if job_types_str == "" or job_types_str == "all":
-        job_types_set = set() # Empty set means download all
-        _log.info("Will download images for all job types with image_paths.")
-    else:
-        job_types_set = {jt.strip() for jt in job_types_str.split(',') if jt.strip()}
-        _log.info(f"Will download images for job types: {job_types_set}")
+    job_types_set = parse_job_types(args.job_types_to_download)
 
+    if args.workers < 1:
+        _log.error(f"--workers must be at least 1, got {args.workers}")
+        return 1
+    if args.max_attempts < 0:
+        _log.error(f"--max-attempts must not be negative, got {args.max_attempts}")
+        return 1
+    try:
+        type_weights = parse_type_weights(args.type_weights)
+    except ValueError as e:
+        _log.error(f"Invalid --type-weights: {e}")
+        return 1
+    bandwidth_schedule = None
+    try:
+        if args.bandwidth_schedule:
+            bandwidth_schedule = RateSchedule(args.bandwidth_schedule, args.max_bytes_per_second)
+    except ValueError as e:
+        _log.error(f"Invalid --bandwidth-schedule: {e}")
+        return 1
+
+    try:
+        derivative_sizes = parse_sizes(args.derivative_sizes)
+    except ValueError as e:
+        _log.error(f"Invalid --derivative-sizes: {e}")
+        return 1
 
-    downloader = MidjourneyDownloader(job_types_to_download=job_types_set)
+    manifest = ArchiveManifest(archive_root_path)
+    store = ContentStore(archive_root_path, manifest) if args.dedupe_store else None
+    derivatives = None
+    if derivative_sizes:
+        try:
+            derivatives = DerivativeGenerator(
+                manifest,
+                derivative_sizes,
+                image_format=args.derivative_format,
+                quality=args.derivative_quality,
+                workers=args.derivative_workers or None,
+            )
+        except ImportError as e:
+            _log.error(str(e))
+            manifest.close()
+            return 1
+    downloader = MidjourneyDownloader(
+        job_types_to_download=job_types_set,
+        workers=args.workers,
+        manifest=manifest,
+        store=store,
+        chunk_size=args.chunk_size,
+        max_retries=args.max_retries,
+        derivatives=derivatives,
+        bandwidth_budget=(
+            TokenBucket("bandwidth", args.max_bytes_per_second, schedule=bandwidth_schedule)
+            if args.max_bytes_per_second or bandwidth_schedule
+            else None
+        ),
+    )
+    profiler = None
+    if args.profile or args.trace_memory:
+        profiler = RunProfiler(args.profile_dir, "downloader", profile=args.profile, trace_memory=args.trace_memory)
+        profiler.instrument(downloader, "download_from_metadata_file", "download_from_shard", "download_url")
+        profiler.start()
     exit_code = 0
     try:
-        downloader.walk_archive(archive_root=archive_root_path)
+        if args.rescan:
+            downloader.walk_archive(
+                archive_root=archive_root_path, since=args.since, until=args.until, newest_first=args.order == "newest"
+            )
+        else:
+            if manifest.is_empty():
+                # Archived before the manifest existed: queue its images once
+                manifest.rebuild()
+            downloader.download_queue(
+                since=args.since,
+                until=args.until,
+                max_attempts=args.max_attempts or None,
+                order=args.order,
+                type_weights=type_weights,
+            )
     except KeyboardInterrupt:
         _log.info("Caught KeyboardInterrupt. Exiting.")
+    except ImportError as e: # A compressed shard needs a codec that is not installed
+        _log.error(str(e))
+        exit_code = 1
     except Exception as e:
         _log.error(f"An unexpected error occurred during archive walk: {e}", exc_info=True)
         exit_code = 1
     finally:
+        downloader.close()
+        if derivatives is not None:
+            derivatives.close()
+            downloader.stats.update(derivatives.stats)
+        manifest.close()
+        if profiler is not None:
+            profiler.stop()
         _log.info(f"Download process finished. Stats: {downloader.stats}")
-        if downloader.stats.get("error_http",0) > 0 or \
-           downloader.stats.get("error_connection",0) > 0 or \
-           downloader.stats.get("error_timeout",0) > 0 or \
-           downloader.stats.get("error_io_write",0) > 0 or \
-           downloader.stats.get("error_unexpected_download",0) > 0 or \
-           downloader.stats.get("error_json_decode",0) > 0 or \
-           downloader.stats.get("error_file_read",0) > 0:
+        if store is not None:
+            _log.info(f"Deduplication saved {downloader.stats['bytes_saved_dedupe']} bytes in this run.")
+        if downloader.has_errors():
             exit_code = 1 # Indicate error if any download or file processing errors occurred
+        if args.metrics_out is not None:
+            write_metrics(args.metrics_out, "downloader", downloader.stats, started, exit_code)
 
     return exit_code
 
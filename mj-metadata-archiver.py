@@ -12,15 +12,56 @@ import itertools
 import json
 import logging
 import os
+import queue
+import signal
 import textwrap
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Callable
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from mj_accounts import load_accounts
+from mj_archive import enqueue_sort_key, import_script, parse_enqueue_time
+from mj_cache import ResponseCache
+from mj_codecs import COMPRESSIONS
+from mj_manifest import ArchiveManifest, KnownJobIds
+from mj_metrics import METRICS, write_metrics
+from mj_profiling import RunProfiler
+from mj_ratelimit import AdaptiveLimiter, RateSchedule, SharedTransport, TokenBucket, parse_byte_rate, request_with_retries
+from mj_storage import STORAGE_LAYOUTS, MetadataWriteError, create_storage
 
 _log = logging.getLogger(__name__)
 
+API_BASE_URL = "https://www.midjourney.com"
+
+# The API lists at most about this many jobs for one fromDate, however many pages are requested
+LISTING_CAP = 2500
+# Jobs per listing page; a shorter page is the end of the listing
+LISTING_PAGE_SIZE = 50
+# A capped window is only split while its halves would still span at least this much
+MIN_WINDOW_SPAN = dt.timedelta(seconds=1)
+
+# One fromDate window of a partitioned crawl: the jobs enqueued after `start` and up to
+# and including `end`. `fetched` counts the jobs listed so far, `oldest` is the oldest of them.
+CrawlWindow = collections.namedtuple("CrawlWindow", ["start", "end", "next_page", "fetched", "oldest"])
+
 
 class MidjourneyMetadataArchiver:
+    # Stats keys that make the archiving process exit with an error code
+    ERROR_STATS = (
+        "error_parsing_enqueue_time",
+        "error_creating_directory",
+        "error_writing_json",
+        "error_writing_prompt",
+        "error_writing_shard",
+        "error_api_request",
+        "error_window_incomplete",
+    )
+
     _text_wrapper = textwrap.TextWrapper(
         width=80,
         initial_indent=" " * 4,
@@ -29,24 +70,118 @@ class MidjourneyMetadataArchiver:
         break_on_hyphens=False,
     )
 
-    def __init__(self, archive_root: Path, user_id: str, session_token: str, json_indent: int = 2):
+    def __init__(
+        self,
+        archive_root: Path,
+        user_id: str,
+        session_token: str,
+        json_indent: int = 2,
+        manifest: ArchiveManifest | None = None,
+        prefetch_pages: int = 1,
+        storage_layout: str = "files",
+        compression: str = "none",
+        api_base_url: str = API_BASE_URL,
+        max_retries: int = 5,
+        transport: SharedTransport | None = None,
+        account: str | None = None,
+        response_cache: ResponseCache | None = None,
+        replay: bool = False,
+    ):
         self.archive_root = archive_root
+        self.api_base_url = api_base_url.rstrip("/")
         self.user_id = user_id
         self.session_token = session_token
         self.json_indent = json_indent if json_indent > 0 else None # json.dump indent must be non-negative or None
         self.stats = collections.Counter()
+        self.manifest = manifest if manifest is not None else ArchiveManifest(archive_root)
+        self.storage = create_storage(
+            storage_layout, self.manifest, self.json_indent, self.render_prompt_text, compression
+        )
+        # Called with (job_info, json_path) for every job whose metadata is in the archive
+        # once its page is stored, e.g. to hand it to a downloader while the crawl continues
+        self.on_job_archived: Callable[[dict, Path], None] | None = None
+        self._page_jobs: list[tuple[dict, Path]] = [] # Archived jobs of the page, until it is stored
+        # Ids of the archived jobs, loaded by crawls that stop at already archived pages
+        self.known_job_ids: KnownJobIds | None = None
+        # Set (e.g. on SIGTERM) to end crawls and watch() after the page being archived
+        self.stop_requested = threading.Event()
+        # Number of listing pages requested ahead in the background while a page is written to disk
+        self.prefetch_pages = max(0, prefetch_pages)
+        # With a transport shared by several accounts, its session, API limiter and budgets are used,
+        # and `account` identifies this archiver's requests for the fair scheduling between accounts
+        self.transport = transport
+        self.account = account
+        if transport is not None:
+            self.session = transport.session
+            self.limiter = transport.api_limiter
+        else:
+            # One keep-alive session for all API requests, with room for the prefetching threads
+            self.session = requests.Session()
+            self._set_api_concurrency(self.prefetch_pages + 1)
+        self.max_retries = max_retries
+        # Listing pages on disk: revalidated and reused, or with `replay` the only source of pages
+        self.response_cache = response_cache
+        self.replay = replay
+        if replay and response_cache is None:
+            raise ValueError("Replaying listing pages needs a response cache")
+
+    def _set_api_concurrency(self, concurrency: int):
+        """
+        Size the connection pool and the limiter for `concurrency` API requests in flight.
+        A shared transport keeps its own limit for the API requests of all accounts.
+        """
+        if self.transport is not None:
+            return
+        adapter = HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter) # For a local stand-in of the API, see mj-benchmark.py
+        # Backs off when the API throttles or fails, instead of ending the crawl early
+        self.limiter = AdaptiveLimiter("API", max_concurrency=concurrency)
+
+    def _collect_request_stats(self):
+        if self.transport is None: # A shared limiter's stats are reported for all accounts together
+            self.stats.update(self.limiter.stats) # Retries and throttling of this crawl
+            self.limiter.stats.clear()
+        if self.response_cache is not None:
+            self.stats.update(self.response_cache.stats) # Hits, revalidations and replayed pages
+            self.response_cache.stats.clear()
+
+    def has_errors(self) -> bool:
+        return any(self.stats.get(key, 0) > 0 for key in self.ERROR_STATS)
+
+    def close(self):
+        if self.transport is None:
+            self.session.close()
+        self.manifest.close()
+
+    @classmethod
+    def render_prompt_text(cls, job_info: dict) -> str:
+        """
+        Content of the prompt text file of a job.
+        """
+        # Use .get() for prompt and full_command in case they are missing from job_info
+        return (
+            "Prompt:\n"
+            + cls._text_wrapper.fill(job_info.get("prompt", "[No Prompt Available]")) + "\n"
+            + "\nFull command:\n"
+            + cls._text_wrapper.fill(job_info.get("full_command", "[No Full Command Available]")) + "\n"
+        )
 
     def request_recent_jobs(
         self,
         job_type: str | None = "upscale",
         from_date: dt.datetime | None = None,
         page: int | None = None,
-        amount: int = 50,
+        amount: int = LISTING_PAGE_SIZE,
     ) -> list[dict]:
         """
-        Do `recent-jobs` request to midjourney API
+        Do `recent-jobs` request to midjourney API. Throttled and failed requests are
+        retried; if the listing still can't be fetched, the `RequestException` is raised
+        so that an error is never mistaken for the end of the listing (`[]`).
+        With a response cache, fresh cached pages are used without a request and older
+        ones are revalidated; when replaying, a page missing from the cache ends the listing.
         """
-        url = "https://www.midjourney.com/api/app/recent-jobs/"
+        url = f"{self.api_base_url}/api/app/recent-jobs/"
         params = {
             "amount": amount,
             "orderBy": "new",
@@ -62,28 +197,69 @@ class MidjourneyMetadataArchiver:
         if page:
             params["page"] = str(page) # Changed to string
 
+        cached = None
+        if self.response_cache is not None:
+            cached = self.response_cache.get(url, params)
+            if self.replay:
+                if cached is None:
+                    _log.info(f"No cached page for params {params}: end of the replayed listing.")
+                    self.response_cache.count("cache_replay_missing")
+                    return []
+                _log.info(f"Replaying cached recent jobs for params: {params}")
+                self.response_cache.count("cache_replayed")
+                return self._decode_job_listing(cached.body, cached.content_type)
+            if cached is not None and self.response_cache.is_fresh(cached):
+                _log.info(f"Using cached recent jobs for params: {params}")
+                self.response_cache.count("cache_hits")
+                return self._decode_job_listing(cached.body, cached.content_type)
+
         headers = {
             "Cookie": f"__Secure-next-auth.session-token={self.session_token}",
         }
+        if cached is not None:
+            headers.update(self.response_cache.conditional_headers(cached))
 
         _log.info(f"Requesting recent jobs: {url} with params: {params}")
-        try:
-            resp = requests.get(url=url, params=params, headers=headers)
-            resp.raise_for_status() # Raises HTTPError for bad responses (4XX or 5XX)
-        except requests.exceptions.RequestException as e:
-            _log.error(f"API request failed: {e}")
-            return [] # Return empty list on failure
-
-        if not resp.headers["Content-Type"].startswith("application/json"):
-            _log.error(f"Unexpected Content-Type: {resp.headers['Content-Type']}")
-            return []
+        budget = self.transport.request_budget if self.transport is not None else None
+        with self.limiter.slot(self.account):
+            resp = request_with_retries(
+                self.session, url, self.limiter, self.max_retries,
+                budget=budget, client=self.account, params=params, headers=headers, timeout=60,
+            )
+        if self.transport is not None and self.transport.bandwidth_budget is not None:
+            self.transport.bandwidth_budget.take(len(resp.content), self.account)
+        if resp.status_code == 304 and cached is not None:
+            _log.info("Cached page is still current (HTTP 304).")
+            self.response_cache.count("cache_revalidated")
+            self.response_cache.refresh(url, params, cached)
+            return self._decode_job_listing(cached.body, cached.content_type)
+        resp.raise_for_status() # Raises HTTPError for bad responses (4XX or 5XX)
+        METRICS.count("mj_transferred_bytes_total", len(resp.content), endpoint=self.limiter.name)
+
+        content_type = resp.headers.get("Content-Type", "")
+        job_listing = self._decode_job_listing(resp.text, content_type, resp)
+        if self.response_cache is not None:
+            self.response_cache.put(
+                url, params, resp.text, content_type, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+            )
+        return job_listing
+
+    def _decode_job_listing(
+        self, body: str, content_type: str, resp: requests.Response | None = None
+    ) -> list[dict]:
+        """
+        Decode a `recent-jobs` response body, fetched or cached. Unexpected content
+        raises `RequestException`; a listing in an unknown format is logged and ends it (`[]`).
+        """
+        if not content_type.startswith("application/json"):
+            raise requests.exceptions.RequestException(f"Unexpected Content-Type: {content_type}", response=resp)
 
         try:
-            job_listing = resp.json()
+            with METRICS.time_phase("json_decode"):
+                job_listing = json.loads(body)
         except json.JSONDecodeError as e:
-            _log.error(f"Failed to decode JSON response: {e}")
-            _log.debug(f"Response text: {resp.text}")
-            return []
+            _log.debug(f"Response text: {body}")
+            raise requests.exceptions.RequestException(f"Failed to decode JSON response: {e}", response=resp) from e
 
         if isinstance(job_listing, list):
             if not job_listing: # Empty list is a valid response (no jobs found)
@@ -100,39 +276,17 @@ class MidjourneyMetadataArchiver:
         return []
 
 
-    def get_latest_enqueue_time_from_archive(self) -> Optional[str]:
+    def get_latest_enqueue_time_from_archive(self) -> str | None:
         """
-        Finds the latest enqueue_time from existing JSON files in the archive.
-        Returns None if no files are found or if times cannot be parsed.
+        Finds the latest enqueue_time of the jobs in the archive manifest.
+        An empty manifest is first rebuilt from the JSON files in the archive,
+        so archives created before the manifest existed are picked up once.
+        Returns None if the archive contains no jobs.
         """
-        latest_time_obj = None
-        latest_time_str = None
-
-        for json_file in self.archive_root.glob("**/*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                enqueue_time_str = data.get("enqueue_time")
-                if enqueue_time_str:
-                    # Standard format: "2023-10-26 18:19:40.038313"
-                    # Sometimes it might be without microseconds: "2023-10-26 18:19:40"
-                    try:
-                        current_time_obj = dt.datetime.strptime(enqueue_time_str, "%Y-%m-%d %H:%M:%S.%f")
-                    except ValueError:
-                        try:
-                            current_time_obj = dt.datetime.strptime(enqueue_time_str, "%Y-%m-%d %H:%M:%S")
-                        except ValueError:
-                            _log.warning(f"Could not parse enqueue_time '{enqueue_time_str}' from {json_file}")
-                            continue
-
-                    if latest_time_obj is None or current_time_obj > latest_time_obj:
-                        latest_time_obj = current_time_obj
-                        latest_time_str = enqueue_time_str
-            except json.JSONDecodeError:
-                _log.warning(f"Could not decode JSON from {json_file}")
-            except Exception as e:
-                _log.warning(f"Error processing file {json_file}: {e}")
+        if self.manifest.is_empty():
+            self.manifest.rebuild()
 
+        latest_time_str = self.manifest.latest_enqueue_time()
         if latest_time_str:
             _log.info(f"Latest enqueue_time found in archive: {latest_time_str}")
         else:
@@ -141,12 +295,18 @@ class MidjourneyMetadataArchiver:
 
     def crawl(
         self,
-        limit: int | None = None,
+        page_limit: int | None = None,
         job_type: str | None = "upscale",
         from_date: str | None = None,
+        get_from_date_from_archive: bool = False,
+        overwrite_metadata: bool = False,
+        stop_after_known_pages: int = 0,
+        prefetch_pages: int | None = None,
     ):
         """
-        Crawl the Midjourney API to collect job metadata
+        Crawl the Midjourney API to collect job metadata. With `stop_after_known_pages`,
+        the crawl ends after that many consecutive pages of only already archived jobs.
+        `prefetch_pages` overrides the archiver's number of pages requested ahead.
         """
         if get_from_date_from_archive and from_date is None:
             # Only get from archive if from_date is not explicitly set.
@@ -156,46 +316,302 @@ class MidjourneyMetadataArchiver:
                 from_date = archived_from_date
                 _log.info(f"Using from_date from archive: {from_date}")
 
-        # TODO: there seems to be a hard limit of 2500 items in total job listing (document this)
+        if stop_after_known_pages and self.known_job_ids is None:
+            self._load_known_job_ids()
+        known_pages = 0 # Consecutive pages without a new job
+
+        # The listing ends after about LISTING_CAP jobs; crawl_partitioned() gets past that for backfills
         pages = range(1, page_limit + 1) if page_limit else itertools.count(1)
         initial_from_date = from_date # Store the initial from_date for consistent paging
 
-        for page in pages:
-            _log.info(f"Crawling for job info batch page={page}")
-            job_listing = self.request_recent_jobs(
-                from_date=initial_from_date, page=page, job_type=job_type
+        # Pages requested ahead of time, by page number. They are consumed strictly in order,
+        # so the archive is written exactly as in a sequential crawl.
+        prefetched: dict[int, Future] = {}
+        if prefetch_pages is None:
+            prefetch_pages = self.prefetch_pages
+        executor = None
+        if prefetch_pages:
+            executor = ThreadPoolExecutor(max_workers=prefetch_pages, thread_name_prefix="mj-prefetch")
+
+        try:
+            for page in pages:
+                if self.stop_requested.is_set():
+                    _log.info("Stop requested: ending the crawl.")
+                    break
+                _log.info(f"Crawling for job info batch page={page}")
+                future = prefetched.pop(page, None)
+                if future is not None:
+                    job_listing = future.result()
+                else:
+                    job_listing = self.request_recent_jobs(
+                        from_date=initial_from_date, page=page, job_type=job_type
+                    )
+                if not job_listing:
+                    _log.info("Empty job listing batch: reached end of total job listing.")
+                    break
+
+                # Get "enqueue_time" of the *first* job in the *first ever* batch for consistent paging in subsequent requests.
+                # The API uses the fromDate of the *first job on the first page* as a reference for subsequent pages.
+                if initial_from_date is None and job_listing:
+                    initial_from_date = job_listing[0]["enqueue_time"]
+                    _log.info(f"Set initial_from_date for paging: {initial_from_date}")
+
+                # Paging parameters are known now: fetch the next pages while this one is written to disk
+                if executor is not None:
+                    for next_page in range(page + 1, page + 1 + prefetch_pages):
+                        if page_limit and next_page > page_limit:
+                            break
+                        if next_page not in prefetched:
+                            prefetched[next_page] = executor.submit(
+                                self.request_recent_jobs,
+                                from_date=initial_from_date, page=next_page, job_type=job_type,
+                            )
+
+                skipped_before = self.stats["skipped_existing"]
+                self.archive_job_listing(job_listing, overwrite_metadata)
+                if stop_after_known_pages:
+                    if self.stats["skipped_existing"] - skipped_before == len(job_listing):
+                        known_pages += 1
+                    else:
+                        known_pages = 0
+                    if known_pages >= stop_after_known_pages:
+                        _log.info(f"Stopping: the last {known_pages} pages held only jobs that were already archived.")
+                        break
+        finally:
+            if executor is not None:
+                for future in prefetched.values():
+                    future.cancel()
+                executor.shutdown(wait=True)
+            self._collect_request_stats()
+
+    def _load_known_job_ids(self):
+        if self.manifest.is_empty():
+            self.manifest.rebuild()
+        self.known_job_ids = self.manifest.load_known_job_ids()
+        _log.info(f"Loaded the ids of {self.manifest.job_count()} archived jobs")
+
+    def watch(self, job_type: str | None = "upscale", min_interval: float = 15.0, max_interval: float = 300.0):
+        """
+        Poll the newest jobs until `stop_requested` is set. Every poll crawls from the
+        newest job until a page holds only archived jobs, on the same keep-alive session
+        and against the ids of the archived jobs kept in memory. The interval drops to
+        `min_interval` after a poll that archived new jobs and doubles after every idle
+        or failed poll, up to `max_interval`.
+        """
+        if self.known_job_ids is None:
+            self._load_known_job_ids()
+        interval = min_interval
+        _log.info(f"Watching for new jobs every {min_interval:g} to {max_interval:g} seconds")
+        while not self.stop_requested.is_set():
+            archived_before = self.stats["archived_newly"]
+            self.stats["watch_polls"] += 1
+            try:
+                # Without prefetching, an idle poll is a single request
+                self.crawl(job_type=job_type, stop_after_known_pages=1, prefetch_pages=0)
+            except requests.exceptions.RequestException as e:
+                if e.response is not None and e.response.status_code in (401, 403):
+                    raise # Invalid or expired credentials: polling again won't help
+                _log.warning(f"Polling for new jobs failed: {e}")
+                self.stats["watch_poll_errors"] += 1
+            new_jobs = self.stats["archived_newly"] - archived_before
+            if new_jobs > 0:
+                _log.info(f"Archived {new_jobs} new jobs")
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+            _log.debug(f"Next poll in {interval:g} seconds")
+            self.stop_requested.wait(interval)
+        _log.info("Stopped watching for new jobs.")
+
+    def crawl_partitioned(
+        self,
+        since: dt.date,
+        until: dt.date,
+        job_type: str | None = "upscale",
+        window_days: int = 30,
+        workers: int = 4,
+        overwrite_metadata: bool = False,
+        listing_cap: int = LISTING_CAP,
+    ):
+        """
+        Crawl the jobs enqueued from `since` through `until` as separate `fromDate`
+        windows, `workers` of them concurrently. A window whose listing ends before the
+        window's start, or reaches `listing_cap` jobs (0 for none), is split into two
+        windows covering the part it has not reached yet. Every page is checkpointed in the manifest:
+        the unfinished windows of an interrupted partitioned crawl of the same job
+        type are resumed instead of starting over.
+        """
+        checkpoint_key = job_type or "all"
+        windows = collections.deque(
+            CrawlWindow(
+                parse_enqueue_time(window_start),
+                parse_enqueue_time(window_end),
+                next_page,
+                fetched,
+                parse_enqueue_time(oldest) if oldest else None,
             )
-            if not job_listing:
-                _log.info("Empty job listing batch: reached end of total job listing or API error.")
-                break
-
-            new_jobs_archived_this_page = self.archive_job_listing(job_listing, overwrite_metadata)
-
-            # TODO: option to stop crawling if listing was already fully archived
-            # If overwrite_metadata is False and no new jobs were archived on this page,
-            # and we are using from_date from archive, it implies we might have caught up.
-            # However, new jobs could have been added *after* the from_date but before current time.
-            # A more robust "already fully archived" check would require knowing the *very latest* job ID from API,
-            # or if the API simply returns no new jobs for a from_date that was the newest in our archive.
-            # For now, if overwrite is false and nothing new saved, and we are using archive date, we can stop.
-            if not overwrite_metadata and new_jobs_archived_this_page == 0 and get_from_date_from_archive:
-                 _log.info("No new jobs archived on this page and using from_date from archive. Assuming up to date.")
-                 # break # Be cautious with this break, it might be too aggressive if jobs were added between archive time and now.
-                         # The API returning an empty list is the more reliable stop condition.
-
-            # Get "enqueue_time" of the *first* job in the *first ever* batch for consistent paging in subsequent requests.
-            # The API uses the fromDate of the *first job on the first page* as a reference for subsequent pages.
-            if initial_from_date is None and job_listing:
-                initial_from_date = job_listing[0]["enqueue_time"]
-                _log.info(f"Set initial_from_date for paging: {initial_from_date}")
-
-    def archive_job_listing(self, job_listing: list[dict]):
+            for window_start, window_end, next_page, fetched, oldest in self.manifest.crawl_windows(checkpoint_key)
+        )
+        if windows:
+            _log.info(f"Resuming {len(windows)} unfinished windows of an earlier partitioned crawl of '{checkpoint_key}' jobs")
+        else:
+            range_start = dt.datetime.combine(since, dt.time()) - dt.timedelta(microseconds=1)
+            window_end = dt.datetime.combine(until + dt.timedelta(days=1), dt.time()) - dt.timedelta(microseconds=1)
+            while window_end > range_start:
+                window_start = max(range_start, window_end - dt.timedelta(days=window_days))
+                windows.append(CrawlWindow(window_start, window_end, 1, 0, None))
+                self._checkpoint_window(checkpoint_key, windows[-1])
+                window_end = window_start
+            self.manifest.commit()
+            _log.info(f"Crawling {since} to {until} in {len(windows)} windows of {window_days} days")
+
+        self._set_api_concurrency(workers)
+        # Pages are fetched concurrently, but archived one at a time on this thread
+        in_flight: dict[Future, CrawlWindow] = {}
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mj-window")
+        try:
+            while in_flight or (windows and not self.stop_requested.is_set()):
+                while windows and len(in_flight) < workers and not self.stop_requested.is_set():
+                    window = windows.popleft()
+                    _log.info(f"Crawling window {window.start} - {window.end} page={window.next_page}")
+                    future = executor.submit(
+                        self.request_recent_jobs,
+                        job_type=job_type, from_date=enqueue_sort_key(window.end), page=window.next_page,
+                    )
+                    in_flight[future] = window
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window = in_flight.pop(future)
+                    next_windows = self._archive_window_page(
+                        checkpoint_key, window, future.result(), overwrite_metadata, listing_cap
+                    )
+                    # Finish started windows first, so few of them are left half done
+                    windows.extendleft(reversed(next_windows))
+            if windows:
+                _log.info(f"Stop requested: {len(windows)} windows are left for the next run to resume.")
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.manifest.commit()
+            self._collect_request_stats()
+
+    def _checkpoint_window(self, checkpoint_key: str, window: CrawlWindow):
+        self.manifest.save_crawl_window(
+            checkpoint_key,
+            enqueue_sort_key(window.start),
+            enqueue_sort_key(window.end),
+            window.next_page,
+            window.fetched,
+            enqueue_sort_key(window.oldest) if window.oldest else None,
+        )
+
+    def _archive_window_page(
+        self,
+        checkpoint_key: str,
+        window: CrawlWindow,
+        job_listing: list[dict],
+        overwrite_metadata: bool,
+        listing_cap: int,
+    ) -> list[CrawlWindow]:
+        """
+        Archive one listing page of a window and checkpoint the window. Returns the
+        windows to crawl next: the window with its next page, the two halves of what
+        is left of it after it hit the listing cap, or none once it is complete.
+
+        The cap is detected by count (`listing_cap`) and, whatever its value, by the
+        listing ending before the window's start: the rest of the window is crawled
+        with a new `fromDate`. A window that reached the cap with all its jobs at the
+        window's end can't be split; it is counted as incomplete, as jobs of that
+        instant may be missing, and only the part before that instant is crawled.
+        """
+        jobs_in_window = []
+        for job_info in job_listing:
+            enqueue_time_dt = parse_enqueue_time(job_info.get("enqueue_time"))
+            if enqueue_time_dt is not None and enqueue_time_dt <= window.start:
+                break # The listing is newest first: the rest belongs to older windows
+            jobs_in_window.append(job_info)
+        self.archive_job_listing(jobs_in_window, overwrite_metadata)
+
+        fetched = window.fetched + len(job_listing)
+        oldest = window.oldest
+        if jobs_in_window:
+            oldest = parse_enqueue_time(jobs_in_window[-1].get("enqueue_time")) or oldest
+        window_key = (checkpoint_key, enqueue_sort_key(window.start), enqueue_sort_key(window.end))
+
+        if len(jobs_in_window) < len(job_listing) or not fetched:
+            # Reached the start of the window, or the window holds no jobs at all
+            self.manifest.remove_crawl_window(*window_key)
+            self.manifest.commit()
+            self.stats["windows_completed"] += 1
+            return []
+
+        next_windows = [window._replace(next_page=window.next_page + 1, fetched=fetched, oldest=oldest)]
+        # A listing that ends before the window's start was capped, whatever the count
+        if len(job_listing) < LISTING_PAGE_SIZE or (listing_cap and fetched >= listing_cap):
+            if oldest is None:
+                _log.error(f"Window {window.start} - {window.end} ended without enqueue times, giving it up as incomplete.")
+                self.stats["error_window_incomplete"] += 1
+                next_windows = []
+            elif oldest >= window.end:
+                if listing_cap and fetched >= listing_cap:
+                    _log.error(
+                        f"Window {window.start} - {window.end} hit the listing cap with all jobs at {oldest} and cannot "
+                        f"be split: further jobs of that instant may be missing."
+                    )
+                    self.stats["error_window_incomplete"] += 1
+                # Stop paging this window and crawl what is left before that instant
+                next_windows = [CrawlWindow(window.start, oldest - dt.timedelta(microseconds=1), 1, 0, None)]
+                if next_windows[0].end <= window.start:
+                    next_windows = []
+            elif oldest - window.start >= 2 * MIN_WINDOW_SPAN:
+                middle = window.start + (oldest - window.start) / 2
+                _log.info(f"Window {window.start} - {window.end} hit the listing cap at {oldest}, splitting the rest at {middle}")
+                next_windows = [CrawlWindow(middle, oldest, 1, 0, None), CrawlWindow(window.start, middle, 1, 0, None)]
+                self.stats["windows_split"] += 1
+            else:
+                _log.info(f"Window {window.start} - {window.end} hit the listing cap at {oldest}, crawling the rest")
+                next_windows = [CrawlWindow(window.start, oldest, 1, 0, None)]
+                self.stats["windows_split"] += 1
+        self.manifest.remove_crawl_window(*window_key)
+        for next_window in next_windows:
+            self._checkpoint_window(checkpoint_key, next_window)
+        self.manifest.commit()
+        return next_windows
+
+    def archive_job_listing(self, job_listing: list[dict], overwrite_metadata: bool = False) -> int:
+        archived_count = 0
         for job_info in job_listing:
             if self.archive_job_info(job_info, overwrite_metadata):
                 archived_count += 1
+        # Packed storage writes the whole page at once
+        failed_job_ids = self.storage.flush()
+        if failed_job_ids:
+            self.manifest.forget_jobs(failed_job_ids)
+            self.stats["error_writing_shard"] += len(failed_job_ids)
+            self.stats["archived_newly"] -= len(failed_job_ids)
+            archived_count -= len(failed_job_ids)
+        with METRICS.time_phase("manifest_commit"):
+            self.manifest.commit() # Persist the manifest once per page
+        # Only jobs whose metadata was stored go on, e.g. to the downloads
+        page_jobs, self._page_jobs = self._page_jobs, []
+        if self.on_job_archived is not None:
+            failed = set(failed_job_ids)
+            for job_info, json_path in page_jobs:
+                if job_info["id"] not in failed:
+                    self.on_job_archived(job_info, json_path)
         return archived_count
 
-    def archive_job_info(self, job_info: dict, overwrite_metadata: bool) -> bool:
+    def _is_archived(self, job_id: str) -> bool:
+        if self.known_job_ids is not None:
+            return job_id in self.known_job_ids
+        return self.manifest.has_job(job_id)
+
+    def _job_archived(self, job_info: dict, json_path: Path):
+        if self.on_job_archived is not None:
+            self._page_jobs.append((job_info, json_path))
+
+    def archive_job_info(self, job_info: dict, overwrite_metadata: bool = False) -> bool:
         job_id = job_info["id"]
         enqueue_time = job_info["enqueue_time"]
         _log.info(f"Archiving metadata of job {job_id} ({enqueue_time=})")
@@ -217,39 +633,39 @@ class MidjourneyMetadataArchiver:
 
         job_dir = self.archive_root / enqueue_time_dt.strftime("%Y/%Y-%m/%Y-%m-%d")
         try:
-            job_dir.mkdir(parents=True, exist_ok=True)
+            with METRICS.time_phase("mkdir"):
+                job_dir.mkdir(parents=True, exist_ok=True)
         except OSError as e:
             _log.error(f"Could not create directory {job_dir}: {e}. Skipping archiving of job {job_id}.")
             self.stats["error_creating_directory"] += 1
             return False
 
         filename_base = f"{enqueue_time_dt.strftime('%Y%m%d-%H%M%S')}_{job_id}"
-        json_path = job_dir / f"{filename_base}.json"
-        prompt_path = job_dir / f"{filename_base}.prompt.txt"
+        json_path, prompt_path = self.storage.paths(job_dir, filename_base)
 
-        if not overwrite_metadata and json_path.exists() and prompt_path.exists():
-            _log.debug(f"Skipping job {job_id}, metadata files already exist and overwrite_metadata is False.")
-            self.stats["skipped_existing"] += 1
-            return False # Indicates that the job was not newly archived, but existed
+        if not overwrite_metadata:
+            if self._is_archived(job_id):
+                _log.debug(f"Skipping job {job_id}, already in archive manifest and overwrite_metadata is False.")
+                self.stats["skipped_existing"] += 1
+                self._job_archived(job_info, json_path)
+                return False # Indicates that the job was not newly archived, but existed
+            # With known_job_ids the manifest was rebuilt if needed and has every archived job
+            if self.known_job_ids is None and self.storage.has_files(job_dir, filename_base):
+                # Archived before the manifest existed: index it now
+                _log.debug(f"Skipping job {job_id}, metadata files already exist and overwrite_metadata is False.")
+                self.manifest.record_job(job_info, json_path, prompt_path)
+                self.stats["skipped_existing"] += 1
+                self._job_archived(job_info, json_path)
+                return False
 
-        # Store raw metadata as JSON file
+        # Store raw metadata as JSON and prompt info as text (or buffer both for the page's packed shard write)
         try:
-            with json_path.open("w", encoding="utf-8") as f:
-                json.dump(job_info, f, indent=self.json_indent)
-        except IOError as e:
-            _log.error(f"Error writing JSON file {json_path}: {e}")
-            self.stats["error_writing_json"] += 1
-            return False # Failed to archive
-
-        # Store prompt info as text file
-        try:
-            with prompt_path.open("w", encoding="utf-8") as f:
-                f.write("Prompt:\n")
-                # Use .get() for prompt and full_command in case they are missing from job_info
-                f.write(self._text_wrapper.fill(job_info.get("prompt", "[No Prompt Available]")) + "\n")
-                f.write("\nFull command:\n")
-                f.write(self._text_wrapper.fill(job_info.get("full_command", "[No Full Command Available]")) + "\n")
-        except IOError as e:
+            self.storage.store(job_info, job_dir, filename_base)
+        except MetadataWriteError as e:
+            if e.kind == "json":
+                _log.error(f"Error writing JSON file {json_path}: {e}")
+                self.stats["error_writing_json"] += 1
+                return False # Failed to archive
             _log.error(f"Error writing prompt file {prompt_path}: {e}")
             self.stats["error_writing_prompt"] += 1
             # If JSON was written but prompt failed, we count it as partially archived.
@@ -258,10 +674,253 @@ class MidjourneyMetadataArchiver:
                  self.stats["archived_json_only_prompt_failed"] +=1
             return False
 
+        self.manifest.record_job(job_info, json_path, prompt_path if self.storage.layout == "files" else None)
+        if self.known_job_ids is not None:
+            self.known_job_ids.add(job_id)
         self.stats["archived_newly"] +=1
+        self._job_archived(job_info, json_path)
         return True # Indicates that the job was newly and successfully archived
 
 
+class DownloadPipeline:
+    """
+    Downloads the images of the jobs an archiver archives while the crawl goes on
+    (`--download`): archived jobs go through a bounded queue to a downloader on a
+    background thread, so the crawl pauses when downloads fall behind.
+    `bandwidth_budget` caps the downloads of an archiver without a shared transport.
+    """
+
+    def __init__(
+        self, archiver: MidjourneyMetadataArchiver, args: argparse.Namespace, bandwidth_budget: TokenBucket | None = None
+    ):
+        downloader_script = import_script("mj-downloader.py")
+        self.archiver = archiver
+        self.downloader = downloader_script.MidjourneyDownloader(
+            job_types_to_download=downloader_script.parse_job_types(args.download_job_types),
+            workers=args.download_workers,
+            manifest=archiver.manifest,
+            max_retries=args.max_retries,
+            transport=archiver.transport,
+            account=archiver.account,
+            bandwidth_budget=bandwidth_budget,
+        )
+        self.job_queue = queue.Queue(maxsize=max(1, args.download_queue_size))
+        self.stop_downloads = threading.Event()
+        thread_name = f"mj-download-pipeline-{archiver.account}" if archiver.account else "mj-download-pipeline"
+        self._thread = threading.Thread(
+            target=self.downloader.download_jobs_from_queue,
+            args=(self.job_queue, self.stop_downloads),
+            name=thread_name,
+        )
+
+    # Blocks when the queue is full, which pauses the crawl until downloads catch up
+    def _queue_for_download(self, job_info: dict, json_path: Path):
+        METRICS.observe_queue_depth("download_jobs", self.job_queue.qsize())
+        self.job_queue.put((job_info, json_path))
+
+    def start(self):
+        self.archiver.on_job_archived = self._queue_for_download
+        self._thread.start()
+
+    def finish(self):
+        """
+        Wait for the queued downloads. After a stop request, queued images are not
+        downloaded and stay pending in the manifest for the next run.
+        """
+        if self.archiver.stop_requested.is_set():
+            self.stop_downloads.set()
+        _log.info("Crawl finished, waiting for queued downloads to complete.")
+        self.job_queue.put(None)
+        self._thread.join()
+        self.downloader.close()
+
+
+def create_archiver(
+    args: argparse.Namespace,
+    archive_root: Path,
+    user_id: str,
+    session_token: str,
+    transport: SharedTransport | None = None,
+    account: str | None = None,
+) -> MidjourneyMetadataArchiver:
+    return MidjourneyMetadataArchiver(
+        archive_root=archive_root,
+        user_id=user_id,
+        session_token=session_token,
+        json_indent=args.json_indent,
+        prefetch_pages=args.prefetch_pages,
+        api_base_url=args.api_base_url,
+        max_retries=args.max_retries,
+        storage_layout=args.storage,
+        compression=args.compression,
+        transport=transport,
+        account=account,
+        response_cache=(
+            ResponseCache(archive_root, max_age=args.cache_max_age) if args.cache_responses or args.replay else None
+        ),
+        replay=args.replay,
+    )
+
+
+def run_archiver(metadata_archiver: MidjourneyMetadataArchiver, args: argparse.Namespace, job_type: str | None):
+    """
+    Run the crawl selected on the command line. API and unexpected errors are
+    logged and counted in the archiver's stats instead of being raised.
+    """
+    prefix = f"Account {metadata_archiver.account}: " if metadata_archiver.account else ""
+    try:
+        if args.watch:
+            metadata_archiver.watch(
+                job_type=job_type,
+                min_interval=args.min_poll_interval,
+                max_interval=args.max_poll_interval,
+            )
+        elif args.partitioned:
+            metadata_archiver.crawl_partitioned(
+                since=args.since,
+                until=args.until or dt.date.today(),
+                job_type=job_type,
+                window_days=args.window_days,
+                workers=args.partition_workers,
+                overwrite_metadata=args.overwrite_metadata,
+                listing_cap=args.listing_cap,
+            )
+        else:
+            metadata_archiver.crawl(
+                page_limit=args.page_limit,
+                job_type=job_type,
+                from_date=args.from_date,
+                get_from_date_from_archive=args.get_from_date_from_archive,
+                overwrite_metadata=args.overwrite_metadata,
+                stop_after_known_pages=args.stop_after_known_pages,
+            )
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None:
+            if e.response.status_code == 401:
+                _log.error(f"{prefix}HTTP 401 Unauthorized: API request failed. This often means your session token is invalid or expired.")
+            elif e.response.status_code == 403:
+                 _log.error(f"{prefix}HTTP 403 Forbidden: API request failed. Check your User ID and permissions. It's also possible the API structure changed or access was revoked.")
+            else:
+                _log.error(f"{prefix}HTTP Error during API request: {e.response.status_code} - {e.response.text}")
+        else:
+            _log.error(f"{prefix}HTTP Error during API request (no response object): {e}")
+        metadata_archiver.stats["error_api_request"] += 1
+    except requests.exceptions.RequestException as e:
+        _log.error(f"{prefix}A network error occurred during API request: {e}")
+        metadata_archiver.stats["error_api_request"] += 1
+    except Exception as e:
+        _log.error(f"{prefix}An unexpected error occurred: {e}", exc_info=True) # Log full traceback for truly unexpected errors
+
+
+def archive_accounts(
+    args: argparse.Namespace,
+    job_type: str | None,
+    archive_root: Path,
+    started: float,
+    bandwidth_schedule: RateSchedule | None = None,
+) -> int:
+    """
+    Multi-account mode (`--accounts`): crawl, and with `--download` download, every
+    account of the accounts file on its own thread, into its own archive root and
+    with its own stats. All accounts share one `SharedTransport`, which takes them
+    in turn for API requests, downloads and the request and bandwidth budgets.
+    """
+    try:
+        accounts = load_accounts(args.accounts, archive_root)
+        for account in accounts:
+            account.archive_root.mkdir(parents=True, exist_ok=True)
+    except (ValueError, OSError) as e:
+        _log.error(str(e))
+        return 1
+
+    transport = SharedTransport(
+        api_concurrency=args.api_concurrency,
+        download_concurrency=args.download_workers,
+        requests_per_second=args.max_requests_per_second or None,
+        bytes_per_second=args.max_bytes_per_second or None,
+        bandwidth_schedule=bandwidth_schedule,
+    )
+    archivers: list[MidjourneyMetadataArchiver] = []
+    pipelines: dict[str, DownloadPipeline] = {}
+    profiler = None
+    try:
+        for account in accounts:
+            archivers.append(create_archiver(
+                args, account.archive_root, account.user_id, account.session_token, transport, account.name
+            ))
+        if args.profile or args.trace_memory:
+            profiler = RunProfiler(args.profile_dir, "archiver", profile=args.profile, trace_memory=args.trace_memory)
+            for metadata_archiver in archivers:
+                profiler.instrument(metadata_archiver, "request_recent_jobs", "archive_job_listing", "archive_job_info")
+            profiler.start()
+        if args.download:
+            for metadata_archiver in archivers:
+                pipeline = pipelines[metadata_archiver.account] = DownloadPipeline(metadata_archiver, args)
+                if profiler is not None:
+                    profiler.instrument(pipeline.downloader, "download_job", "download_url")
+                pipeline.start()
+    except ImportError as e:
+        _log.error(str(e))
+        for pipeline in pipelines.values():
+            pipeline.finish()
+        for metadata_archiver in archivers:
+            metadata_archiver.close()
+        transport.close()
+        return 1
+
+    def request_stop(signum, frame):
+        _log.info(f"Received {signal.Signals(signum).name}: stopping all accounts after their current page.")
+        for metadata_archiver in archivers:
+            metadata_archiver.stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+
+    _log.info(f"Archiving {len(accounts)} accounts into {archive_root}")
+    threads = [
+        threading.Thread(
+            target=run_archiver, args=(metadata_archiver, args, job_type), name=f"mj-account-{metadata_archiver.account}"
+        )
+        for metadata_archiver in archivers
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        _log.info("Caught KeyboardInterrupt. Stopping all accounts after their current page.")
+        for metadata_archiver in archivers:
+            metadata_archiver.stop_requested.set()
+        for pipeline in pipelines.values():
+            pipeline.stop_downloads.set()
+        for thread in threads:
+            thread.join()
+
+    total_stats = collections.Counter()
+    exit_code = 0
+    for metadata_archiver in archivers:
+        stats = metadata_archiver.stats
+        pipeline = pipelines.get(metadata_archiver.account)
+        if pipeline is not None:
+            pipeline.finish()
+            stats = metadata_archiver.stats + pipeline.downloader.stats
+            if pipeline.downloader.has_errors():
+                exit_code = 1
+        if metadata_archiver.has_errors():
+            exit_code = 1
+        metadata_archiver.close()
+        _log.info(f"Account {metadata_archiver.account} finished. Stats: {stats}")
+        total_stats.update(stats)
+    total_stats.update(transport.stats()) # Retries, throttling and budget waits of all accounts
+    transport.close()
+    if profiler is not None:
+        profiler.stop()
+    _log.info(f"Archiving process finished for {len(accounts)} accounts. Stats: {total_stats}")
+    if args.metrics_out is not None:
+        write_metrics(args.metrics_out, "archiver", total_stats, started, exit_code)
+    return exit_code
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Download Midjourney job metadata.",
@@ -285,6 +944,45 @@ def main():
         default=os.environ.get("MIDJOURNEY_SESSION_TOKEN"),
         help="Your Midjourney __Secure-next-auth.session-token. Can also be set via MIDJOURNEY_SESSION_TOKEN environment variable.",
     )
+    parser.add_argument(
+        "--accounts",
+        type=Path,
+        default=None,
+        help="Archive several accounts at once: a JSON file listing each account's name, user_id and session_token "
+             "(or session_token_env, an environment variable holding it) and optionally archive_root (default: "
+             "<archive-root>/<name>). Accounts are crawled concurrently over one shared connection pool and take "
+             "turns within --api-concurrency, --max-requests-per-second and --max-bytes-per-second. "
+             "--user-id and --session-token are ignored.",
+    )
+    parser.add_argument(
+        "--api-concurrency",
+        type=int,
+        default=4,
+        help="With --accounts: maximum number of API requests in flight for all accounts together. "
+             "With --download, --download-workers likewise caps the downloads of all accounts together.",
+    )
+    parser.add_argument(
+        "--max-requests-per-second",
+        type=float,
+        default=0,
+        help="With --accounts: budget of API and image requests per second for all accounts together, "
+             "retries included. Use 0 for no limit.",
+    )
+    parser.add_argument(
+        "--max-bytes-per-second",
+        type=parse_byte_rate,
+        default=0,
+        help="Bandwidth budget in bytes per second, with an optional k, M or G suffix, e.g. '5M': with "
+             "--accounts for all accounts together, otherwise for the images of --download. Use 0 for no limit.",
+    )
+    parser.add_argument(
+        "--bandwidth-schedule",
+        type=str,
+        default="",
+        help="Bandwidth budgets by local time of day, e.g. '09:00-18:00=1M,22:00-06:00=20M'; ranges may wrap "
+             "around midnight and the first matching one wins. --max-bytes-per-second applies outside of them, "
+             "and a rate of 0 lifts the limit. Applies like --max-bytes-per-second.",
+    )
     parser.add_argument(
         "--page-limit",
         type=int,
@@ -310,6 +1008,74 @@ def main():
         help="Automatically set --from-date to the enqueue_time of the latest job found in the existing archive. "
              "This is ignored if --from-date is explicitly set.",
     )
+    parser.add_argument(
+        "--stop-after-known-pages",
+        type=int,
+        default=0,
+        help="Stop crawling after this many consecutive listing pages that only hold already archived jobs, "
+             "e.g. 1 for quick incremental syncs from the newest jobs. The ids of the archived jobs are loaded "
+             "into memory at the start. Use 0 to crawl until the end of the listing.",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Backfill the history from --since through --until as fromDate windows crawled concurrently, "
+             "which also gets past the API's cap of about 2500 jobs per listing. Progress is checkpointed "
+             "in the manifest, so running the same command again resumes an interrupted backfill.",
+    )
+    parser.add_argument(
+        "--since",
+        type=dt.date.fromisoformat,
+        default=dt.date(2022, 1, 1),
+        help="With --partitioned: first day (YYYY-MM-DD) of the history to crawl.",
+    )
+    parser.add_argument(
+        "--until",
+        type=dt.date.fromisoformat,
+        default=None,
+        help="With --partitioned: last day (YYYY-MM-DD) of the history to crawl. Default: today.",
+    )
+    parser.add_argument(
+        "--window-days",
+        type=int,
+        default=30,
+        help="With --partitioned: initial length of the windows in days. Windows that hit the listing cap "
+             "are split further.",
+    )
+    parser.add_argument(
+        "--listing-cap",
+        type=int,
+        default=LISTING_CAP,
+        help="With --partitioned: number of jobs after which the API ends a listing. A window is split as soon "
+             "as it reaches this many jobs; a listing that ends earlier before the window's start is split as "
+             "well. Use 0 to rely on the latter only.",
+    )
+    parser.add_argument(
+        "--partition-workers",
+        type=int,
+        default=4,
+        help="With --partitioned: number of windows crawled concurrently.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and poll for new jobs, on a warm session and with the ids of the archived jobs in "
+             "memory, until SIGTERM or Ctrl+C. Polls come every --min-poll-interval seconds while new jobs arrive "
+             "and back off up to --max-poll-interval while idle. Combine with --download to download new images "
+             "as well.",
+    )
+    parser.add_argument(
+        "--min-poll-interval",
+        type=float,
+        default=15.0,
+        help="Seconds between polls of --watch while new jobs arrive.",
+    )
+    parser.add_argument(
+        "--max-poll-interval",
+        type=float,
+        default=300.0,
+        help="Longest time in seconds between polls of --watch; the interval doubles after every idle poll up to this.",
+    )
     parser.add_argument(
         "--overwrite-metadata",
         action="store_true",
@@ -321,6 +1087,114 @@ def main():
         default=2,
         help="Indentation level for JSON files. Use 0 for the most compact JSON output (no newlines or spaces).",
     )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        default="files",
+        choices=STORAGE_LAYOUTS,
+        help="How to store job metadata: 'files' writes a .json and a .prompt.txt file per job, "
+             "'packed' appends jobs to one jobs.jsonl (and prompts.txt) shard per day.",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="none",
+        choices=COMPRESSIONS,
+        help="Compression of packed shards. Every job is compressed separately so it can still be read "
+             "with one seek. 'zstd' needs the zstandard package and trains a dictionary on the first jobs.",
+    )
+    parser.add_argument(
+        "--api-base-url",
+        type=str,
+        default=API_BASE_URL,
+        help="Base URL of the Midjourney API, e.g. to point the archiver at a local stand-in for testing.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="How often to retry a throttled (429) or failed request before giving up, for the job listing and, "
+             "with --download, for images. Retries honour Retry-After and otherwise back off exponentially with jitter.",
+    )
+    parser.add_argument(
+        "--prefetch-pages",
+        type=int,
+        default=1,
+        help="Number of job listing pages to fetch in the background while the current page is written to disk. "
+             "Use 0 to fetch pages strictly one after another.",
+    )
+    parser.add_argument(
+        "--cache-responses",
+        action="store_true",
+        help="Keep every job listing page in <archive-root>/.mj-cache. Cached pages are revalidated with the "
+             "API's ETag/Last-Modified where it sends them, and can be replayed offline with --replay.",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=0,
+        help="With --cache-responses: use cached pages younger than this many seconds without asking the API, "
+             "e.g. to resume a failed crawl without fetching its pages again.",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Read the job listing pages from <archive-root>/.mj-cache only, without any API request; a page "
+             "missing from the cache ends the listing. Use the options of the cached crawl, e.g. with "
+             "--overwrite-metadata to rewrite the archive after a format change. No session token is needed.",
+    )
+    parser.add_argument(
+        "--download",
+        action="store_true",
+        help="Also download images while crawling. Each archived job is queued for download right away "
+             "instead of running mj-downloader.py over the whole archive afterwards.",
+    )
+    parser.add_argument(
+        "--download-job-types",
+        type=str,
+        default="upscale",
+        help="With --download: comma-separated list of job types to download images for. "
+             "Provide an empty string or 'all' to download for all types.",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=4,
+        help="With --download: number of concurrent image downloads.",
+    )
+    parser.add_argument(
+        "--download-queue-size",
+        type=int,
+        default=200,
+        help="With --download: maximum number of archived jobs waiting for download. "
+             "The crawl pauses when the queue is full.",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=Path,
+        default=None,
+        help="Write request latencies, bytes transferred, phase timings, queue depths and the final stats "
+             "to this file at the end of the run: a JSON report for a .json path, otherwise a Prometheus "
+             "textfile (e.g. for node exporter's textfile collector, use a .prom path).",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run with cProfile (all threads) and time the main stages; the results are written "
+             "to a timestamped directory under --profile-dir.",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace memory allocations with tracemalloc and write the top allocators and the peak to the "
+             "profile directory. Slows the run down considerably.",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        default=Path.cwd() / "mj-profiles",
+        help="Directory for the results of --profile and --trace-memory.",
+    )
     parser.add_argument(
         "--log-level",
         type=str,
@@ -337,26 +1211,31 @@ def main():
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
     )
 
-    user_id = args.user_id
-    if not user_id:
-        try:
-            user_id = input("Enter your Midjourney User ID: ")
-        except EOFError: # Handle non-interactive execution (e.g. cronjob)
-            _log.error("User ID not provided via --user-id argument, MIDJOURNEY_USER_ID environment variable, or interactive prompt.")
-            return 1 # Exit with error code
+    started = time.time()
+    if args.metrics_out is not None:
+        METRICS.enable()
 
+    user_id = args.user_id
     session_token = args.session_token
-    if not session_token:
-        try:
-            session_token = input("Enter your Midjourney Session Token (__Secure-next-auth.session-token): ")
-        except EOFError:
-            _log.error("Session Token not provided via --session-token argument, MIDJOURNEY_SESSION_TOKEN environment variable, or interactive prompt.")
-            return 1
+    if args.accounts is None: # With --accounts, every account brings its own credentials
+        if not user_id:
+            try:
+                user_id = input("Enter your Midjourney User ID: ")
+            except EOFError: # Handle non-interactive execution (e.g. cronjob)
+                _log.error("User ID not provided via --user-id argument, MIDJOURNEY_USER_ID environment variable, or interactive prompt.")
+                return 1 # Exit with error code
 
-    if not user_id or not session_token:
-        # This case should ideally be caught by the individual checks above, but as a safeguard:
-        _log.error("User ID and Session Token are required.")
-        return 1
+        if not session_token and not args.replay: # Replayed pages are not requested
+            try:
+                session_token = input("Enter your Midjourney Session Token (__Secure-next-auth.session-token): ")
+            except EOFError:
+                _log.error("Session Token not provided via --session-token argument, MIDJOURNEY_SESSION_TOKEN environment variable, or interactive prompt.")
+                return 1
+
+        if not user_id or (not session_token and not args.replay):
+            # This case should ideally be caught by the individual checks above, but as a safeguard:
+            _log.error("User ID and Session Token are required.")
+            return 1
 
     # Validate from_date format if provided, before passing to the archiver
     parsed_from_date = None
@@ -374,10 +1253,6 @@ def main():
                     _log.error(f"Invalid --from-date format: '{args.from_date}'. Use 'YYYY-MM-DD HH:MM:SS.ffffff', 'YYYY-MM-DD HH:MM:SS', or 'YYYY-MM-DD'.")
                     return 1
 
-    # For the API call, we need the from_date as a string in the specific format it expects,
-    # or None if not applicable. The internal logic of request_recent_jobs handles the string.
-    from_date_for_api = args.from_date
-
     job_type_to_pass = args.job_type
     if args.job_type and args.job_type.lower() in ["all", "none"]:
         job_type_to_pass = None # API expects null or no jobType param for all types
@@ -394,44 +1269,115 @@ def main():
         return 1
 
 
-    metadata_archiver = MidjourneyMetadataArchiver(
-        archive_root=resolved_archive_root,
-        user_id=user_id,
-        session_token=session_token,
-        json_indent=args.json_indent,
-    )
+    if args.compression != "none" and args.storage != "packed":
+        _log.error("--compression only applies to --storage packed.")
+        return 1
+
+    if args.stop_after_known_pages and (args.overwrite_metadata or args.partitioned):
+        _log.error("--stop-after-known-pages can't be combined with --overwrite-metadata or --partitioned.")
+        return 1
+
+    if args.watch:
+        if args.partitioned or args.from_date or args.get_from_date_from_archive or args.page_limit \
+                or args.overwrite_metadata or args.stop_after_known_pages:
+            _log.error("--watch can't be combined with --partitioned, --from-date, --get-from-date-from-archive, "
+                       "--page-limit, --overwrite-metadata or --stop-after-known-pages.")
+            return 1
+        if args.min_poll_interval <= 0 or args.max_poll_interval < args.min_poll_interval:
+            _log.error("--min-poll-interval must be positive and at most --max-poll-interval.")
+            return 1
+
+    if args.cache_max_age < 0:
+        _log.error(f"--cache-max-age must not be negative, got {args.cache_max_age}")
+        return 1
+    if args.watch and (args.replay or args.cache_max_age):
+        _log.error("--watch polls for new jobs and can't be combined with --replay or --cache-max-age.")
+        return 1
+
+    if args.accounts is None:
+        if args.max_requests_per_second:
+            _log.error("--max-requests-per-second only applies to --accounts.")
+            return 1
+        if (args.max_bytes_per_second or args.bandwidth_schedule) and not args.download:
+            _log.error("Without --accounts, --max-bytes-per-second and --bandwidth-schedule only apply to --download.")
+            return 1
+    elif args.api_concurrency < 1 or args.max_requests_per_second < 0:
+        _log.error("--api-concurrency must be at least 1 and --max-requests-per-second must not be negative.")
+        return 1
+
+    if args.partitioned:
+        if args.from_date or args.get_from_date_from_archive or args.page_limit:
+            _log.error("--from-date, --get-from-date-from-archive and --page-limit don't apply to --partitioned.")
+            return 1
+        if args.window_days < 1 or args.partition_workers < 1:
+            _log.error("--window-days and --partition-workers must be at least 1.")
+            return 1
+        if args.listing_cap < 0:
+            _log.error(f"--listing-cap must not be negative, got {args.listing_cap}")
+            return 1
+
+    bandwidth_schedule = None
     try:
-        metadata_archiver.crawl(
-            page_limit=args.page_limit,
-            job_type=job_type_to_pass,
-            from_date=from_date_for_api,
-            get_from_date_from_archive=args.get_from_date_from_archive,
-            overwrite_metadata=args.overwrite_metadata,
-        )
+        if args.bandwidth_schedule:
+            bandwidth_schedule = RateSchedule(args.bandwidth_schedule, args.max_bytes_per_second)
+    except ValueError as e:
+        _log.error(f"Invalid --bandwidth-schedule: {e}")
+        return 1
+
+    if args.accounts is not None:
+        return archive_accounts(args, job_type_to_pass, resolved_archive_root, started, bandwidth_schedule)
+
+    try:
+        metadata_archiver = create_archiver(args, resolved_archive_root, user_id, session_token)
+    except ImportError as e:
+        _log.error(str(e))
+        return 1
+
+    profiler = None
+    if args.profile or args.trace_memory:
+        profiler = RunProfiler(args.profile_dir, "archiver", profile=args.profile, trace_memory=args.trace_memory)
+        profiler.instrument(metadata_archiver, "request_recent_jobs", "archive_job_listing", "archive_job_info")
+        profiler.start()
+
+    pipeline = None
+    if args.download:
+        bandwidth_budget = None
+        if args.max_bytes_per_second or bandwidth_schedule:
+            bandwidth_budget = TokenBucket("bandwidth", args.max_bytes_per_second, schedule=bandwidth_schedule)
+        pipeline = DownloadPipeline(metadata_archiver, args, bandwidth_budget)
+        if profiler is not None:
+            profiler.instrument(pipeline.downloader, "download_job", "download_url")
+        pipeline.start()
+
+    def request_stop(signum, frame):
+        _log.info(f"Received {signal.Signals(signum).name}: stopping after the current page.")
+        metadata_archiver.stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+
+    try:
+        run_archiver(metadata_archiver, args, job_type_to_pass)
     except KeyboardInterrupt:
         _log.info("Caught KeyboardInterrupt. Exiting gracefully.")
-    except requests.exceptions.HTTPError as e:
-        if e.response is not None:
-            if e.response.status_code == 401:
-                _log.error(f"HTTP 401 Unauthorized: API request failed. This often means your session token is invalid or expired.")
-            elif e.response.status_code == 403:
-                 _log.error(f"HTTP 403 Forbidden: API request failed. Check your User ID and permissions. It's also possible the API structure changed or access was revoked.")
-            else:
-                _log.error(f"HTTP Error during API request: {e.response.status_code} - {e.response.text}")
-        else:
-            _log.error(f"HTTP Error during API request (no response object): {e}")
-    except requests.exceptions.RequestException as e:
-        _log.error(f"A network error occurred during API request: {e}")
-    except Exception as e:
-        _log.error(f"An unexpected error occurred: {e}", exc_info=True) # Log full traceback for truly unexpected errors
+        if pipeline is not None:
+            pipeline.stop_downloads.set()
     finally:
-        _log.info(f"Archiving process finished. Stats: {metadata_archiver.stats}")
-        if metadata_archiver.stats.get("error_parsing_enqueue_time",0) > 0 or \
-           metadata_archiver.stats.get("error_creating_directory",0) > 0 or \
-           metadata_archiver.stats.get("error_writing_json",0) > 0 or \
-           metadata_archiver.stats.get("error_writing_prompt",0) > 0:
-            return 1 # Exit with error code if any file operation errors occurred
-        return 0 # Exit with success code
+        stats = metadata_archiver.stats
+        if pipeline is not None:
+            pipeline.finish()
+            stats = metadata_archiver.stats + pipeline.downloader.stats
+        metadata_archiver.close()
+        if profiler is not None:
+            profiler.stop()
+        _log.info(f"Archiving process finished. Stats: {stats}")
+        exit_code = 0
+        if metadata_archiver.has_errors():
+            exit_code = 1 # Exit with error code if any file operation or API errors occurred
+        if pipeline is not None and pipeline.downloader.has_errors():
+            exit_code = 1
+        if args.metrics_out is not None:
+            write_metrics(args.metrics_out, "archiver", stats, started, exit_code)
+        return exit_code
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+"""
+Accounts file of the multi-account mode (`mj-metadata-archiver.py --accounts`).
+
+The file is a JSON list with one object per account:
+
+    [
+        {"name": "alice", "user_id": "...", "session_token": "..."},
+        {"name": "bob", "user_id": "...", "session_token_env": "MJ_TOKEN_BOB", "archive_root": "/data/bob"}
+    ]
+
+`session_token_env` names an environment variable holding the token instead,
+so the file can be checked in without secrets. Every account is archived into
+its own `archive_root`, by default `<--archive-root>/<name>`; relative roots are
+relative to `--archive-root` as well.
+"""
+
+import collections
+import json
+import os
+import re
+from pathlib import Path
+
+Account = collections.namedtuple("Account", ["name", "user_id", "session_token", "archive_root"])
+
+ACCOUNT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$") # Account names are used as directory names
+
+
+def _parse_account(entry, archive_root: Path) -> Account:
+    if not isinstance(entry, dict):
+        raise ValueError(f"Every account must be a JSON object, got {entry!r}")
+    name = entry.get("name")
+    if not isinstance(name, str) or not ACCOUNT_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid account name {name!r}: use letters, digits, '.', '_' and '-'")
+    user_id = entry.get("user_id")
+    if not isinstance(user_id, str) or not user_id:
+        raise ValueError(f"Account {name} has no user_id")
+    session_token = entry.get("session_token")
+    token_variable = entry.get("session_token_env")
+    if token_variable:
+        session_token = os.environ.get(token_variable)
+        if not session_token:
+            raise ValueError(f"Environment variable {token_variable} with the session token of account {name} is not set")
+    if not isinstance(session_token, str) or not session_token:
+        raise ValueError(f"Account {name} has neither session_token nor session_token_env")
+    account_root = archive_root / Path(entry.get("archive_root") or name).expanduser()
+    return Account(name, user_id, session_token, account_root.resolve())
+
+
+def load_accounts(path: Path, archive_root: Path) -> list[Account]:
+    """
+    Read and validate an accounts file. Raises ValueError if it is invalid,
+    names an account twice or gives two accounts the same archive root.
+    """
+    try:
+        entries = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Cannot read accounts file {path}: {e}") from e
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Accounts file {path} must hold a non-empty JSON list of accounts")
+    accounts = [_parse_account(entry, archive_root) for entry in entries]
+    for field in ("name", "archive_root"):
+        counts = collections.Counter(getattr(account, field) for account in accounts)
+        duplicates = [str(value) for value, count in counts.items() if count > 1]
+        if duplicates:
+            raise ValueError(f"Accounts file {path} uses the same {field} for several accounts: {', '.join(duplicates)}")
+    return accounts
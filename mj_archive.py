@@ -0,0 +1,234 @@
+"""
+Helpers shared by the Midjourney archive tools that describe the on-disk
+archive layout written by `mj-metadata-archiver.py`:
+
+    <archive_root>/YYYY/YYYY-MM/YYYY-MM-DD/YYYYMMDD-HHMMSS_<job_id>.json
+
+or, with packed storage, one append-only shard per day, optionally compressed:
+
+    <archive_root>/YYYY/YYYY-MM/YYYY-MM-DD/jobs.jsonl[.gz|.zst]
+"""
+
+import collections
+import datetime as dt
+import importlib.util
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Iterator
+
+from mj_codecs import COMPRESSION_SUFFIXES, codec_for_path
+
+_log = logging.getLogger(__name__)
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+ENQUEUE_TIME_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+SUPPORTED_IMAGE_EXTENSIONS = ("png", "jpg", "jpeg", "webp")
+
+# Packed storage: one JSON document per line, and the rendered prompts of the same jobs.
+# Compressed shards carry the codec's suffix (`jobs.jsonl.zst`, `prompts.txt.zst`).
+SHARD_FILENAME = "jobs.jsonl"
+PROMPTS_SHARD_FILENAME = "prompts.txt"
+SHARD_FILENAMES = tuple(SHARD_FILENAME + suffix for suffix in COMPRESSION_SUFFIXES.values())
+
+# A job read from a packed shard: its metadata, the path its JSON file would have
+# in the per-file layout, and the byte range of its line (or compressed frame) in the shard
+ShardEntry = collections.namedtuple("ShardEntry", ["job_info", "job_path", "offset", "length"])
+
+
+def parse_enqueue_time(enqueue_time: str) -> dt.datetime | None:
+    """
+    Parse an API `enqueue_time` ("2023-10-26 18:19:40.038313", sometimes without
+    microseconds). Returns None if the value cannot be parsed.
+    """
+    for time_format in ENQUEUE_TIME_FORMATS:
+        try:
+            return dt.datetime.strptime(enqueue_time, time_format)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def enqueue_sort_key(enqueue_time_dt: dt.datetime) -> str:
+    """
+    Fixed-width representation of an enqueue time that sorts chronologically as text.
+    """
+    return enqueue_time_dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def job_dir_for(archive_root: Path, enqueue_time_dt: dt.datetime) -> Path:
+    return archive_root / enqueue_time_dt.strftime("%Y/%Y-%m/%Y-%m-%d")
+
+
+def job_filename_base(job_id: str, enqueue_time_dt: dt.datetime) -> str:
+    return f"{enqueue_time_dt.strftime('%Y%m%d-%H%M%S')}_{job_id}"
+
+
+def image_extension(image_url: str) -> str:
+    """
+    Extension of an image URL, lower-cased and without the dot.
+    URLs without an extension default to "png", which Midjourney typically serves.
+    """
+    extension = Path(image_url.split("?")[0]).suffix.lstrip('.').lower()
+    return extension or "png"
+
+
+def image_download_path(job_info_path: Path, image_url: str, index: int, image_count: int) -> Path | None:
+    """
+    Local path of the `index`-th image of a job, next to its JSON metadata file:
+    20231027-123456_jobid.json -> 20231027-123456_jobid.png (single image)
+                               -> 20231027-123456_jobid-1.png (multiple images)
+    Returns None if the URL has an unsupported extension.
+    """
+    extension = image_extension(image_url)
+    if extension not in SUPPORTED_IMAGE_EXTENSIONS:
+        return None
+    image_index_suffix = "" if image_count == 1 else f"-{index + 1}"
+    return job_info_path.parent / f"{job_info_path.stem}{image_index_suffix}.{extension}"
+
+
+def _date_range_of_dir(name: str, depth: int) -> tuple[dt.date, dt.date] | None:
+    """
+    First and last day covered by a `YYYY`, `YYYY-MM` or `YYYY-MM-DD` directory
+    at the given depth below the archive root, or None if the name doesn't match.
+    """
+    try:
+        if depth == 0:
+            year = int(name) if len(name) == 4 else None
+            return (dt.date(year, 1, 1), dt.date(year, 12, 31)) if year else None
+        if depth == 1:
+            first = dt.datetime.strptime(name, "%Y-%m").date()
+            next_month = (first.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+            return first, next_month - dt.timedelta(days=1)
+        if depth == 2:
+            day = dt.datetime.strptime(name, "%Y-%m-%d").date()
+            return day, day
+    except ValueError:
+        return None
+    return None
+
+
+def iter_job_files(
+    archive_root: Path,
+    since: dt.date | None = None,
+    until: dt.date | None = None,
+    include_shards: bool = False,
+    newest_first: bool = False,
+) -> Iterator[Path]:
+    """
+    Yield the JSON metadata files of the archive as they are found.
+    With `include_shards`, packed day shards (`jobs.jsonl[.gz|.zst]`) are yielded as well.
+    Files come in name order, which is the order of the jobs' enqueue times,
+    or in reverse with `newest_first`.
+
+    The tree is scanned directory by directory with `os.scandir`, so memory use
+    depends only on the size of a single directory, not of the whole archive.
+    `since` and `until` are inclusive day bounds; `YYYY`, `YYYY-MM` and
+    `YYYY-MM-DD` subtrees entirely outside of them are not entered at all.
+    Hidden entries (such as the manifest) are ignored.
+    """
+    stack = [(archive_root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name, reverse=newest_first)
+        except OSError as e:
+            _log.warning(f"Cannot scan directory {directory}: {e}")
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                date_range = _date_range_of_dir(entry.name, depth)
+                if date_range is not None:
+                    first_day, last_day = date_range
+                    if (since and last_day < since) or (until and first_day > until):
+                        _log.debug(f"Skipping {entry.path}: outside of date range")
+                        continue
+                subdirectories.append((Path(entry.path), depth + 1))
+            elif (entry.name.endswith(".json") or (include_shards and entry.name in SHARD_FILENAMES)) and entry.is_file():
+                yield Path(entry.path)
+        # Reversed so that the stack pops subdirectories in name order
+        stack.extend(reversed(subdirectories))
+
+
+def job_path_in_shard(shard_path: Path, job_info: dict) -> Path | None:
+    """
+    Path the job's JSON file would have in the per-file layout. Images of packed
+    jobs are named after it, exactly like images of jobs stored as separate files.
+    """
+    enqueue_time_dt = parse_enqueue_time(job_info.get("enqueue_time"))
+    if enqueue_time_dt is None or "id" not in job_info:
+        return None
+    return shard_path.parent / f"{job_filename_base(job_info['id'], enqueue_time_dt)}.json"
+
+
+def is_shard_path(path: Path) -> bool:
+    return path.name in SHARD_FILENAMES
+
+
+def shard_paths(job_dir: Path, compression: str) -> tuple[Path, Path]:
+    """
+    The job shard and the prompts shard of a day folder for a compression.
+    """
+    suffix = COMPRESSION_SUFFIXES[compression]
+    return job_dir / f"{SHARD_FILENAME}{suffix}", job_dir / f"{PROMPTS_SHARD_FILENAME}{suffix}"
+
+
+def prompts_shard_path(shard_path: Path) -> Path:
+    return shard_path.with_name(PROMPTS_SHARD_FILENAME + shard_path.name[len(SHARD_FILENAME):])
+
+
+def archive_root_of_shard(shard_path: Path) -> Path:
+    return shard_path.parents[3] # <archive_root>/YYYY/YYYY-MM/YYYY-MM-DD/<shard>
+
+
+def read_shard(shard_path: Path, archive_root: Path | None = None) -> Iterator[ShardEntry]:
+    """
+    Yield a `ShardEntry` for every job in a packed day shard. Shards are
+    append-only, so when a job was written more than once its last line wins.
+    Lines that can't be decoded (e.g. cut off by a crash) are skipped with a warning.
+
+    Compressed shards hold one frame per job; offset and length of an entry are
+    those of its frame. `archive_root` locates the zstd dictionary and defaults
+    to the root the shard's day folder is in.
+    """
+    codec = codec_for_path(shard_path, archive_root or archive_root_of_shard(shard_path))
+    entries: dict[str, ShardEntry] = {}
+    for frame_number, (frame_offset, frame_length, line) in enumerate(codec.split_frames(shard_path.read_bytes()), start=1):
+        if not line.strip():
+            continue
+        try:
+            job_info = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            _log.warning(f"Skipping undecodable line {frame_number} of {shard_path}: {e}")
+            continue
+        if not isinstance(job_info, dict) or "id" not in job_info:
+            continue
+        job_path = job_path_in_shard(shard_path, job_info)
+        if job_path is None:
+            _log.warning(f"Skipping job {job_info.get('id')} in {shard_path}: cannot parse enqueue_time")
+            continue
+        entries[job_info["id"]] = ShardEntry(job_info, job_path, frame_offset, frame_length)
+    yield from entries.values()
+
+
+def import_script(filename: str):
+    """
+    Import one of the hyphenated command line scripts next to this module
+    (e.g. "mj-downloader.py") so its classes can be reused by the other tools.
+    """
+    module_name = Path(filename).stem.replace("-", "_")
+    module = sys.modules.get(module_name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(module_name, SCRIPTS_DIR / filename)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return module
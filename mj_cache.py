@@ -0,0 +1,136 @@
+"""
+On-disk cache of the API's listing pages.
+
+Every `recent-jobs` page is stored under
+`<archive_root>/.mj-cache/<key[:2]>/<key>.json.gz`, where the key is the SHA-256
+of the URL path and the request parameters. Neither the host nor the session
+token (a cookie) is part of the key, so the pages stay valid across logins and
+can be replayed with any `--api-base-url`.
+Each entry keeps the response body together with its `ETag` and `Last-Modified`
+validators and the time it was fetched.
+
+A cached page younger than `max_age` seconds is used without a request; older
+pages are revalidated with `If-None-Match`/`If-Modified-Since` where the API sent
+validators, and fetched again otherwise. In replay mode the archiver reads pages
+from the cache only, so a crawl can be repeated offline, e.g. with
+`--overwrite-metadata` after a change of the metadata format.
+"""
+
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+_log = logging.getLogger(__name__)
+
+CACHE_DIRNAME = ".mj-cache"
+
+CachedResponse = collections.namedtuple(
+    "CachedResponse", ["body", "content_type", "etag", "last_modified", "fetched_at"]
+)
+
+
+def cache_key(url: str, params: dict) -> str:
+    canonical = json.dumps([urlsplit(url).path, sorted((str(k), str(v)) for k, v in params.items())], separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Listing pages of the API by URL and parameters, see the module docstring.
+    `stats` counts hits, revalidations, stores and replayed pages.
+    """
+
+    def __init__(self, archive_root: Path, max_age: float = 0.0):
+        self.root = archive_root / CACHE_DIRNAME
+        self.max_age = max_age
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json.gz"
+
+    def get(self, url: str, params: dict) -> CachedResponse | None:
+        path = self._path(cache_key(url, params))
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+            return CachedResponse(
+                entry["body"], entry["content_type"], entry.get("etag"), entry.get("last_modified"), entry["fetched_at"]
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, KeyError, TypeError) as e: # Unreadable entries count as missing
+            _log.warning(f"Ignoring damaged cache entry {path}: {e}")
+            self.count("cache_damaged")
+            return None
+
+    def is_fresh(self, cached: CachedResponse) -> bool:
+        return time.time() - cached.fetched_at < self.max_age
+
+    @staticmethod
+    def conditional_headers(cached: CachedResponse) -> dict[str, str]:
+        headers = {}
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        return headers
+
+    def put(
+        self,
+        url: str,
+        params: dict,
+        body: str,
+        content_type: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ):
+        """
+        Store a page, replacing an earlier entry atomically. Failures are logged
+        and counted, as the page itself was fetched fine.
+        """
+        if self._write(url, params, body, content_type, etag, last_modified):
+            self.count("cache_stored")
+
+    def refresh(self, url: str, params: dict, cached: CachedResponse):
+        """
+        Record that the API confirmed a cached page (HTTP 304) just now.
+        """
+        self._write(url, params, cached.body, cached.content_type, cached.etag, cached.last_modified)
+
+    def _write(
+        self, url: str, params: dict, body: str, content_type: str, etag: str | None, last_modified: str | None
+    ) -> bool:
+        path = self._path(cache_key(url, params))
+        entry = {
+            "url": url,
+            "params": params,
+            "fetched_at": time.time(),
+            "content_type": content_type,
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body,
+        }
+        temporary_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(temporary_path, "wt", encoding="utf-8") as f:
+                json.dump(entry, f, separators=(",", ":"))
+            os.replace(temporary_path, path)
+        except OSError as e:
+            _log.warning(f"Could not cache the response to {url}: {e}")
+            temporary_path.unlink(missing_ok=True)
+            self.count("cache_write_failed")
+            return False
+        return True
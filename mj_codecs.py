@@ -0,0 +1,186 @@
+"""
+Compression codecs for packed metadata shards.
+
+Every job is compressed as an independent frame (a gzip member or a zstd frame)
+and frames are appended to the shard. The shard therefore stays a valid
+`.gz`/`.zst` stream for standard tools, while the offsets in the manifest still
+allow decompressing a single job without reading the rest of the shard.
+
+zstd needs the optional `zstandard` package. Small JSON documents compress far
+better with a dictionary trained on the archive's own jobs; it is stored in the
+archive root and used for all new frames once it exists.
+"""
+
+import functools
+import gzip
+import logging
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+_log = logging.getLogger(__name__)
+
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+COMPRESSIONS = tuple(COMPRESSION_SUFFIXES)
+ZSTD_DICTIONARY_FILENAME = ".mj-zstd-dictionary"
+ZSTD_DICTIONARY_SIZE = 112640 # zstd's default, plenty for JSON documents of one schema
+SPLIT_READ_SIZE = 16 * 1024 # Bytes fed to a frame's decompressor at a time; most job frames are smaller
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstd compression requires the 'zstandard' package: pip install zstandard"
+        ) from e
+    return zstandard
+
+
+class NoCompression:
+    name = "none"
+    suffix = COMPRESSION_SUFFIXES["none"]
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def split_frames(self, data: bytes) -> Iterator[tuple[int, int, bytes]]:
+        """
+        Yield `(offset, length, payload)` for every frame (here: line) of a shard.
+        """
+        offset = 0
+        for line in data.splitlines(keepends=True):
+            yield offset, len(line), line
+            offset += len(line)
+
+
+class GzipCompression(NoCompression):
+    name = "gzip"
+    suffix = COMPRESSION_SUFFIXES["gzip"]
+
+    frame_errors = (zlib.error,)
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+    def _decompressobj(self, frame: bytes):
+        return zlib.decompressobj(wbits=31) # Expect a gzip header; stops at the end of one member
+
+    def split_frames(self, data: bytes) -> Iterator[tuple[int, int, bytes]]:
+        # Feed each frame in small slices of a memoryview: passing the rest of the
+        # shard would copy it (and its unused data) for every frame
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            position = offset
+            chunks = []
+            try:
+                decompressor = self._decompressobj(view[offset:offset + SPLIT_READ_SIZE])
+                while not decompressor.eof and position < len(data):
+                    chunk = view[position:position + SPLIT_READ_SIZE]
+                    chunks.append(decompressor.decompress(chunk))
+                    position += len(chunk)
+            except self.frame_errors as e:
+                _log.warning(f"Stopping at undecodable frame at byte {offset}: {e}")
+                return
+            if not decompressor.eof:
+                _log.warning(f"Ignoring truncated frame at byte {offset}")
+                return
+            length = position - offset - len(decompressor.unused_data)
+            yield offset, length, b"".join(chunks)
+            offset += length
+
+
+class ZstdCompression(GzipCompression):
+    name = "zstd"
+    suffix = COMPRESSION_SUFFIXES["zstd"]
+
+    def __init__(self, level: int = 10, dictionary: bytes | None = None):
+        zstandard = _import_zstandard()
+        self._zstandard = zstandard
+        self.frame_errors = (zstandard.ZstdError,)
+        self.level = level
+        self.dictionary = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        # zstandard (de)compressors are not thread-safe; `get_codec` returns a new codec per call
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=self.dictionary)
+        self._plain_decompressor = zstandard.ZstdDecompressor()
+        self._dict_decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary) if self.dictionary else None
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def _decompressor_for(self, frame: bytes):
+        # Frames written before the dictionary was trained don't reference it
+        if self._zstandard.get_frame_parameters(frame).dict_id and self._dict_decompressor is not None:
+            return self._dict_decompressor
+        return self._plain_decompressor
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor_for(data).decompress(data)
+
+    def _decompressobj(self, frame: bytes):
+        return self._decompressor_for(frame).decompressobj()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_dictionary(dictionary_path: Path) -> bytes | None:
+    return dictionary_path.read_bytes() if dictionary_path.exists() else None
+
+
+def get_codec(name: str, archive_root: Path):
+    if name == "none":
+        return NoCompression()
+    if name == "gzip":
+        return GzipCompression()
+    if name == "zstd":
+        return ZstdCompression(dictionary=_load_dictionary(zstd_dictionary_path(archive_root)))
+    raise ValueError(f"Unknown compression '{name}', expected one of {COMPRESSIONS}")
+
+
+def codec_for_path(path: Path, archive_root: Path):
+    """
+    Codec of a shard file, chosen by its suffix.
+    """
+    if path.name.endswith(ZstdCompression.suffix):
+        return get_codec("zstd", archive_root)
+    if path.name.endswith(GzipCompression.suffix):
+        return get_codec("gzip", archive_root)
+    return get_codec("none", archive_root)
+
+
+def zstd_dictionary_path(archive_root: Path) -> Path:
+    return archive_root / ZSTD_DICTIONARY_FILENAME
+
+
+def train_zstd_dictionary(samples: list[bytes], dict_size: int = ZSTD_DICTIONARY_SIZE) -> bytes:
+    """
+    Train a zstd dictionary on sample job documents.
+    Raises ValueError if the samples are not enough to train one.
+    """
+    zstandard = _import_zstandard()
+    try:
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Cannot train a zstd dictionary on {len(samples)} samples: {e}") from e
+
+
+def save_zstd_dictionary(archive_root: Path, dictionary: bytes) -> Path:
+    """
+    Store the archive's zstd dictionary. An existing dictionary is never replaced,
+    as the frames compressed with it could not be read anymore.
+    """
+    dictionary_path = zstd_dictionary_path(archive_root)
+    with dictionary_path.open("xb") as f:
+        f.write(dictionary)
+    _load_dictionary.cache_clear()
+    _log.info(f"Saved a {len(dictionary)} byte zstd dictionary to {dictionary_path}")
+    return dictionary_path
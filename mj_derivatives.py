@@ -0,0 +1,162 @@
+"""
+Derivative images (previews) of the downloaded images, e.g. small WebP or JPEG
+thumbnails for a gallery.
+
+Every derivative sits next to its source image and extends its name with the
+size: `20231027-123456_<job_id>-1.png` gets `20231027-123456_<job_id>-1.256px.webp`.
+Images are decoded and resized in a process pool, so all cores are used. The
+size and mtime of the source are recorded in the manifest with every derivative,
+and derivatives whose source has not changed since are skipped.
+
+Needs the optional `Pillow` package.
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+from mj_manifest import ArchiveManifest
+
+_log = logging.getLogger(__name__)
+
+DERIVATIVE_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+def _import_pil():
+    try:
+        from PIL import Image
+    except ImportError as e:
+        raise ImportError("Derivative images require the 'Pillow' package: pip install Pillow") from e
+    return Image
+
+
+def derivative_path(source_path: Path, size: int, image_format: str) -> Path:
+    return source_path.with_name(f"{source_path.stem}.{size}px.{image_format}")
+
+
+def render_derivatives(source_path: str, targets: list[tuple[str, int]], image_format: str, quality: int) -> list[str]:
+    """
+    Decode `source_path` once and write a derivative for every `(path, size)` in
+    `targets`, fitting the image into `size` x `size` pixels. Runs in a worker process.
+    """
+    Image = _import_pil()
+    written = []
+    with Image.open(source_path) as image:
+        image.load()
+        if DERIVATIVE_FORMATS[image_format] == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        # Largest first, so every smaller size is resized from the previous one
+        for path, size in sorted(targets, key=lambda target: -target[1]):
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                image.save(temporary_path, DERIVATIVE_FORMATS[image_format], quality=quality)
+                os.replace(temporary_path, path)
+            except BaseException:
+                Path(temporary_path).unlink(missing_ok=True)
+                raise
+            written.append(path)
+    return written
+
+
+class DerivativeGenerator:
+    """
+    Generates the configured derivative sizes of images in a process pool.
+    `submit` can be called from several threads; it blocks while many images are
+    waiting for the pool. `stats` counts written, skipped and failed derivatives.
+    """
+
+    def __init__(
+        self,
+        manifest: ArchiveManifest,
+        sizes: list[int],
+        image_format: str = "webp",
+        quality: int = 80,
+        workers: int | None = None,
+    ):
+        _import_pil() # Fail before the first image rather than in a worker
+        self.manifest = manifest
+        self.sizes = sorted(set(sizes), reverse=True)
+        self.image_format = image_format
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        # Worker processes are spawned: forking a process with running download threads is unsafe
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._slots = threading.BoundedSemaphore(self.workers * 4)
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def submit(self, source_path: Path) -> Future | None:
+        """
+        Queue the missing or outdated derivatives of an image. Returns None if all are up to date.
+        """
+        try:
+            source_stat = source_path.stat()
+        except OSError as e:
+            _log.warning(f"Not creating derivatives of {source_path}: {e}")
+            self._count("error_derivative_source")
+            return None
+        targets = []
+        for size in self.sizes:
+            path = derivative_path(source_path, size, self.image_format)
+            recorded = self.manifest.derivative_source(path)
+            if recorded == (source_stat.st_size, source_stat.st_mtime_ns) and path.exists():
+                self._count("skipped_derivative_unchanged")
+                continue
+            targets.append((str(path), size))
+        if not targets:
+            return None
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                render_derivatives, str(source_path), targets, self.image_format, self.quality
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda done: self._derivatives_done(done, source_path, source_stat))
+        return future
+
+    def _derivatives_done(self, future: Future, source_path: Path, source_stat: os.stat_result):
+        self._slots.release()
+        try:
+            written = future.result()
+        except Exception as e:
+            _log.error(f"Could not create derivatives of {source_path}: {e}")
+            self._count("error_derivative")
+            return
+        for path in written:
+            self.manifest.record_derivative(Path(path), source_path, source_stat.st_size, source_stat.st_mtime_ns)
+        _log.debug(f"Created {len(written)} derivatives of {source_path.name}")
+        self._count("derivatives_written", len(written))
+
+    def has_errors(self) -> bool:
+        return any(self.stats.get(key, 0) > 0 for key in ("error_derivative", "error_derivative_source"))
+
+    def close(self):
+        """
+        Wait for the queued derivatives and stop the worker processes.
+        """
+        self._executor.shutdown(wait=True)
+        self.manifest.commit()
+
+
+def parse_sizes(sizes: str) -> list[int]:
+    """
+    Parse a comma-separated list of derivative sizes in pixels, e.g. "256,1024".
+    """
+    parsed = [int(size) for size in sizes.split(",") if size.strip()]
+    if any(size < 1 for size in parsed):
+        raise ValueError(f"Derivative sizes must be positive, got '{sizes}'")
+    return parsed
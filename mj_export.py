@@ -0,0 +1,317 @@
+"""
+Export of the archived job metadata to columnar files for analytics.
+
+The archive is streamed, day folder by day folder, into Parquet (or Arrow IPC)
+files partitioned by month, in the Hive layout that pyarrow, pandas, Polars,
+DuckDB and Spark read as one dataset:
+
+    <output_dir>/month=2023-10/part-20231101T120000-1.parquet
+
+Every row is one job: its id, enqueue time, type, prompt, the parameters of its
+full command (`--ar 16:9` becomes `{"ar": "16:9"}`), its image URLs and the
+complete metadata as compact JSON. Exports are incremental: `_mj_export.json` in
+the output directory holds the export's id, under which the archive manifest
+records every exported job. The next export reads only the jobs of the manifest
+that are not recorded yet, however old they are (e.g. from a `--partitioned`
+backfill), and appends new part files.
+
+Needs the optional `pyarrow` package.
+"""
+
+import collections
+import datetime as dt
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+
+from mj_archive import is_shard_path, iter_job_files, parse_enqueue_time, read_shard
+from mj_manifest import ArchiveManifest
+from mj_storage import read_packed_job
+
+_log = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {"parquet": "parquet", "arrow": "arrow"} # Format -> file extension
+EXPORT_STATE_FILENAME = "_mj_export.json" # Leading underscore: ignored by dataset readers
+EXPORT_BATCH_ROWS = 10000
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Exporting requires the 'pyarrow' package: pip install pyarrow") from e
+    return pyarrow
+
+
+def export_schema(pa):
+    return pa.schema([
+        ("id", pa.string()),
+        ("enqueue_time", pa.timestamp("us")),
+        ("type", pa.string()),
+        ("prompt", pa.string()),
+        ("full_command", pa.string()),
+        ("parameters", pa.map_(pa.string(), pa.string())),
+        ("username", pa.string()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("parent_id", pa.string()),
+        ("image_count", pa.int32()),
+        ("image_paths", pa.list_(pa.string())),
+        ("metadata", pa.string()),
+    ])
+
+
+def parse_parameters(full_command: str | None) -> list[tuple[str, str]]:
+    """
+    The `--name value` parameters at the end of a full command, in order.
+    Flags without a value (`--tile`) get an empty value.
+    """
+    if not full_command:
+        return []
+    parameters = []
+    for part in f" {full_command}".split(" --")[1:]:
+        name, _, value = part.strip().partition(" ")
+        if name:
+            parameters.append((name.lower(), value.strip()))
+    return parameters
+
+
+def _int_or_none(value) -> int | None:
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def _str_or_none(value) -> str | None:
+    return value if isinstance(value, str) else None
+
+
+def job_row(job_info: dict, enqueue_time_dt: dt.datetime) -> dict:
+    image_paths = job_info.get("image_paths")
+    image_paths = [url for url in image_paths if isinstance(url, str)] if isinstance(image_paths, list) else []
+    return {
+        "id": job_info["id"],
+        "enqueue_time": enqueue_time_dt,
+        "type": _str_or_none(job_info.get("type")),
+        "prompt": _str_or_none(job_info.get("prompt")),
+        "full_command": _str_or_none(job_info.get("full_command")),
+        "parameters": parse_parameters(_str_or_none(job_info.get("full_command"))),
+        "username": _str_or_none(job_info.get("username")),
+        "width": _int_or_none(job_info.get("width")),
+        "height": _int_or_none(job_info.get("height")),
+        "parent_id": _str_or_none(job_info.get("parent_id")),
+        "image_count": len(image_paths),
+        "image_paths": image_paths,
+        "metadata": json.dumps(job_info, ensure_ascii=False, separators=(",", ":")),
+    }
+
+
+class MonthPartitionWriter:
+    """
+    Writes rows into one part file per month, buffering `batch_rows` rows at a time.
+    Part files are written under hidden names and only renamed into place by
+    `commit()`, so readers never see a half-written export.
+    """
+
+    def __init__(self, output_dir: Path, export_format: str, run_id: str, batch_rows: int = EXPORT_BATCH_ROWS):
+        self.pa = _import_pyarrow()
+        self.schema = export_schema(self.pa)
+        self.output_dir = output_dir
+        self.export_format = export_format
+        self.run_id = run_id
+        self.batch_rows = batch_rows
+        self.rows_written = collections.Counter() # Month -> rows
+        self._month: str | None = None
+        self._writer = None
+        self._rows: list[dict] = []
+        self._written: list[tuple[Path, Path]] = [] # (temporary path, final path)
+
+    def write(self, month: str, row: dict):
+        if month != self._month:
+            self._close_part()
+            self._open_part(month)
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_rows:
+            self._write_rows()
+
+    def _open_part(self, month: str):
+        partition_dir = self.output_dir / f"month={month}"
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        taken = {final_path for _, final_path in self._written}
+        number = 1
+        while True:
+            final_path = partition_dir / f"part-{self.run_id}-{number}.{EXPORT_FORMATS[self.export_format]}"
+            if final_path not in taken and not final_path.exists():
+                break
+            number += 1
+        temporary_path = partition_dir / f".{final_path.name}.tmp"
+        if self.export_format == "parquet":
+            self._writer = self.pa.parquet.ParquetWriter(temporary_path, self.schema, compression="zstd")
+        else:
+            self._writer = self.pa.ipc.new_file(str(temporary_path), self.schema)
+        self._written.append((temporary_path, final_path))
+        self._month = month
+
+    def _write_rows(self):
+        if self._rows:
+            self._writer.write_table(self.pa.Table.from_pylist(self._rows, schema=self.schema))
+            self.rows_written[self._month] += len(self._rows)
+            self._rows = []
+
+    def _close_part(self):
+        if self._writer is not None:
+            self._write_rows()
+            self._writer.close()
+            self._writer = None
+            self._month = None
+
+    def commit(self) -> list[Path]:
+        """
+        Finish the open part and move all parts into place. Returns their paths.
+        """
+        self._close_part()
+        for temporary_path, final_path in self._written:
+            os.replace(temporary_path, final_path)
+        return [final_path for _, final_path in self._written]
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for temporary_path, _ in self._written:
+            temporary_path.unlink(missing_ok=True)
+
+
+def _iter_archive_jobs(archive_root: Path):
+    """
+    `(job_info, source_path)` of all jobs in the archive, day by day.
+    """
+    for path in iter_job_files(archive_root, include_shards=True):
+        if is_shard_path(path):
+            try:
+                for entry in read_shard(path, archive_root):
+                    yield entry.job_info, path
+            except IOError as e:
+                _log.error(f"Error reading shard {path}: {e}")
+            continue
+        try:
+            job_info = json.loads(path.read_text(encoding="utf8"))
+        except (IOError, json.JSONDecodeError) as e:
+            _log.error(f"Error reading {path}: {e}")
+            continue
+        if isinstance(job_info, dict) and "id" in job_info:
+            yield job_info, path
+
+
+def _iter_unexported_jobs(manifest: ArchiveManifest, export_id: str):
+    """
+    `(job_info, source_path)` of the jobs of the manifest not exported by `export_id` yet.
+    """
+    for job_id, json_path in manifest.iter_unexported_jobs(export_id):
+        try:
+            job_info = read_packed_job(manifest, job_id)
+            if job_info is None:
+                job_info = json.loads(json_path.read_text(encoding="utf8"))
+        except (IOError, ValueError) as e:
+            _log.error(f"Error reading job {job_id} from {json_path}: {e}")
+            continue
+        if isinstance(job_info, dict) and "id" in job_info:
+            yield job_info, json_path
+
+
+def read_export_state(output_dir: Path) -> dict | None:
+    state_path = output_dir / EXPORT_STATE_FILENAME
+    if not state_path.exists():
+        return None
+    return json.loads(state_path.read_text(encoding="utf-8"))
+
+
+def _write_export_state(output_dir: Path, state: dict):
+    state_path = output_dir / EXPORT_STATE_FILENAME
+    temporary_path = state_path.with_name(f".{state_path.name}.tmp")
+    temporary_path.write_text(json.dumps(state, indent=2) + "\n", encoding="utf-8")
+    os.replace(temporary_path, state_path)
+
+
+def _existing_parts(output_dir: Path) -> list[Path]:
+    return sorted(
+        path for extension in EXPORT_FORMATS.values() for path in output_dir.glob(f"month=*/part-*.{extension}")
+    )
+
+
+def export_archive(
+    archive_root: Path,
+    output_dir: Path,
+    export_format: str = "parquet",
+    full: bool = False,
+    batch_rows: int = EXPORT_BATCH_ROWS,
+) -> collections.Counter:
+    """
+    Export the jobs archived since the previous export of `output_dir`, or all jobs
+    with `full`, which replaces the earlier part files once the new ones are complete.
+    Returns counts of exported and skipped jobs.
+    """
+    stats = collections.Counter()
+    previous_state = read_export_state(output_dir)
+    state = None if full else previous_state
+    if state is not None and state.get("format") != export_format:
+        raise ValueError(
+            f"{output_dir} holds a {state.get('format')} export; export with --full to replace it with {export_format}"
+        )
+
+    manifest = ArchiveManifest(archive_root)
+    try:
+        if manifest.is_empty():
+            manifest.rebuild()
+        if state is None:
+            export_id = uuid.uuid4().hex
+            jobs = _iter_archive_jobs(archive_root)
+            _log.info(f"Exporting all jobs to {output_dir}")
+        else:
+            export_id = state.get("export_id")
+            if export_id is None: # Written by an export that only kept the newest enqueue time
+                export_id = uuid.uuid4().hex
+                manifest.record_exported_until(export_id, state["last_enqueue_key"])
+            jobs = _iter_unexported_jobs(manifest, export_id)
+            _log.info(f"Exporting the jobs archived since the previous export to {output_dir}")
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        replaced_parts = _existing_parts(output_dir) if full else []
+        run_id = dt.datetime.now().strftime("%Y%m%dT%H%M%S")
+        writer = MonthPartitionWriter(output_dir, export_format, run_id, batch_rows)
+        exported_ids = [] # Also the unexportable jobs, so they are not read again
+        try:
+            for job_info, source_path in jobs:
+                exported_ids.append(job_info["id"])
+                enqueue_time_dt = parse_enqueue_time(job_info.get("enqueue_time"))
+                if enqueue_time_dt is None:
+                    _log.warning(f"Not exporting job {job_info['id']} from {source_path}: cannot parse enqueue_time")
+                    stats["skipped_unparsable_enqueue_time"] += 1
+                    continue
+                writer.write(enqueue_time_dt.strftime("%Y-%m"), job_row(job_info, enqueue_time_dt))
+                stats["exported_jobs"] += 1
+            parts = writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+        manifest.record_exported_jobs(export_id, exported_ids)
+        previous_id = (previous_state or {}).get("export_id")
+        if previous_id and previous_id != export_id:
+            manifest.forget_export(previous_id)
+    finally:
+        manifest.close()
+
+    for part in replaced_parts:
+        part.unlink(missing_ok=True)
+    _write_export_state(output_dir, {
+        "format": export_format,
+        "export_id": export_id,
+        "exported_jobs": (state or {}).get("exported_jobs", 0) + stats["exported_jobs"],
+        "updated": dt.datetime.now().isoformat(timespec="seconds"),
+    })
+    stats["part_files"] = len(parts)
+    _log.info(f"Exported {stats['exported_jobs']} jobs into {len(parts)} part files in {len(writer.rows_written)} months")
+    return stats
@@ -0,0 +1,874 @@
+"""
+SQLite manifest of the Midjourney archive.
+
+The manifest lives in the archive root and records, for every archived job,
+its id, enqueue_time, type, metadata file paths and the download state of its
+images. The images double as the downloader's persistent work queue: they are
+registered as pending when their metadata is written, and failed downloads
+keep their attempt count and last error until they are retried. The manifest
+lets the tools answer "what is the newest archived job?" and "is this job
+already archived?" with indexed queries instead of walking the tree.
+It also keeps the per-window checkpoints of partitioned crawls, so an
+interrupted backfill resumes where it stopped.
+
+Where SQLite has FTS5, the manifest also holds a full-text index of the jobs'
+`prompt`, `full_command` and type for ranked prompt search.
+"""
+
+import collections
+import datetime as dt
+import hashlib
+import itertools
+import json
+import logging
+import math
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from mj_archive import (
+    enqueue_sort_key,
+    image_download_path,
+    is_shard_path,
+    iter_job_files,
+    parse_enqueue_time,
+    read_shard,
+)
+
+_log = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".mj-manifest.sqlite3"
+
+IMAGE_STATE_PENDING = "pending"
+IMAGE_STATE_DONE = "done"
+IMAGE_STATE_FAILED = "failed"
+
+# Orders of the download queue: by the jobs' enqueue time, or in the order they were archived
+DOWNLOAD_ORDERS = ("newest", "oldest", "archived")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    enqueue_time TEXT NOT NULL,
+    enqueue_key TEXT NOT NULL,
+    type TEXT,
+    json_path TEXT NOT NULL,
+    prompt_path TEXT,
+    archived_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_enqueue_key ON jobs (enqueue_key);
+CREATE TABLE IF NOT EXISTS images (
+    job_id TEXT NOT NULL,
+    image_index INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    PRIMARY KEY (job_id, image_index)
+);
+CREATE INDEX IF NOT EXISTS images_state ON images (state);
+CREATE TABLE IF NOT EXISTS packed_index (
+    job_id TEXT PRIMARY KEY,
+    shard_path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_objects (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_urls (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_links (
+    path TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    method TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS derivatives (
+    path TEXT PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    source_size INTEGER NOT NULL,
+    source_mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_checks (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    error TEXT,
+    checked_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS crawl_windows (
+    job_type TEXT NOT NULL,
+    window_start TEXT NOT NULL,
+    window_end TEXT NOT NULL,
+    next_page INTEGER NOT NULL,
+    fetched INTEGER NOT NULL,
+    oldest TEXT,
+    PRIMARY KEY (job_type, window_start, window_end)
+);
+CREATE TABLE IF NOT EXISTS exported_jobs (
+    export_id TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    PRIMARY KEY (export_id, job_id)
+) WITHOUT ROWID;
+"""
+
+# Full-text index of the prompts. Its rowid is derived from the job id (see
+# `_search_rowid`), so a job is replaced without scanning the index.
+_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS prompt_search USING fts5 (
+    job_id UNINDEXED,
+    prompt,
+    full_command,
+    type
+);
+"""
+
+# bm25 column weights of prompt_search: a match in the prompt counts most
+_SEARCH_RANK = "bm25(prompt_search, 0.0, 4.0, 1.0, 0.5)"
+
+# Columns added to existing tables after their first release: table -> [(column, definition)]
+_ADDED_COLUMNS = {
+    "images": [("attempts", "INTEGER NOT NULL DEFAULT 0"), ("last_error", "TEXT")],
+}
+
+# A prompt search result; `snippet` is the matching part of the prompt with the hits in [brackets]
+SearchHit = collections.namedtuple("SearchHit", ["job_id", "enqueue_time", "type", "json_path", "snippet"])
+
+# An image waiting in the download queue; `attempts` counts its failed downloads
+QueuedImage = collections.namedtuple("QueuedImage", ["job_id", "image_index", "url", "path", "attempts"])
+
+# A downloaded image with the size and mtime (ns) it had when it was last verified, if it was
+DownloadedImage = collections.namedtuple(
+    "DownloadedImage", ["job_id", "image_index", "url", "path", "checked_size", "checked_mtime_ns"]
+)
+
+
+class KnownJobIds:
+    """
+    Bloom filter over the ids of the archived jobs, for dedupe during a crawl.
+    A miss means the job is certainly not archived. A hit is confirmed in the
+    manifest, so a false positive costs one query but never skips a new job.
+    """
+
+    def __init__(self, manifest: "ArchiveManifest", capacity: int, false_positive_rate: float = 0.01):
+        self._manifest = manifest
+        self._bit_count = max(64, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self._hash_count = max(1, round(self._bit_count / max(capacity, 1) * math.log(2)))
+        self._bits = bytearray((self._bit_count + 7) // 8)
+
+    def _positions(self, job_id: str) -> Iterator[int]:
+        digest = hashlib.blake2b(job_id.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self._bit_count for i in range(self._hash_count))
+
+    def add(self, job_id: str):
+        for position in self._positions(job_id):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, job_id: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(job_id))
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.might_contain(job_id) and self._manifest.has_job(job_id)
+
+
+def _now() -> str:
+    return dt.datetime.now().isoformat(timespec="seconds")
+
+
+def _search_rowid(job_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(job_id.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def _fts_phrase_query(query: str) -> str:
+    """
+    `query` with every word quoted, for input that is not valid FTS5 query syntax.
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class ArchiveManifest:
+    """
+    Thread-safe wrapper around the manifest database.
+
+    Writes are batched: they are committed every `commit_every` statements,
+    on `commit()` and on `close()`. Rebuilds run as a single transaction instead.
+    Paths are stored relative to the archive root.
+    """
+
+    def __init__(self, archive_root: Path, commit_every: int = 500):
+        self.archive_root = archive_root
+        self.path = archive_root / MANIFEST_FILENAME
+        self.commit_every = commit_every
+        self._lock = threading.RLock()
+        self._pending_writes = 0
+        self._in_transaction = False # Set while a rebuild holds back the batched commits
+        self._temporary_tables = itertools.count(1) # Numbers the sorted download queues
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._add_missing_columns()
+        try:
+            self._conn.executescript(_SEARCH_SCHEMA)
+            self.search_available = True
+        except sqlite3.OperationalError as e:
+            _log.warning(f"Prompt search is disabled, SQLite lacks FTS5: {e}")
+            self.search_available = False
+        self._conn.commit()
+
+    def _add_missing_columns(self):
+        for table, columns in _ADDED_COLUMNS.items():
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column, definition in columns:
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _relative(self, path: Path) -> str:
+        try:
+            return path.relative_to(self.archive_root).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+    def _execute_write(self, sql: str, params: tuple):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._pending_writes += 1
+            if self._pending_writes >= self.commit_every and not self._in_transaction:
+                self._conn.commit()
+                self._pending_writes = 0
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending_writes = 0
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the writes of the block as one transaction that is committed at its end
+        and rolled back on errors, so other readers and a crash never see it half done.
+        """
+        with self._lock:
+            self.commit()
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+            finally:
+                self._in_transaction = False
+                self._pending_writes = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM jobs LIMIT 1").fetchone() is None
+
+    def job_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def has_job(self, job_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone() is not None
+
+    def load_known_job_ids(self) -> KnownJobIds:
+        """
+        Bloom filter of the archived job ids, sized with room for the archive to double.
+        """
+        with self._lock:
+            known_job_ids = KnownJobIds(self, capacity=2 * self.job_count() + 10000)
+            for (job_id,) in self._conn.execute("SELECT id FROM jobs"):
+                known_job_ids.add(job_id)
+        return known_job_ids
+
+    def latest_enqueue_time(self) -> str | None:
+        """
+        `enqueue_time` of the newest archived job, as it was returned by the API.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT enqueue_time FROM jobs ORDER BY enqueue_key DESC LIMIT 1"
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_job(self, job_info: dict, json_path: Path, prompt_path: Path | None = None):
+        """
+        Add or update a job and register its images. Images that are already
+        known keep their download state.
+        """
+        job_id = job_info["id"]
+        enqueue_time = job_info["enqueue_time"]
+        enqueue_time_dt = parse_enqueue_time(enqueue_time)
+        if enqueue_time_dt is None:
+            _log.warning(f"Not adding job {job_id} to manifest: cannot parse enqueue_time '{enqueue_time}'")
+            return
+        with self._lock:
+            self._execute_write(
+                "INSERT OR REPLACE INTO jobs (id, enqueue_time, enqueue_key, type, json_path, prompt_path, archived_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    enqueue_time,
+                    enqueue_sort_key(enqueue_time_dt),
+                    job_info.get("type"),
+                    self._relative(json_path),
+                    self._relative(prompt_path) if prompt_path else None,
+                    _now(),
+                ),
+            )
+            self._index_prompt(job_info)
+            image_paths = job_info.get("image_paths")
+            if not isinstance(image_paths, list):
+                return
+            for i, image_url in enumerate(image_paths):
+                if not isinstance(image_url, str) or not image_url.startswith("http"):
+                    continue
+                download_path = image_download_path(json_path, image_url, i, len(image_paths))
+                if download_path is None:
+                    continue
+                # A known image keeps its download state and history, only its URL and path follow the metadata
+                self._execute_write(
+                    "INSERT INTO images (job_id, image_index, url, path, state, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (job_id, image_index) DO UPDATE SET url = excluded.url, path = excluded.path",
+                    (job_id, i, image_url, self._relative(download_path), IMAGE_STATE_PENDING, _now()),
+                )
+
+    def _index_prompt(self, job_info: dict):
+        if not self.search_available:
+            return
+        rowid = _search_rowid(job_info["id"])
+        with self._lock:
+            self._execute_write("DELETE FROM prompt_search WHERE rowid = ?", (rowid,))
+            self._execute_write(
+                "INSERT INTO prompt_search (rowid, job_id, prompt, full_command, type) VALUES (?, ?, ?, ?, ?)",
+                (
+                    rowid,
+                    job_info["id"],
+                    job_info.get("prompt") or "",
+                    job_info.get("full_command") or "",
+                    job_info.get("type") or "",
+                ),
+            )
+
+    def search_index_count(self) -> int:
+        if not self.search_available:
+            return 0
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM prompt_search").fetchone()[0]
+
+    def search_prompts(
+        self,
+        query: str,
+        since: dt.date | None = None,
+        until: dt.date | None = None,
+        job_types: set[str] | None = None,
+        limit: int = 20,
+    ) -> list[SearchHit]:
+        """
+        Jobs whose prompt, full command or type match an FTS5 `query`, best match first.
+        `since` and `until` are inclusive day bounds. Queries that are not valid FTS5
+        syntax are searched for as plain words.
+        """
+        if not self.search_available:
+            raise RuntimeError("Prompt search needs SQLite with the FTS5 extension")
+        conditions = ["prompt_search MATCH ?"]
+        params: list = []
+        if since:
+            conditions.append("jobs.enqueue_key >= ?")
+            params.append(since.isoformat())
+        if until:
+            conditions.append("jobs.enqueue_key < ?")
+            params.append((until + dt.timedelta(days=1)).isoformat())
+        if job_types:
+            conditions.append(f"jobs.type IN ({', '.join('?' * len(job_types))})")
+            params.extend(sorted(job_types))
+        sql = (
+            "SELECT jobs.id, jobs.enqueue_time, jobs.type, jobs.json_path, "
+            "snippet(prompt_search, 1, '[', ']', '...', 16) "
+            "FROM prompt_search JOIN jobs ON jobs.id = prompt_search.job_id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {_SEARCH_RANK} LIMIT ?"
+        )
+        with self._lock:
+            try:
+                rows = self._conn.execute(sql, [query, *params, limit]).fetchall()
+            except sqlite3.OperationalError:
+                rows = self._conn.execute(sql, [_fts_phrase_query(query), *params, limit]).fetchall()
+        return [SearchHit(job_id, enqueue_time, job_type, self.archive_root / json_path, snippet)
+                for job_id, enqueue_time, job_type, json_path, snippet in rows]
+
+    def set_image_state(self, job_id: str, image_index: int, url: str, path: Path, state: str, error: str | None = None):
+        """
+        Record the download state of an image. A failure counts as an attempt and
+        keeps its `error`; a successful download keeps the count of failed attempts.
+        """
+        failed = 1 if state == IMAGE_STATE_FAILED else 0
+        self._execute_write(
+            "INSERT INTO images (job_id, image_index, url, path, state, updated_at, attempts, last_error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (job_id, image_index) DO UPDATE SET url = excluded.url, path = excluded.path, "
+            "state = excluded.state, updated_at = excluded.updated_at, "
+            "attempts = images.attempts + excluded.attempts, last_error = excluded.last_error",
+            (job_id, image_index, url, self._relative(path), state, _now(), failed, error),
+        )
+
+    def image_state_counts(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT state, COUNT(*) FROM images GROUP BY state").fetchall())
+
+    def failed_image_count(self, min_attempts: int = 0) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM images WHERE state = ? AND attempts >= ?", (IMAGE_STATE_FAILED, min_attempts)
+            ).fetchone()[0]
+
+    def iter_queued_images(
+        self,
+        job_types: set[str] | None = None,
+        since: dt.date | None = None,
+        until: dt.date | None = None,
+        max_attempts: int | None = None,
+        order: str = "archived",
+        type_weights: dict[str, float] | None = None,
+        batch_size: int = 1000,
+    ) -> Iterator[QueuedImage]:
+        """
+        The download queue: pending images, then failed ones with fewer than `max_attempts`
+        attempts, of jobs of `job_types` enqueued between the inclusive days `since` and
+        `until`. Rows are read in batches, so the caller may update images meanwhile.
+
+        With `order` "newest" or "oldest", both parts are sorted by the enqueue time of
+        their jobs, failed images with fewer attempts first, and `type_weights` scale the
+        age of the jobs by type: with `{"upscale": 4}`, a four days old upscale ranks like
+        a one day old grid under "newest". "archived" keeps the order the images were
+        queued in, which needs no sort.
+        """
+        conditions = []
+        params: list = []
+        if since:
+            conditions.append("jobs.enqueue_key >= ?")
+            params.append(since.isoformat())
+        if until:
+            conditions.append("jobs.enqueue_key < ?")
+            params.append((until + dt.timedelta(days=1)).isoformat())
+        if job_types:
+            conditions.append(f"jobs.type IN ({', '.join('?' * len(job_types))})")
+            params.extend(sorted(job_types))
+        if order != "archived":
+            yield from self._iter_images_by_priority(conditions, params, max_attempts, order, type_weights, batch_size)
+            return
+        yield from self._iter_images_in_state(IMAGE_STATE_PENDING, conditions, params, batch_size)
+        if max_attempts is not None:
+            conditions.append("images.attempts < ?")
+            params.append(max_attempts)
+        yield from self._iter_images_in_state(IMAGE_STATE_FAILED, conditions, params, batch_size)
+
+    def _iter_images_in_state(self, state: str, conditions: list[str], params: list, batch_size: int):
+        # Paged by rowid, the order of the images_state index, so no batch needs a sort
+        sql = (
+            "SELECT images.rowid, images.job_id, images.image_index, images.url, images.path, images.attempts "
+            "FROM images JOIN jobs ON jobs.id = images.job_id "
+            f"WHERE {' AND '.join(['images.state = ?', 'images.rowid > ?', *conditions])} "
+            "ORDER BY images.rowid LIMIT ?"
+        )
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(sql, (state, last_rowid, *params, batch_size)).fetchall()
+            if not rows:
+                return
+            for rowid, job_id, image_index, url, path, attempts in rows:
+                yield QueuedImage(job_id, image_index, url, self.archive_root / path, attempts)
+            last_rowid = rows[-1][0]
+
+    def _iter_images_by_priority(
+        self,
+        conditions: list[str],
+        params: list,
+        max_attempts: int | None,
+        order: str,
+        type_weights: dict[str, float] | None,
+        batch_size: int,
+    ):
+        # The queue is sorted once into a temporary table and then paged by its rowid,
+        # instead of sorting what is left of the queue again for every batch
+        age = "(julianday(?) - julianday(jobs.enqueue_key))"
+        weights = sorted((type_weights or {}).items())
+        weight = f"(CASE jobs.type {' '.join('WHEN ? THEN ?' for _ in weights)} ELSE 1.0 END)" if weights else "1.0"
+        priority = f"{age} / {weight}" if order == "newest" else f"-({age} * {weight})"
+        failed_condition = "images.state = ?" if max_attempts is None else "(images.state = ? AND images.attempts < ?)"
+        table = f"download_order_{next(self._temporary_tables)}"
+        with self._lock:
+            self._conn.execute(f"CREATE TEMP TABLE {table} (image_rowid INTEGER NOT NULL)")
+            self._conn.execute(
+                f"INSERT INTO temp.{table} (image_rowid) "
+                "SELECT images.rowid FROM images JOIN jobs ON jobs.id = images.job_id "
+                f"WHERE {' AND '.join([f'(images.state = ? OR {failed_condition})', *conditions])} "
+                f"ORDER BY images.state = ?, images.attempts, {priority}, images.rowid",
+                (
+                    IMAGE_STATE_PENDING,
+                    IMAGE_STATE_FAILED,
+                    *(() if max_attempts is None else (max_attempts,)),
+                    *params,
+                    IMAGE_STATE_FAILED,
+                    dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                    *(value for item in weights for value in item),
+                ),
+            )
+        sql = (
+            "SELECT queue.rowid, images.job_id, images.image_index, images.url, images.path, images.attempts "
+            f"FROM temp.{table} AS queue JOIN images ON images.rowid = queue.image_rowid "
+            "WHERE queue.rowid > ? AND images.state IN (?, ?) ORDER BY queue.rowid LIMIT ?"
+        )
+        last_rowid = 0
+        try:
+            while True:
+                with self._lock:
+                    rows = self._conn.execute(
+                        sql, (last_rowid, IMAGE_STATE_PENDING, IMAGE_STATE_FAILED, batch_size)
+                    ).fetchall()
+                if not rows:
+                    return
+                for rowid, job_id, image_index, url, path, attempts in rows:
+                    yield QueuedImage(job_id, image_index, url, self.archive_root / path, attempts)
+                last_rowid = rows[-1][0]
+        finally:
+            with self._lock:
+                self._conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+
+    def forget_jobs(self, job_ids: list[str]):
+        """
+        Remove jobs (and their images) from the manifest, e.g. when writing them failed.
+        """
+        with self._lock:
+            for job_id in job_ids:
+                self._execute_write("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self._execute_write("DELETE FROM images WHERE job_id = ?", (job_id,))
+                self._execute_write("DELETE FROM packed_index WHERE job_id = ?", (job_id,))
+                if self.search_available:
+                    self._execute_write("DELETE FROM prompt_search WHERE rowid = ?", (_search_rowid(job_id),))
+
+    def set_packed_location(self, job_id: str, shard_path: Path, offset: int, length: int):
+        self._execute_write(
+            "INSERT OR REPLACE INTO packed_index (job_id, shard_path, offset, length) VALUES (?, ?, ?, ?)",
+            (job_id, self._relative(shard_path), offset, length),
+        )
+
+    def packed_location(self, job_id: str) -> tuple[Path, int, int] | None:
+        """
+        (shard path, byte offset, byte length) of a job stored in a packed shard.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT shard_path, offset, length FROM packed_index WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return self.archive_root / row[0], row[1], row[2]
+
+    def clear_packed_locations(self, shard_path: Path):
+        self._execute_write("DELETE FROM packed_index WHERE shard_path = ?", (self._relative(shard_path),))
+
+    def store_object_for_url(self, url: str) -> tuple[str, int, str] | None:
+        """
+        (sha256, size, path) of the content-addressed store object downloaded from `url`, if any.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT o.sha256, o.size, o.path FROM store_urls u JOIN store_objects o ON o.sha256 = u.sha256 "
+                "WHERE u.url = ?",
+                (url,),
+            ).fetchone()
+
+    def add_store_object(self, sha256: str, size: int, path: Path, url: str):
+        with self._lock:
+            self._execute_write(
+                "INSERT OR IGNORE INTO store_objects (sha256, size, path) VALUES (?, ?, ?)",
+                (sha256, size, self._relative(path)),
+            )
+            self._execute_write("INSERT OR REPLACE INTO store_urls (url, sha256) VALUES (?, ?)", (url, sha256))
+
+    def add_store_link(self, path: Path, sha256: str, method: str):
+        self._execute_write(
+            "INSERT OR REPLACE INTO store_links (path, sha256, method) VALUES (?, ?, ?)",
+            (self._relative(path), sha256, method),
+        )
+
+    def forget_store_object(self, path: Path) -> Path | None:
+        """
+        Drop the store object that `path` is linked to, with its URL mappings and
+        the link, so its URLs are downloaded again. Returns the object's path, or
+        None if `path` is not linked to the store.
+        """
+        relative_path = self._relative(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT o.sha256, o.path FROM store_links l JOIN store_objects o ON o.sha256 = l.sha256 WHERE l.path = ?",
+                (relative_path,),
+            ).fetchone()
+            self._execute_write("DELETE FROM store_links WHERE path = ?", (relative_path,))
+            if row is None:
+                return None
+            sha256, object_path = row
+            self._execute_write("DELETE FROM store_urls WHERE sha256 = ?", (sha256,))
+            self._execute_write("DELETE FROM store_objects WHERE sha256 = ?", (sha256,))
+        return self.archive_root / object_path
+
+    def store_report(self) -> dict:
+        """
+        Summary of the content-addressed store: object count and bytes stored once,
+        linked files and the bytes they would take as separate copies.
+        """
+        with self._lock:
+            objects, stored_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM store_objects"
+            ).fetchone()
+            links, linked_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(o.size), 0) FROM store_links l JOIN store_objects o ON o.sha256 = l.sha256"
+            ).fetchone()
+            urls = self._conn.execute("SELECT COUNT(*) FROM store_urls").fetchone()[0]
+            methods = dict(self._conn.execute("SELECT method, COUNT(*) FROM store_links GROUP BY method").fetchall())
+        return {
+            "objects": objects,
+            "urls": urls,
+            "stored_bytes": stored_bytes,
+            "linked_files": links,
+            "linked_bytes": linked_bytes,
+            "bytes_saved": max(0, linked_bytes - stored_bytes),
+            "link_methods": methods,
+        }
+
+    def downloaded_image_paths(self) -> list[Path]:
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM images WHERE state = ?", (IMAGE_STATE_DONE,)).fetchall()
+        return [self.archive_root / path for (path,) in rows]
+
+    def iter_downloaded_images(self, batch_size: int = 1000) -> Iterator[DownloadedImage]:
+        """
+        The images in the `done` state, with their last verification. Rows are read
+        in batches, so the caller may update images meanwhile.
+        """
+        sql = (
+            "SELECT images.rowid, images.job_id, images.image_index, images.url, images.path, "
+            "image_checks.size, image_checks.mtime_ns "
+            "FROM images LEFT JOIN image_checks ON image_checks.path = images.path "
+            "WHERE images.state = ? AND images.rowid > ? ORDER BY images.rowid LIMIT ?"
+        )
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(sql, (IMAGE_STATE_DONE, last_rowid, batch_size)).fetchall()
+            if not rows:
+                return
+            for rowid, job_id, image_index, url, path, checked_size, checked_mtime_ns in rows:
+                yield DownloadedImage(job_id, image_index, url, self.archive_root / path, checked_size, checked_mtime_ns)
+            last_rowid = rows[-1][0]
+
+    def record_image_check(self, path: Path, size: int, mtime_ns: int, sha256: str, error: str | None):
+        self._execute_write(
+            "INSERT OR REPLACE INTO image_checks (path, size, mtime_ns, sha256, error, checked_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self._relative(path), size, mtime_ns, sha256, error, _now()),
+        )
+
+    def forget_image_check(self, path: Path):
+        self._execute_write("DELETE FROM image_checks WHERE path = ?", (self._relative(path),))
+
+    def image_check_report(self) -> dict[str, int]:
+        """
+        Number of verified images and of those that failed verification.
+        """
+        with self._lock:
+            checked, failed = self._conn.execute(
+                "SELECT COUNT(*), COUNT(error) FROM image_checks"
+            ).fetchone()
+        return {"checked": checked, "failed": failed}
+
+    def iter_unexported_jobs(self, export_id: str, batch_size: int = 1000) -> Iterator[tuple[str, Path]]:
+        """
+        `(job_id, json_path)` of the jobs that export `export_id` has not exported yet,
+        whenever they were archived, in enqueue order so the jobs of a month come
+        together. Rows are read in batches after the last `(enqueue_key, id)`.
+        """
+        last_key, last_id = "", ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, json_path, enqueue_key FROM jobs WHERE (enqueue_key > ? OR (enqueue_key = ? AND id > ?)) "
+                    "AND NOT EXISTS (SELECT 1 FROM exported_jobs WHERE export_id = ? AND job_id = jobs.id) "
+                    "ORDER BY enqueue_key, id LIMIT ?",
+                    (last_key, last_key, last_id, export_id, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            for job_id, json_path, _ in rows:
+                yield job_id, self.archive_root / json_path
+            last_id, _, last_key = rows[-1]
+
+    def record_exported_jobs(self, export_id: str, job_ids: list[str]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO exported_jobs (export_id, job_id) VALUES (?, ?)",
+                ((export_id, job_id) for job_id in job_ids),
+            )
+            self.commit()
+
+    def record_exported_until(self, export_id: str, enqueue_key: str):
+        """
+        Mark the jobs enqueued up to `enqueue_key` as exported, for exports that
+        only remembered the newest exported enqueue time.
+        """
+        self._execute_write(
+            "INSERT OR IGNORE INTO exported_jobs (export_id, job_id) SELECT ?, id FROM jobs WHERE enqueue_key <= ?",
+            (export_id, enqueue_key),
+        )
+        self.commit()
+
+    def forget_export(self, export_id: str):
+        self._execute_write("DELETE FROM exported_jobs WHERE export_id = ?", (export_id,))
+        self.commit()
+
+    def derivative_source(self, path: Path) -> tuple[int, int] | None:
+        """
+        Size and mtime (ns) of the source image a derivative was created from.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT source_size, source_mtime_ns FROM derivatives WHERE path = ?", (self._relative(path),)
+            ).fetchone()
+
+    def record_derivative(self, path: Path, source_path: Path, source_size: int, source_mtime_ns: int):
+        self._execute_write(
+            "INSERT OR REPLACE INTO derivatives (path, source_path, source_size, source_mtime_ns) VALUES (?, ?, ?, ?)",
+            (self._relative(path), self._relative(source_path), source_size, source_mtime_ns),
+        )
+
+    def crawl_windows(self, job_type: str) -> list[tuple[str, str, int, int, str | None]]:
+        """
+        Unfinished windows of a partitioned crawl, as
+        `(window_start, window_end, next_page, fetched, oldest)`, newest first.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT window_start, window_end, next_page, fetched, oldest FROM crawl_windows "
+                "WHERE job_type = ? ORDER BY window_end DESC",
+                (job_type,),
+            ).fetchall()
+
+    def save_crawl_window(
+        self, job_type: str, window_start: str, window_end: str, next_page: int, fetched: int, oldest: str | None
+    ):
+        self._execute_write(
+            "INSERT OR REPLACE INTO crawl_windows (job_type, window_start, window_end, next_page, fetched, oldest) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (job_type, window_start, window_end, next_page, fetched, oldest),
+        )
+
+    def remove_crawl_window(self, job_type: str, window_start: str, window_end: str):
+        self._execute_write(
+            "DELETE FROM crawl_windows WHERE job_type = ? AND window_start = ? AND window_end = ?",
+            (job_type, window_start, window_end),
+        )
+
+    def _iter_archive_jobs(self) -> Iterator[tuple[dict, Path, Path | None, tuple[Path, int, int] | None]]:
+        """
+        Yield `(job_info, json_path, prompt_path, packed_location)` for every job under
+        the archive root. `packed_location` is the (shard, offset, length) of packed jobs.
+        """
+        for path in iter_job_files(self.archive_root, include_shards=True):
+            if is_shard_path(path):
+                try:
+                    for entry in read_shard(path, self.archive_root):
+                        yield entry.job_info, entry.job_path, None, (path, entry.offset, entry.length)
+                except OSError as e:
+                    _log.warning(f"Skipping {path}: {e}")
+                continue
+            try:
+                job_info = json.loads(path.read_text(encoding="utf8"))
+            except (json.JSONDecodeError, OSError) as e:
+                _log.warning(f"Skipping {path}: {e}")
+                continue
+            if not isinstance(job_info, dict) or "id" not in job_info or "enqueue_time" not in job_info:
+                _log.debug(f"Skipping {path}: not a job metadata file")
+                continue
+            prompt_path = path.with_name(f"{path.stem}.prompt.txt")
+            yield job_info, path, prompt_path if prompt_path.exists() else None, None
+
+    def rebuild(self) -> int:
+        """
+        Repopulate the manifest from the JSON metadata files and packed shards under
+        the archive root. Images found on disk are marked as downloaded, and downloaded
+        images missing on disk are queued again. Known images keep their attempts and
+        last error; only the images of jobs that are gone are removed.
+        Returns the number of jobs indexed.
+        """
+        _log.info(f"Rebuilding manifest {self.path} from {self.archive_root}")
+        indexed = 0
+        with self._transaction():
+            self._conn.execute("DELETE FROM jobs")
+            self._conn.execute("DELETE FROM packed_index")
+            if self.search_available:
+                self._conn.execute("DELETE FROM prompt_search")
+            for job_info, json_path, prompt_path, packed_location in self._iter_archive_jobs():
+                self._rebuild_job(job_info, json_path, prompt_path)
+                if packed_location is not None:
+                    self.set_packed_location(job_info["id"], *packed_location)
+                indexed += 1
+            self._execute_write("DELETE FROM images WHERE job_id NOT IN (SELECT id FROM jobs)", ())
+        _log.info(f"Manifest rebuilt with {indexed} jobs.")
+        return indexed
+
+    def rebuild_search_index(self) -> int:
+        """
+        Rebuild only the prompt search index from the metadata under the archive root,
+        leaving jobs and download states alone. Returns the number of jobs indexed.
+        """
+        if not self.search_available:
+            raise RuntimeError("Prompt search needs SQLite with the FTS5 extension")
+        _log.info(f"Building the prompt search index from {self.archive_root}")
+        indexed = 0
+        with self._transaction():
+            self._conn.execute("DELETE FROM prompt_search")
+            for job_info, _, _, _ in self._iter_archive_jobs():
+                self._index_prompt(job_info)
+                indexed += 1
+            self._conn.execute("INSERT INTO prompt_search (prompt_search) VALUES ('optimize')")
+        _log.info(f"Prompt search index built with {indexed} jobs.")
+        return indexed
+
+    def _rebuild_job(self, job_info: dict, json_path: Path, prompt_path: Path | None):
+        self.record_job(job_info, json_path, prompt_path)
+        image_paths = job_info.get("image_paths")
+        if isinstance(image_paths, list):
+            for i, image_url in enumerate(image_paths):
+                if not isinstance(image_url, str):
+                    continue
+                download_path = image_download_path(json_path, image_url, i, len(image_paths))
+                if download_path is None:
+                    continue
+                if download_path.exists():
+                    self.set_image_state(job_info["id"], i, image_url, download_path, IMAGE_STATE_DONE)
+                else:
+                    self._execute_write(
+                        "UPDATE images SET state = ?, updated_at = ? WHERE job_id = ? AND image_index = ? AND state = ?",
+                        (IMAGE_STATE_PENDING, _now(), job_info["id"], i, IMAGE_STATE_DONE),
+                    )
@@ -0,0 +1,211 @@
+"""
+Run metrics of the archiver and the downloader: request latency histograms per
+endpoint, HTTP status counts, bytes transferred, time spent per phase (JSON
+encoding, compression, file writes, mkdir, manifest commits) and queue depths.
+
+`METRICS` is shared by all modules of a process, like a logger. It only records
+anything once `enable()` has been called, i.e. when a tool was started with
+`--metrics-out`. At the end of the run `write_metrics` saves the metrics and the
+tool's final `stats` as a Prometheus textfile (for node exporter's textfile
+collector) or, for a `.json` path, as a JSON report.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+_log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Prometheus type and help text of every metric family
+METRIC_FAMILIES = {
+    "mj_request_duration_seconds": ("histogram", "Time until the response headers arrived, per request attempt."),
+    "mj_http_responses_total": ("counter", "Request attempts by HTTP status; 'error' for connection failures and timeouts."),
+    "mj_transferred_bytes_total": ("counter", "Response body bytes received."),
+    "mj_phase_duration_seconds": ("histogram", "Time spent per phase of archiving and downloading."),
+    "mj_queue_depth": ("histogram", "Items waiting in a queue, sampled whenever one is added."),
+    "mj_stat": ("gauge", "Final value of a counter of the run's stats."),
+    "mj_run_duration_seconds": ("gauge", "Wall time of the run."),
+    "mj_run_timestamp_seconds": ("gauge", "Unix time at which the run ended."),
+    "mj_run_exit_status": ("gauge", "Exit status of the run; 0 on success."),
+}
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip([*map(_format_value, self.buckets), "+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, keyed by name and labels.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[tuple[str, tuple], _Histogram] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def count(self, name: str, amount: float = 1, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time_phase(self, phase: str):
+        """
+        Record the wall time of the block in `mj_phase_duration_seconds`.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("mj_phase_duration_seconds", time.perf_counter() - start, phase=phase)
+
+    def observe_queue_depth(self, queue_name: str, depth: int):
+        self.observe("mj_queue_depth", depth, buckets=DEPTH_BUCKETS, queue=queue_name)
+
+    def prometheus_text(self, extra_labels: dict[str, str] | None = None, gauges: list | None = None) -> str:
+        """
+        The metrics in the Prometheus text exposition format. `gauges` are additional
+        `(name, labels, value)` samples; `extra_labels` are added to every sample.
+        """
+        extra = tuple(sorted((extra_labels or {}).items()))
+        samples: dict[str, list[str]] = {}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                samples.setdefault(name, []).append(f"{name}{_labels_text(labels + extra)} {_format_value(value)}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                lines = samples.setdefault(name, [])
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{name}_bucket{_labels_text(labels + extra + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{_labels_text(labels + extra)} {_format_value(histogram.sum)}")
+                lines.append(f"{name}_count{_labels_text(labels + extra)} {histogram.count}")
+        for name, labels, value in gauges or []:
+            samples.setdefault(name, []).append(
+                f"{name}{_labels_text(tuple(sorted(labels.items())) + extra)} {_format_value(value)}"
+            )
+        text = []
+        for name, lines in samples.items():
+            metric_type, help_text = METRIC_FAMILIES.get(name, ("untyped", name))
+            text.append(f"# HELP {name} {help_text}")
+            text.append(f"# TYPE {name} {metric_type}")
+            text.extend(lines)
+        return "\n".join(text) + "\n"
+
+    def report(self) -> dict:
+        """
+        The metrics as plain data for a JSON report.
+        """
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(histogram.cumulative()),
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+
+METRICS = Metrics()
+
+
+def write_metrics(path: Path, tool: str, stats: dict, started: float, exit_status: int):
+    """
+    Write the run's metrics and final `stats` to `path`: a JSON report if it ends
+    with `.json`, a Prometheus textfile otherwise. The file is replaced atomically,
+    so a collector never reads half of it.
+    """
+    ended = time.time()
+    if path.suffix == ".json":
+        content = json.dumps({
+            "tool": tool,
+            "started": started,
+            "ended": ended,
+            "duration_seconds": ended - started,
+            "exit_status": exit_status,
+            "stats": dict(stats),
+            **METRICS.report(),
+        }, indent=2) + "\n"
+    else:
+        gauges = [("mj_stat", {"name": key}, value) for key, value in sorted(stats.items())]
+        gauges += [
+            ("mj_run_duration_seconds", {}, ended - started),
+            ("mj_run_timestamp_seconds", {}, ended),
+            ("mj_run_exit_status", {}, exit_status),
+        ]
+        content = METRICS.prometheus_text({"tool": tool}, gauges)
+    temporary_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path.write_text(content, encoding="utf-8")
+        os.replace(temporary_path, path)
+    except OSError as e:
+        _log.error(f"Could not write metrics to {path}: {e}")
+        temporary_path.unlink(missing_ok=True)
+        return
+    _log.info(f"Metrics written to {path}")
@@ -0,0 +1,147 @@
+"""
+Profiling of archiver and downloader runs (`--profile`, `--trace-memory`).
+
+A `RunProfiler` collects, for one run:
+- `profile.pstats`/`profile.txt`: cProfile statistics of all threads, for
+  `python -m pstats`, snakeviz and the like, and the top functions as text
+- `memory.txt`: the top allocators from tracemalloc and the peak traced memory
+- `stages.txt`: calls, wall time and CPU time of the instrumented methods, e.g.
+  `request_recent_jobs`, `archive_job_info`, `download_from_metadata_file` and
+  `download_url`; stages that call each other are timed inclusively
+
+Everything is written to a timestamped directory, ready to attach to a bug report.
+"""
+
+import cProfile
+import datetime as dt
+import functools
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+_log = logging.getLogger(__name__)
+
+PROFILE_TOP_FUNCTIONS = 60
+MEMORY_TOP_ALLOCATORS = 30
+TRACEMALLOC_FRAMES = 10
+
+
+class RunProfiler:
+    def __init__(self, output_root: Path, tool: str, profile: bool = False, trace_memory: bool = False):
+        self.output_dir = output_root / f"{tool}-{dt.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self._profiles: list[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        # Stage name -> [calls, wall seconds, CPU seconds, longest call in seconds]
+        self._stages: dict[str, list] = {}
+
+    def _start_thread_profile(self, frame, event, arg):
+        # Installed with threading.setprofile: runs once in every new thread and
+        # replaces itself with a profiler of that thread
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.profile:
+            profile = cProfile.Profile()
+            self._profiles.append(profile)
+            if sys.version_info < (3, 12):
+                # Before 3.12, a profiler only sees the thread that enabled it
+                threading.setprofile(self._start_thread_profile)
+            profile.enable()
+        _log.info(f"Profiling this run into {self.output_dir}")
+
+    def instrument(self, obj, *method_names: str):
+        """
+        Time every call of the named methods of `obj`, by wrapping them on the instance.
+        """
+        for method_name in method_names:
+            setattr(obj, method_name, self._timed(method_name, getattr(obj, method_name)))
+
+    def _timed(self, stage: str, method):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall_start
+                cpu = time.thread_time() - cpu_start
+                with self._lock:
+                    totals = self._stages.setdefault(stage, [0, 0.0, 0.0, 0.0])
+                    totals[0] += 1
+                    totals[1] += wall
+                    totals[2] += cpu
+                    totals[3] = max(totals[3], wall)
+        return timed
+
+    def stop(self):
+        """
+        Stop collecting and write the results. Call after the worker threads have finished.
+        """
+        if self.profile:
+            threading.setprofile(None)
+            self._profiles[0].disable()
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            if self.profile:
+                self._write_profile()
+            if self.trace_memory:
+                self._write_memory()
+            self._write_stages()
+        except OSError as e:
+            _log.error(f"Could not write the profile to {self.output_dir}: {e}")
+            return
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+        _log.info(f"Profile written to {self.output_dir}")
+
+    def _write_profile(self):
+        stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(self.output_dir / "profile.pstats")
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP_FUNCTIONS)
+        (self.output_dir / "profile.txt").write_text(text.getvalue(), encoding="utf-8")
+
+    def _write_memory(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Traced memory at the end: {current / 1e6:.1f} MB, peak: {peak / 1e6:.1f} MB",
+            "",
+            f"Top {MEMORY_TOP_ALLOCATORS} allocating lines:",
+        ]
+        lines += [str(statistic) for statistic in snapshot.statistics("lineno")[:MEMORY_TOP_ALLOCATORS]]
+        lines += ["", "Tracebacks of the top 5 allocators:"]
+        for statistic in snapshot.statistics("traceback")[:5]:
+            lines.append(f"{statistic.count} blocks, {statistic.size / 1e3:.1f} kB")
+            lines += [f"    {line}" for line in statistic.traceback.format()]
+        (self.output_dir / "memory.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    def _write_stages(self):
+        lines = [f"{'Stage':<28} {'Calls':>8} {'Wall s':>10} {'CPU s':>10} {'Mean ms':>9} {'Max ms':>9}"]
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda item: -item[1][1])
+        for stage, (calls, wall, cpu, longest) in stages:
+            lines.append(
+                f"{stage:<28} {calls:>8} {wall:>10.3f} {cpu:>10.3f} {wall / calls * 1000:>9.2f} {longest * 1000:>9.2f}"
+            )
+        (self.output_dir / "stages.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
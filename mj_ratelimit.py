@@ -0,0 +1,449 @@
+"""
+Adaptive concurrency control and retries for requests to the Midjourney API
+and the image CDN.
+
+An `AdaptiveLimiter` caps the number of requests in flight to one host and
+adjusts the cap with AIMD: every successful response raises it by about one per
+round of requests, while throttling (429), server errors (5xx), connection
+failures and responses much slower than usual halve it. A `Retry-After` pauses
+all requests to the host until it has passed. `request_with_retries` retries a
+request through a limiter with jittered exponential backoff.
+
+A `TokenBucket` is a budget of requests or bytes per second. Limiter slots and
+budget tokens are handed out round robin between clients (e.g. accounts), so a
+client with a long backlog cannot starve the others. A `SharedTransport` holds
+one keep-alive session, the limiters and the budgets that the archivers and
+downloaders of several accounts share. A `RateSchedule` changes the rate of a
+budget by time of day, e.g. to download faster at night.
+"""
+
+import collections
+import datetime as dt
+import email.utils
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from mj_metrics import METRICS
+
+_log = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# At most one decrease per this many seconds, so a burst of errors from requests
+# that were all sent at the old limit only halves it once
+DECREASE_INTERVAL = 1.0
+# Latency samples needed before slow responses count as congestion
+LATENCY_WARMUP_SAMPLES = 10
+LATENCY_EWMA_WEIGHT = 0.2
+# Lets the latency floor follow a lasting change of the service's latency
+LATENCY_FLOOR_DRIFT = 0.001
+# How often a scheduled budget looks up its rate for the time of day, in seconds
+SCHEDULE_CHECK_INTERVAL = 10.0
+
+
+class FairTurns:
+    """
+    Round-robin order of the threads waiting for a shared resource: the oldest
+    waiter of the client whose turn it is goes next, and that client then moves
+    to the back of the line. Only use it under the lock of the resource.
+    """
+
+    def __init__(self):
+        self._clients = collections.deque()
+        self._waiters: dict[object, collections.deque] = {}
+
+    def join(self, client) -> object:
+        ticket = object()
+        waiters = self._waiters.setdefault(client, collections.deque())
+        if not waiters:
+            self._clients.append(client)
+        waiters.append(ticket)
+        return ticket
+
+    def is_next(self, client, ticket: object) -> bool:
+        return self._clients[0] == client and self._waiters[client][0] is ticket
+
+    def leave(self, client, ticket: object):
+        waiters = self._waiters[client]
+        waiters.remove(ticket)
+        self._clients.remove(client)
+        if waiters:
+            self._clients.append(client)
+        else:
+            del self._waiters[client]
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for the requests to one host, shared by all threads
+    that send them. Hold a `slot()` for the whole of a request, including
+    reading a streamed body; waiting `client`s get slots in turn. `stats`
+    counts retries, throttled responses, errors and limit decreases.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        min_concurrency: int = 1,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 3.0,
+    ):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.stats = collections.Counter()
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._resume_at = 0.0
+        self._last_decrease = 0.0
+        self._latency_samples = 0
+        self._latency_ewma: float | None = None
+        self._latency_floor: float | None = None
+        self._condition = threading.Condition()
+        self._turns = FairTurns()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_concurrency, int(self._limit))
+
+    @contextmanager
+    def slot(self, client=None):
+        with self._condition:
+            ticket = self._turns.join(client)
+            try:
+                while self._in_flight >= self.limit or not self._turns.is_next(client, ticket):
+                    self._condition.wait()
+                self._in_flight += 1
+            finally:
+                self._turns.leave(client, ticket)
+                self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def count(self, key: str, amount: int = 1):
+        with self._condition:
+            self.stats[key] += amount
+
+    def wait_until_resumed(self):
+        """
+        Sleep while requests to the host are paused by a `Retry-After`.
+        """
+        while True:
+            with self._condition:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def on_success(self, latency: float):
+        with self._condition:
+            self._latency_samples += 1
+            if self._latency_ewma is None:
+                self._latency_ewma = latency
+            else:
+                self._latency_ewma += LATENCY_EWMA_WEIGHT * (latency - self._latency_ewma)
+            if self._latency_floor is None:
+                self._latency_floor = self._latency_ewma
+            else:
+                self._latency_floor = min(self._latency_ewma, self._latency_floor * (1 + LATENCY_FLOOR_DRIFT))
+            if (
+                self._latency_samples > LATENCY_WARMUP_SAMPLES
+                and self._latency_ewma > self._latency_floor * self.latency_tolerance
+            ):
+                self._decrease(f"responses slowed down to {self._latency_ewma:.2f}s")
+                return
+            self._limit = min(float(self.max_concurrency), self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def on_throttled(self, pause: float):
+        with self._condition:
+            self.stats["throttled_responses"] += 1
+            self._resume_at = max(self._resume_at, time.monotonic() + pause)
+            self._decrease(f"throttled, pausing for {pause:.1f}s")
+
+    def on_error(self, reason: str):
+        with self._condition:
+            self.stats["request_errors"] += 1
+            self._decrease(reason)
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_INTERVAL:
+            return
+        self._last_decrease = now
+        old_limit = self.limit
+        self._limit = max(float(self.min_concurrency), self._limit * self.decrease_factor)
+        self.stats["concurrency_decreases"] += 1
+        _log.info(f"{self.name}: {reason}; concurrency {old_limit} -> {self.limit}")
+
+
+class TokenBucket:
+    """
+    Budget of `rate` units (requests or bytes) per second, shared by all threads
+    that take from it, with bursts of up to `burst` units (one second's worth by
+    default). Waiting `client`s take turns. A take larger than the burst drives
+    the bucket into debt, so bytes can be taken after they were received. A rate
+    of 0 is unlimited. With a `schedule`, the rate follows the time of day.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float | None = None, schedule: "RateSchedule | None" = None):
+        self.name = name
+        self.schedule = schedule
+        self.stats = collections.Counter()
+        self._fixed_burst = burst
+        self._condition = threading.Condition()
+        self._turns = FairTurns()
+        self._updated = time.monotonic()
+        self._schedule_checked = self._updated
+        self.rate = schedule.rate_at(dt.datetime.now().time()) if schedule else rate
+        self.burst = max(1.0, burst if burst is not None else self.rate)
+        self._tokens = self.burst
+
+    def set_rate(self, rate: float):
+        with self._condition:
+            self._refill()
+            if rate and not self.rate:
+                self._tokens = float("inf") # Refilled to the burst below, nothing was owed while unlimited
+            self.rate = rate
+            self.burst = max(1.0, self._fixed_burst if self._fixed_burst is not None else rate)
+            self._tokens = min(self.burst, self._tokens)
+            self._condition.notify_all()
+        _log.info(f"The {self.name} budget is now {rate:g}/s" if rate else f"The {self.name} budget is now unlimited")
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _check_schedule(self):
+        # Called with the condition held, which is reentrant for set_rate
+        now = time.monotonic()
+        if self.schedule is None or now - self._schedule_checked < SCHEDULE_CHECK_INTERVAL:
+            return
+        self._schedule_checked = now
+        rate = self.schedule.rate_at(dt.datetime.now().time())
+        if rate != self.rate:
+            self.set_rate(rate)
+
+    def take(self, amount: float = 1.0, client=None):
+        with self._condition:
+            self._check_schedule()
+            if not self.rate:
+                return
+            ticket = self._turns.join(client)
+            waited = False
+            try:
+                while True:
+                    self._check_schedule()
+                    self._refill()
+                    if not self.rate:
+                        break
+                    if self._turns.is_next(client, ticket):
+                        missing = min(amount, self.burst) - self._tokens
+                        if missing <= 0:
+                            break
+                        timeout = missing / self.rate
+                        self._condition.wait(min(timeout, SCHEDULE_CHECK_INTERVAL) if self.schedule else timeout)
+                    else:
+                        self._condition.wait()
+                    waited = True
+                self._tokens -= amount
+            finally:
+                self._turns.leave(client, ticket)
+                self._condition.notify_all()
+            if waited:
+                self.stats[f"{self.name}_budget_waits"] += 1
+
+
+class SharedTransport:
+    """
+    Connections and limits shared by the archivers and downloaders of several
+    accounts: one keep-alive session, one `AdaptiveLimiter` for all API requests,
+    one per image host for all downloads, and optional budgets of requests per
+    second (every attempt, API and images) and bytes per second.
+    """
+
+    def __init__(
+        self,
+        api_concurrency: int,
+        download_concurrency: int,
+        requests_per_second: float | None = None,
+        bytes_per_second: float | None = None,
+        bandwidth_schedule: "RateSchedule | None" = None,
+    ):
+        self.download_concurrency = max(1, download_concurrency)
+        self.session = requests.Session()
+        # Room for every request in flight, also when the API and the images share a host
+        adapter = HTTPAdapter(pool_maxsize=max(1, api_concurrency) + self.download_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.api_limiter = AdaptiveLimiter("API", max_concurrency=api_concurrency)
+        self.request_budget = TokenBucket("request", requests_per_second) if requests_per_second else None
+        self.bandwidth_budget = (
+            TokenBucket("bandwidth", bytes_per_second or 0, schedule=bandwidth_schedule)
+            if bytes_per_second or bandwidth_schedule
+            else None
+        )
+        self._download_limiters: dict[str, AdaptiveLimiter] = {}
+        self._lock = threading.Lock()
+
+    def download_limiter(self, host: str) -> AdaptiveLimiter:
+        with self._lock:
+            limiter = self._download_limiters.get(host)
+            if limiter is None:
+                limiter = self._download_limiters[host] = AdaptiveLimiter(host, max_concurrency=self.download_concurrency)
+            return limiter
+
+    def stats(self) -> collections.Counter:
+        """
+        Retries, throttling and budget waits of all accounts together.
+        """
+        stats = collections.Counter(self.api_limiter.stats)
+        with self._lock:
+            for limiter in self._download_limiters.values():
+                stats.update(limiter.stats)
+        for budget in (self.request_budget, self.bandwidth_budget):
+            if budget is not None:
+                stats.update(budget.stats)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+def parse_byte_rate(value: str) -> float:
+    """
+    Parse a number of bytes per second with an optional k, M or G suffix (powers of 1000), e.g. "2.5M".
+    """
+    value = value.strip()
+    multiplier = {"k": 1e3, "m": 1e6, "g": 1e9}.get(value[-1:].lower(), 1)
+    if multiplier != 1:
+        value = value[:-1]
+    rate = float(value) * multiplier
+    if rate < 0:
+        raise ValueError(f"Rate must not be negative, got '{value}'")
+    return rate
+
+
+class RateSchedule:
+    """
+    Rates by time of day, parsed from a spec like "09:00-18:00=1M,22:00-06:00=20M":
+    comma-separated local time ranges, which may wrap around midnight, each with a
+    rate in the format of `parse_byte_rate` (0 is unlimited). The first range that
+    contains a time wins; `default_rate` applies outside all ranges.
+    """
+
+    def __init__(self, spec: str, default_rate: float):
+        self.spec = spec
+        self.default_rate = default_rate
+        self.ranges: list[tuple[dt.time, dt.time, float]] = []
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                times, rate = part.split("=")
+                start, end = (dt.time.fromisoformat(t.strip()) for t in times.split("-"))
+                self.ranges.append((start, end, parse_byte_rate(rate)))
+            except ValueError as e:
+                raise ValueError(f"Invalid schedule entry '{part}', expected e.g. '22:00-06:00=20M': {e}") from e
+            if start == end:
+                raise ValueError(f"Invalid schedule entry '{part}': the range is empty")
+        if not self.ranges:
+            raise ValueError(f"Empty schedule '{spec}'")
+
+    def rate_at(self, moment: dt.time) -> float:
+        for start, end, rate in self.ranges:
+            if (start <= moment < end) if start < end else (moment >= start or moment < end):
+                return rate
+        return self.default_rate
+
+
+def retry_after_seconds(response: requests.Response) -> float | None:
+    """
+    The `Retry-After` of a response in seconds; it is either a number of seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After", "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+def request_with_retries(
+    session: requests.Session,
+    url: str,
+    limiter: AdaptiveLimiter,
+    max_retries: int = 5,
+    backoff_base: float = 1.0,
+    backoff_cap: float = 60.0,
+    budget: TokenBucket | None = None,
+    client=None,
+    **kwargs,
+) -> requests.Response:
+    """
+    GET `url`, retrying throttled (429), failed (5xx) and unanswered requests up to
+    `max_retries` times. Waits for `Retry-After` where the server sends one, and
+    otherwise for a random time of up to `backoff_base * 2 ** attempt` seconds.
+    Every attempt takes a token of `budget` as `client`, if given.
+    The caller should hold a slot of `limiter`. Returns the last response, whose
+    status the caller still has to check; connection errors of the last attempt are raised.
+    """
+    attempt = 0
+    while True:
+        limiter.wait_until_resumed()
+        if budget is not None:
+            budget.take(1, client)
+        backoff = random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+        start = time.perf_counter()
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            METRICS.observe("mj_request_duration_seconds", time.perf_counter() - start, endpoint=limiter.name)
+            METRICS.count("mj_http_responses_total", endpoint=limiter.name, status="error")
+            limiter.on_error(f"request failed: {e.__class__.__name__}")
+            if attempt >= max_retries:
+                raise
+            _log.warning(f"Request to {url} failed: {e}. Retrying in {backoff:.1f}s.")
+            time.sleep(backoff)
+        else:
+            METRICS.observe("mj_request_duration_seconds", time.perf_counter() - start, endpoint=limiter.name)
+            METRICS.count("mj_http_responses_total", endpoint=limiter.name, status=str(response.status_code))
+            if response.status_code not in RETRY_STATUS_CODES:
+                limiter.on_success(response.elapsed.total_seconds())
+                return response
+            retry_after = retry_after_seconds(response)
+            if response.status_code == 429 or retry_after is not None:
+                limiter.on_throttled(retry_after if retry_after is not None else backoff)
+            else:
+                limiter.on_error(f"HTTP {response.status_code}")
+            if attempt >= max_retries:
+                return response
+            response.close()
+            if retry_after is None and response.status_code != 429:
+                _log.warning(f"{url} answered HTTP {response.status_code}. Retrying in {backoff:.1f}s.")
+                time.sleep(backoff)
+            else:
+                _log.warning(f"{url} answered HTTP {response.status_code}. Retrying when the pause ends.")
+        attempt += 1
+        limiter.count("retried_requests")
@@ -0,0 +1,124 @@
+"""
+Reformatting of the per-file metadata already in the archive.
+
+`--json-indent` and the layout of the prompt text files only apply to jobs as
+they are archived. `reformat_archive` rewrites every `.json` and `.prompt.txt`
+file from the JSON document on disk, without any API request, as the archiver
+would write it today. Day folders are processed in batches by a process pool;
+a file is only replaced, atomically, if its content changes.
+
+Packed shards are left alone: their JSON lines are always compact, and
+`mj-archive-tool.py convert` re-renders their prompts.
+"""
+
+import collections
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from mj_archive import import_script, iter_job_files
+
+_log = logging.getLogger(__name__)
+
+REFORMAT_BATCH_FILES = 256
+
+# Stats keys that make the reformat exit with an error code
+REFORMAT_ERROR_STATS = ("error_file_read", "error_json_decode", "error_file_write")
+
+
+def _write_atomically(path: Path, text: str):
+    temporary_path = path.with_name(f".{path.name}.{os.getpid()}.tmp") # Hidden from the archive walker
+    try:
+        with temporary_path.open("w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temporary_path, path)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+
+def _read_text(path: Path) -> str | None:
+    try:
+        return path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+def reformat_job_files(json_paths: list[str], json_indent: int | None) -> collections.Counter:
+    """
+    Rewrite the JSON and prompt text files of the given jobs where their content
+    differs from what the archiver would write. Runs in a worker process.
+    """
+    render_prompt = import_script("mj-metadata-archiver.py").MidjourneyMetadataArchiver.render_prompt_text
+    stats = collections.Counter()
+    for json_path in map(Path, json_paths):
+        try:
+            json_text = json_path.read_text(encoding="utf-8")
+            job_info = json.loads(json_text)
+        except json.JSONDecodeError as e:
+            _log.error(f"Not reformatting {json_path}: {e}")
+            stats["error_json_decode"] += 1
+            continue
+        except OSError as e:
+            _log.error(f"Not reformatting {json_path}: {e}")
+            stats["error_file_read"] += 1
+            continue
+        if not isinstance(job_info, dict) or "id" not in job_info:
+            stats["skipped_not_a_job"] += 1
+            continue
+        prompt_path = json_path.with_name(f"{json_path.stem}.prompt.txt")
+        outputs = (
+            (json_path, json_text, json.dumps(job_info, indent=json_indent), "json"),
+            (prompt_path, None, render_prompt(job_info), "prompt"),
+        )
+        for path, current_text, new_text, kind in outputs:
+            try:
+                if current_text is None:
+                    current_text = _read_text(path)
+                if current_text == new_text:
+                    stats[f"unchanged_{kind}"] += 1
+                    continue
+                _write_atomically(path, new_text)
+                stats[f"rewritten_{kind}"] += 1
+            except OSError as e:
+                _log.error(f"Error reformatting {path}: {e}")
+                stats["error_file_write"] += 1
+    return stats
+
+
+def reformat_archive(archive_root: Path, json_indent: int | None, workers: int | None = None) -> collections.Counter:
+    """
+    Reformat the JSON and prompt text files of all jobs in the per-file layout,
+    with `workers` processes (one per CPU by default). Returns the combined stats.
+    """
+    workers = workers or os.cpu_count() or 1
+    stats = collections.Counter()
+    in_flight: set[Future] = set()
+
+    def collect(done: set[Future]):
+        for future in done:
+            stats.update(future.result())
+        in_flight.difference_update(done)
+
+    _log.info(f"Reformatting the metadata files in {archive_root} with {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        batch: list[str] = []
+        for path in iter_job_files(archive_root, include_shards=True):
+            if path.suffix != ".json":
+                stats["skipped_shards"] += 1
+                continue
+            batch.append(str(path))
+            if len(batch) < REFORMAT_BATCH_FILES:
+                continue
+            if len(in_flight) >= workers * 2: # Don't walk far ahead of the workers
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            in_flight.add(executor.submit(reformat_job_files, batch, json_indent))
+            batch = []
+        if batch:
+            in_flight.add(executor.submit(reformat_job_files, batch, json_indent))
+        collect(wait(in_flight).done)
+    if stats["skipped_shards"]:
+        _log.info(f"Skipped {stats['skipped_shards']} packed shards; 'convert' re-renders their prompts.")
+    return stats
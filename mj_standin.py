@@ -0,0 +1,245 @@
+"""
+Local stand-in for the Midjourney `recent-jobs` API and the image CDN, used by
+`mj-benchmark.py` to measure the tools without touching the live services.
+
+The archive is synthetic and deterministic: job `i` is enqueued `job_interval`
+after job `i - 1`, every third job is a grid with four images and the others
+are upscales with one image. The listing mimics the API: newest first, paged by
+`amount`/`page`, filtered by `fromDate` and `jobType`, and terminated by
+`[{"msg": "No jobs found."}]`, optionally after `listing_cap` jobs like the
+real API's cap of about 2500 jobs per `fromDate`. Listing pages carry an `ETag` and
+are answered with 304 to a matching `If-None-Match`, to exercise the archiver's
+response cache. Images are served with `Content-Length` and
+support `Range` requests, so resumed downloads can be exercised as well.
+A share of the requests can be answered with 429 (with `Retry-After`) or 503
+to exercise retries and throttling.
+"""
+
+import bisect
+import collections
+import datetime as dt
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+_log = logging.getLogger(__name__)
+
+STANDIN_START_TIME = dt.datetime(2022, 1, 1)
+NO_JOBS_FOUND = [{"msg": "No jobs found."}]
+GRID_IMAGE_COUNT = 4
+
+
+class StandInArchive:
+    """
+    The synthetic jobs served by the stand-in, generated on demand from their index.
+    """
+
+    def __init__(
+        self,
+        job_count: int,
+        job_interval: dt.timedelta = dt.timedelta(minutes=5),
+        listing_cap: int | None = None,
+    ):
+        self.job_count = job_count
+        self.job_interval = job_interval
+        self.listing_cap = listing_cap
+        # Indexes of the jobs of each type, oldest first, for filtering by jobType
+        self._indexes_by_type = {"all": range(job_count)}
+        for job_type in ("grid", "upscale"):
+            self._indexes_by_type[job_type] = [i for i in range(job_count) if self.job_type(i) == job_type]
+
+    @staticmethod
+    def job_type(index: int) -> str:
+        return "grid" if index % 3 == 0 else "upscale"
+
+    def enqueue_time(self, index: int) -> dt.datetime:
+        return STANDIN_START_TIME + index * self.job_interval
+
+    def image_count(self, index: int) -> int:
+        return GRID_IMAGE_COUNT if self.job_type(index) == "grid" else 1
+
+    def job(self, index: int, image_base_url: str) -> dict:
+        job_id = f"standin-{index:08d}"
+        job_type = self.job_type(index)
+        image_count = self.image_count(index)
+        return {
+            "id": job_id,
+            "enqueue_time": self.enqueue_time(index).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "type": job_type,
+            "prompt": f"stand-in job {index} of a {job_type} with a lighthouse in a storm, oil painting",
+            "full_command": f"stand-in job {index} of a {job_type} with a lighthouse in a storm, oil painting --v 6",
+            "image_paths": [f"{image_base_url}/img/{job_id}_{k}.png" for k in range(image_count)],
+            "width": 1024,
+            "height": 1024,
+            "username": "standin",
+        }
+
+    def listing(
+        self,
+        image_base_url: str,
+        job_type: str | None,
+        from_date: str | None,
+        page: int,
+        amount: int,
+    ) -> list[dict]:
+        indexes = self._indexes_by_type.get(job_type or "all", [])
+        # Jobs enqueued up to fromDate, by their position in the oldest-first index list
+        end = len(indexes)
+        if from_date:
+            from_date_dt = dt.datetime.fromisoformat(from_date)
+            newest = (from_date_dt - STANDIN_START_TIME) // self.job_interval
+            end = bisect.bisect_right(indexes, newest)
+        skipped = (page - 1) * amount
+        if self.listing_cap:
+            amount = max(0, min(amount, self.listing_cap - skipped))
+        start = end - skipped
+        page_indexes = [indexes[i] for i in range(start - 1, max(start - amount, 0) - 1, -1)]
+        return [self.job(i, image_base_url) for i in page_indexes] or NO_JOBS_FOUND
+
+
+class StandInServer:
+    """
+    Threaded HTTP server serving a `StandInArchive`. `page_latency`, `image_latency`
+    and `jitter` (seconds, added uniformly at random) simulate the network.
+    `throttle_rate` and `error_rate` are the shares of requests answered with 429
+    (`Retry-After: retry_after`) and 503. `stats` counts the requests and bytes served.
+    """
+
+    def __init__(
+        self,
+        archive: StandInArchive,
+        page_latency: float = 0.05,
+        image_latency: float = 0.0,
+        jitter: float = 0.0,
+        image_size: int = 64 * 1024,
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        retry_after: int = 1,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.archive = archive
+        self.page_latency = page_latency
+        self.image_latency = image_latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        # Random bytes shared by all images; each image starts with a different digest
+        self._image_body = random.Random(0).randbytes(max(image_size, 40))
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mj-standin", daemon=True)
+        self._thread.start()
+        _log.info(f"Stand-in API and CDN serving {self.archive.job_count} jobs at {self.base_url}")
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats.clear()
+
+    def _count(self, **counts: int):
+        with self._stats_lock:
+            self.stats.update(counts)
+
+    def _delay(self, latency: float):
+        delay = latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def image(self, path: str) -> bytes:
+        return b"\x89PNG\r\n\x1a\n" + hashlib.sha256(path.encode("utf-8")).digest() + self._image_body[40:]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real services
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                failure = random.random()
+                if failure < server.throttle_rate:
+                    server._count(throttled=1)
+                    self._send(429, b"", "text/plain", {"Retry-After": str(server.retry_after)})
+                elif failure < server.throttle_rate + server.error_rate:
+                    server._count(errors=1)
+                    self._send(503, b"", "text/plain")
+                elif url.path.rstrip("/") == "/api/app/recent-jobs":
+                    self._listing(url)
+                elif url.path.startswith("/img/"):
+                    self._image(url.path)
+                else:
+                    self._send(404, b"", "text/plain")
+
+            def _listing(self, url):
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                server._delay(server.page_latency)
+                try:
+                    listing = server.archive.listing(
+                        server.base_url,
+                        query.get("jobType"),
+                        query.get("fromDate"),
+                        int(query.get("page", 1)),
+                        int(query.get("amount", 50)),
+                    )
+                except ValueError:
+                    self._send(400, b"", "text/plain")
+                    return
+                body = json.dumps(listing).encode("utf-8")
+                etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    server._count(pages_not_modified=1)
+                    self._send(304, b"", "application/json", {"ETag": etag})
+                    return
+                server._count(pages=1, jobs=0 if listing is NO_JOBS_FOUND else len(listing))
+                self._send(200, body, "application/json", {"ETag": etag})
+
+            def _image(self, path: str):
+                server._delay(server.image_latency)
+                body = server.image(path)
+                status, headers = 200, {}
+                range_header = self.headers.get("Range")
+                if range_header and range_header.startswith("bytes="):
+                    start = int(range_header[len("bytes="):].split("-")[0] or 0)
+                    if start >= len(body):
+                        self._send(416, b"", "image/png", {"Content-Range": f"bytes */{len(body)}"})
+                        return
+                    status, headers = 206, {"Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}"}
+                    body = body[start:]
+                server._count(images=1, image_bytes=len(body))
+                self._send(status, body, "image/png", headers)
+
+            def _send(self, status: int, body: bytes, content_type: str, headers: dict | None = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
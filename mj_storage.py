@@ -0,0 +1,309 @@
+"""
+Storage backends for the job metadata of the Midjourney archive.
+
+- `files` (default): one `.json` and one `.prompt.txt` file per job.
+- `packed`: one append-only `jobs.jsonl` shard (and a `prompts.txt` companion) per
+  day folder. Writes are buffered and appended once per page; the byte offset of
+  every job is kept in the manifest for O(1) lookup by job id. Shards can be
+  compressed with gzip or zstd (see `mj_codecs`), one frame per job, so a single
+  job is still read with one seek.
+
+Both layouts name downloaded images the same way, so images are unaffected by
+the choice of backend and `convert_archive` can move between them losslessly.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Callable
+
+from mj_archive import is_shard_path, iter_job_files, prompts_shard_path, read_shard, shard_paths
+from mj_codecs import codec_for_path, get_codec, save_zstd_dictionary, train_zstd_dictionary, zstd_dictionary_path
+from mj_manifest import ArchiveManifest
+from mj_metrics import METRICS
+
+_log = logging.getLogger(__name__)
+
+STORAGE_LAYOUTS = ("files", "packed")
+
+# Jobs to collect before training a zstd dictionary for an archive that has none
+ZSTD_TRAINING_SAMPLES = 2000
+
+
+def compact_json(job_info: dict) -> bytes:
+    """
+    A job as one line of a packed shard.
+    """
+    return json.dumps(job_info, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class MetadataWriteError(IOError):
+    """
+    Writing job metadata failed. `kind` tells which file: "json" or "prompt".
+    """
+
+    def __init__(self, kind: str, path: Path, cause: OSError):
+        super().__init__(f"Error writing {kind} file {path}: {cause}")
+        self.kind = kind
+        self.path = path
+
+
+class FileMetadataStorage:
+    """
+    One JSON file and one prompt text file per job, written immediately.
+    """
+
+    layout = "files"
+
+    def __init__(self, json_indent: int | None, render_prompt: Callable[[dict], str]):
+        self.json_indent = json_indent
+        self.render_prompt = render_prompt
+
+    def paths(self, job_dir: Path, filename_base: str) -> tuple[Path, Path]:
+        return job_dir / f"{filename_base}.json", job_dir / f"{filename_base}.prompt.txt"
+
+    def has_files(self, job_dir: Path, filename_base: str) -> bool:
+        json_path, prompt_path = self.paths(job_dir, filename_base)
+        return json_path.exists() and prompt_path.exists()
+
+    def store(self, job_info: dict, job_dir: Path, filename_base: str) -> tuple[Path, Path]:
+        json_path, prompt_path = self.paths(job_dir, filename_base)
+        with METRICS.time_phase("json_encode"):
+            json_text = json.dumps(job_info, indent=self.json_indent)
+        try:
+            with METRICS.time_phase("file_write"), json_path.open("w", encoding="utf-8") as f:
+                f.write(json_text)
+        except OSError as e:
+            raise MetadataWriteError("json", json_path, e) from e
+        try:
+            prompt_text = self.render_prompt(job_info)
+            with METRICS.time_phase("file_write"), prompt_path.open("w", encoding="utf-8") as f:
+                f.write(prompt_text)
+        except OSError as e:
+            raise MetadataWriteError("prompt", prompt_path, e) from e
+        return json_path, prompt_path
+
+    def flush(self) -> list[str]:
+        return []
+
+
+class PackedMetadataStorage:
+    """
+    Append-only day shards. `store` only buffers a job; `flush` appends all buffered
+    jobs of a page with one open/write per shard and records their offsets.
+
+    With zstd compression and no dictionary in the archive yet, the first
+    `ZSTD_TRAINING_SAMPLES` jobs are compressed without one; a dictionary is then
+    trained on them and used for all later jobs.
+    """
+
+    layout = "packed"
+
+    def __init__(self, manifest: ArchiveManifest, render_prompt: Callable[[dict], str], compression: str = "none"):
+        self.manifest = manifest
+        self.render_prompt = render_prompt
+        self.compression = compression
+        self.codec = get_codec(compression, manifest.archive_root)
+        self._pending: dict[Path, list[tuple[dict, str]]] = {}
+        self._training_samples: list[bytes] | None = None
+        if compression == "zstd" and self.codec.dictionary is None:
+            self._training_samples = []
+
+    def paths(self, job_dir: Path, filename_base: str) -> tuple[Path, Path]:
+        return job_dir / f"{filename_base}.json", shard_paths(job_dir, self.compression)[1]
+
+    def has_files(self, job_dir: Path, filename_base: str) -> bool:
+        return False # Only the manifest knows which jobs a shard holds
+
+    def store(self, job_info: dict, job_dir: Path, filename_base: str) -> tuple[Path, Path]:
+        self._pending.setdefault(job_dir, []).append((job_info, filename_base))
+        return self.paths(job_dir, filename_base)
+
+    def flush(self) -> list[str]:
+        """
+        Append the buffered jobs to their shards. Returns the ids of jobs that could
+        not be written; they are removed from the manifest so they are retried.
+        """
+        failed_job_ids = []
+        pending, self._pending = self._pending, {}
+        for job_dir, jobs in pending.items():
+            shard_path, prompts_path = shard_paths(job_dir, self.compression)
+            with METRICS.time_phase("json_encode"):
+                lines = [compact_json(job_info) for job_info, _ in jobs]
+            prompts = "".join(
+                f"=== {filename_base} ===\n{self.render_prompt(job_info)}\n" for job_info, filename_base in jobs
+            )
+            with METRICS.time_phase("compress"):
+                frames = [self.codec.compress(line) for line in lines]
+                prompts_frame = self.codec.compress(prompts.encode("utf-8"))
+            try:
+                with METRICS.time_phase("file_write"):
+                    with shard_path.open("ab") as f:
+                        offset = f.tell()
+                        f.write(b"".join(frames))
+                    with prompts_path.open("ab") as f:
+                        f.write(prompts_frame)
+            except OSError as e:
+                _log.error(f"Error appending {len(jobs)} jobs to shard {shard_path}: {e}")
+                failed_job_ids.extend(job_info["id"] for job_info, _ in jobs)
+                continue
+            for (job_info, _), frame in zip(jobs, frames):
+                self.manifest.set_packed_location(job_info["id"], shard_path, offset, len(frame))
+                offset += len(frame)
+            if self._training_samples is not None:
+                self._training_samples.extend(lines)
+        if self._training_samples is not None and len(self._training_samples) >= ZSTD_TRAINING_SAMPLES:
+            self._train_dictionary()
+        return failed_job_ids
+
+    def _train_dictionary(self):
+        samples, self._training_samples = self._training_samples, None
+        archive_root = self.manifest.archive_root
+        try:
+            save_zstd_dictionary(archive_root, train_zstd_dictionary(samples))
+        except FileExistsError:
+            pass # Another process trained one meanwhile; use it
+        except (ValueError, OSError) as e:
+            _log.warning(f"Continuing without a zstd dictionary: {e}")
+            return
+        self.codec = get_codec("zstd", archive_root)
+
+
+def read_packed_job(manifest: ArchiveManifest, job_id: str) -> dict | None:
+    """
+    Read one job from its packed shard with a single seek, using the manifest's offset index.
+    """
+    location = manifest.packed_location(job_id)
+    if location is None:
+        return None
+    shard_path, offset, length = location
+    with shard_path.open("rb") as f:
+        f.seek(offset)
+        frame = f.read(length)
+    return json.loads(codec_for_path(shard_path, manifest.archive_root).decompress(frame))
+
+
+def sample_jobs(archive_root: Path, limit: int) -> list[bytes]:
+    """
+    Up to `limit` jobs of the archive, in either layout, as packed shard lines.
+    """
+    samples = []
+    for path in iter_job_files(archive_root, include_shards=True):
+        if is_shard_path(path):
+            samples.extend(compact_json(entry.job_info) for entry in read_shard(path, archive_root))
+        else:
+            try:
+                job_info = json.loads(path.read_text(encoding="utf-8"))
+            except (json.JSONDecodeError, OSError):
+                continue
+            if isinstance(job_info, dict) and "id" in job_info:
+                samples.append(compact_json(job_info))
+        if len(samples) >= limit:
+            break
+    return samples[:limit]
+
+
+def train_archive_dictionary(archive_root: Path, sample_count: int = ZSTD_TRAINING_SAMPLES) -> Path:
+    """
+    Train the archive's zstd dictionary on jobs already in the archive.
+    """
+    if zstd_dictionary_path(archive_root).exists():
+        raise FileExistsError(f"The archive already has a zstd dictionary: {zstd_dictionary_path(archive_root)}")
+    return save_zstd_dictionary(archive_root, train_zstd_dictionary(sample_jobs(archive_root, sample_count)))
+
+
+def create_storage(
+    layout: str,
+    manifest: ArchiveManifest,
+    json_indent: int | None,
+    render_prompt: Callable[[dict], str],
+    compression: str = "none",
+):
+    if layout == "files":
+        return FileMetadataStorage(json_indent, render_prompt)
+    if layout == "packed":
+        return PackedMetadataStorage(manifest, render_prompt, compression)
+    raise ValueError(f"Unknown storage layout '{layout}', expected one of {STORAGE_LAYOUTS}")
+
+
+def convert_archive(
+    archive_root: Path,
+    manifest: ArchiveManifest,
+    to_layout: str,
+    json_indent: int | None,
+    render_prompt: Callable[[dict], str],
+    compression: str = "none",
+) -> int:
+    """
+    Convert all job metadata in the archive to `to_layout`, one day folder at a time.
+    Converting to `packed` also recompresses shards written with another compression.
+    Source files are only removed after their jobs were written in the new layout.
+    The JSON documents round-trip unchanged; prompt files are re-rendered from them.
+    Returns the number of jobs converted.
+    """
+    target = create_storage(to_layout, manifest, json_indent, render_prompt, compression)
+    target_shard_name = shard_paths(Path(), compression)[0].name
+    converted = 0
+    batch: list[tuple[Path, dict]] = [] # Per-file jobs of the current day folder, packed together
+
+    def pack_batch() -> int:
+        for json_path, job_info in batch:
+            target.store(job_info, json_path.parent, json_path.stem)
+        failed_job_ids = set(target.flush())
+        packed = 0
+        for json_path, job_info in batch:
+            if job_info["id"] in failed_job_ids:
+                continue
+            manifest.record_job(job_info, json_path, None)
+            json_path.unlink()
+            json_path.with_name(f"{json_path.stem}.prompt.txt").unlink(missing_ok=True)
+            packed += 1
+        batch.clear()
+        manifest.commit()
+        return packed
+
+    def remove_shard(shard_path: Path):
+        manifest.clear_packed_locations(shard_path)
+        shard_path.unlink()
+        prompts_shard_path(shard_path).unlink(missing_ok=True)
+        manifest.commit()
+
+    for path in iter_job_files(archive_root, include_shards=True):
+        if to_layout == "packed" and not is_shard_path(path):
+            if batch and batch[-1][0].parent != path.parent:
+                converted += pack_batch()
+            try:
+                job_info = json.loads(path.read_text(encoding="utf-8"))
+            except (json.JSONDecodeError, OSError) as e:
+                _log.warning(f"Not converting {path}: {e}")
+                continue
+            if isinstance(job_info, dict) and "id" in job_info:
+                batch.append((path, job_info))
+        elif to_layout == "packed" and path.name != target_shard_name:
+            if batch:
+                converted += pack_batch()
+            entries = list(read_shard(path, archive_root))
+            for entry in entries:
+                target.store(entry.job_info, path.parent, entry.job_path.stem)
+            if target.flush():
+                _log.error(f"Not recompressing {path}: cannot write {target_shard_name}")
+                continue
+            for entry in entries:
+                manifest.record_job(entry.job_info, entry.job_path, None)
+            remove_shard(path)
+            converted += len(entries)
+        elif to_layout == "files" and is_shard_path(path):
+            entries = list(read_shard(path, archive_root))
+            try:
+                for entry in entries:
+                    json_path, prompt_path = target.store(entry.job_info, path.parent, entry.job_path.stem)
+                    manifest.record_job(entry.job_info, json_path, prompt_path)
+            except MetadataWriteError as e:
+                _log.error(f"Not converting {path}: {e}")
+                continue
+            remove_shard(path)
+            converted += len(entries)
+    if batch:
+        converted += pack_batch()
+    _log.info(f"Converted {converted} jobs to the '{to_layout}' layout.")
+    return converted
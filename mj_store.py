@@ -0,0 +1,132 @@
+"""
+Content-addressed image store for the Midjourney archive.
+
+Images are stored once under `<archive_root>/.mj-store/<sha256[:2]>/<sha256>.<ext>`
+and the per-job image files are hardlinks to them (reflinks or symlinks where
+hardlinks are not possible). The manifest maps image URLs to store objects, so
+a URL that was downloaded before is linked again without a new download.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from mj_manifest import ArchiveManifest
+
+_log = logging.getLogger(__name__)
+
+STORE_DIRNAME = ".mj-store"
+
+# ioctl request to clone a file's extents on Linux (btrfs, XFS)
+_FICLONE = 0x40049409
+
+
+def _reflink(source: Path, destination: Path):
+    import fcntl # Not available on Windows; callers treat ImportError like any other failure
+
+    # Clone into a temporary file, so a failure never touches `destination`
+    temporary_path = destination.with_name(f".{destination.name}.reflink")
+    try:
+        with source.open("rb") as src, temporary_path.open("wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        os.replace(temporary_path, destination)
+    except OSError:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+
+class ContentStore:
+    def __init__(self, archive_root: Path, manifest: ArchiveManifest):
+        self.root = archive_root / STORE_DIRNAME
+        self.manifest = manifest
+        self._tmp_dir = self.root / "tmp"
+        self._tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._urls_in_progress: set[str] = set()
+        self._urls_condition = threading.Condition()
+
+    @contextmanager
+    def url_lock(self, url: str):
+        """
+        Serialise work on one URL, so concurrent jobs sharing an image don't
+        write the same partial file and the later ones can link the result.
+        """
+        with self._urls_condition:
+            while url in self._urls_in_progress:
+                self._urls_condition.wait()
+            self._urls_in_progress.add(url)
+        try:
+            yield
+        finally:
+            with self._urls_condition:
+                self._urls_in_progress.discard(url)
+                self._urls_condition.notify_all()
+
+    def object_for_url(self, url: str) -> tuple[Path, str, int] | None:
+        """
+        (object path, sha256, size) of a previously stored download of `url`,
+        or None if the URL is unknown or its object is missing on disk.
+        """
+        row = self.manifest.store_object_for_url(url)
+        if row is None:
+            return None
+        sha256, size, relative_path = row
+        object_path = self.manifest.archive_root / relative_path
+        if not object_path.exists():
+            _log.warning(f"Store object {object_path} for {url} is missing, downloading again.")
+            return None
+        return object_path, sha256, size
+
+    def partial_path(self, url: str) -> Path:
+        """
+        Path to download `url` to before it is moved into place by `add`. It is
+        derived from the URL so an interrupted download can be resumed.
+        """
+        return self._tmp_dir / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.part"
+
+    def add(self, part_path: Path, sha256: str, size: int, url: str, extension: str) -> tuple[Path, bool]:
+        """
+        Move a completed download into the store under its content hash.
+        Returns the object path and whether the content was new to the store.
+        """
+        object_path = self.root / sha256[:2] / f"{sha256}.{extension}"
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(part_path, object_path) # Atomic: fails if another download stored it first
+            is_new = True
+        except FileExistsError:
+            is_new = False
+        except OSError as e: # No hardlinks on this file system: move the download into place instead
+            _log.debug(f"Cannot hardlink {part_path} into the store ({e}), moving it.")
+            is_new = not object_path.exists()
+            if is_new:
+                os.replace(part_path, object_path)
+        if part_path.exists(): # Linked, or the content was already stored
+            part_path.unlink()
+        self.manifest.add_store_object(sha256, size, object_path, url)
+        return object_path, is_new
+
+    def link(self, object_path: Path, destination: Path, sha256: str) -> str:
+        """
+        Make `destination` refer to a store object. Returns the method that was used.
+        Raises FileExistsError if `destination` exists, which is never replaced.
+        """
+        try:
+            os.link(object_path, destination)
+            method = "hardlink"
+        except FileExistsError:
+            raise
+        except OSError:
+            if os.path.lexists(destination): # Other errors (e.g. EXDEV) come before the existence check
+                raise FileExistsError(errno.EEXIST, "Destination exists", str(destination))
+            try:
+                _reflink(object_path, destination)
+                method = "reflink"
+            except (ImportError, OSError):
+                os.symlink(os.path.relpath(object_path, destination.parent), destination)
+                method = "symlink"
+        self.manifest.add_store_link(destination, sha256, method)
+        return method
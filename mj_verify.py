@@ -0,0 +1,226 @@
+"""
+Verification of the downloaded images.
+
+Every downloaded image is read once: its first bytes must match the magic
+number of its extension, its header must be well-formed (PNG `IHDR` with a
+non-zero size, a JPEG frame header, a WebP `RIFF` chunk of the file's size) and
+the file must end like a complete image (PNG `IEND`, JPEG end-of-image marker).
+Its SHA-256 is computed on the way and stored in the manifest together with the
+file's size and mtime, so later runs skip the images that did not change.
+
+Truncated or damaged images are deleted and queued for download again, together
+with their object in the content-addressed store if they are linked to one; images
+whose content is a different format than their extension says are only reported,
+as downloading them again would give the same bytes.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mj_manifest import IMAGE_STATE_PENDING, ArchiveManifest, DownloadedImage
+
+_log = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+HEADER_BYTES = 256 * 1024 # Read ahead for headers, e.g. JPEG frame headers behind EXIF and ICC data
+JPEG_TRAILER_BYTES = 64 # Some encoders pad JPEG files after the end-of-image marker
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+# Start-of-frame markers; 0xC4, 0xC8 and 0xCC share the range but are other segments
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+EXTENSION_FORMATS = {"png": "png", "jpg": "jpeg", "jpeg": "jpeg", "webp": "webp"}
+
+
+class ImageCheckError(ValueError):
+    """
+    An image failed verification. `corrupt` is False for well-formed images
+    that are only stored under the wrong extension.
+    """
+
+    def __init__(self, message: str, corrupt: bool = True):
+        super().__init__(message)
+        self.corrupt = corrupt
+
+
+def sniff_format(header: bytes) -> str | None:
+    if header.startswith(PNG_SIGNATURE):
+        return "png"
+    if header.startswith(JPEG_SOI):
+        return "jpeg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _check_png(header: bytes, trailer: bytes, size: int):
+    if header[12:16] != b"IHDR":
+        raise ImageCheckError("PNG without IHDR header")
+    width, height = int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+    if not width or not height:
+        raise ImageCheckError(f"PNG of {width}x{height} pixels")
+    if not trailer.endswith(PNG_IEND):
+        raise ImageCheckError("PNG is truncated, IEND is missing")
+
+
+def _check_jpeg(header: bytes, trailer: bytes, size: int):
+    offset = 2
+    while True:
+        if offset + 9 > len(header):
+            raise ImageCheckError("JPEG without frame header")
+        if header[offset] != 0xFF:
+            raise ImageCheckError(f"JPEG segment without marker at byte {offset}")
+        marker = header[offset + 1]
+        if marker in JPEG_SOF_MARKERS:
+            height = int.from_bytes(header[offset + 5:offset + 7], "big")
+            width = int.from_bytes(header[offset + 7:offset + 9], "big")
+            if not width or not height:
+                raise ImageCheckError(f"JPEG of {width}x{height} pixels")
+            break
+        offset += 2 + int.from_bytes(header[offset + 2:offset + 4], "big")
+    if JPEG_EOI not in trailer[-JPEG_TRAILER_BYTES:]:
+        raise ImageCheckError("JPEG is truncated, the end-of-image marker is missing")
+
+
+def _check_webp(header: bytes, trailer: bytes, size: int):
+    riff_size = int.from_bytes(header[4:8], "little")
+    if riff_size + 8 != size:
+        raise ImageCheckError(f"WebP is {size} bytes, its RIFF header announces {riff_size + 8}")
+    if header[12:16] not in (b"VP8 ", b"VP8L", b"VP8X"):
+        raise ImageCheckError("WebP without VP8 data")
+
+
+FORMAT_CHECKS = {"png": _check_png, "jpeg": _check_jpeg, "webp": _check_webp}
+
+
+def check_image(path: Path) -> tuple[int, str]:
+    """
+    Verify an image and hash it. Returns its size and SHA-256, or raises
+    ImageCheckError (with `size` and `sha256` attributes) if it is invalid.
+    """
+    hasher = hashlib.sha256()
+    header = b""
+    trailer = b""
+    size = 0
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            if len(header) < HEADER_BYTES:
+                header += chunk[:HEADER_BYTES - len(header)]
+            trailer = (trailer + chunk[-JPEG_TRAILER_BYTES:])[-JPEG_TRAILER_BYTES:]
+            hasher.update(chunk)
+            size += len(chunk)
+    sha256 = hasher.hexdigest()
+    try:
+        image_format = sniff_format(header)
+        if image_format is None:
+            raise ImageCheckError("not a PNG, JPEG or WebP image" if size else "empty file")
+        FORMAT_CHECKS[image_format](header, trailer, size)
+        expected_format = EXTENSION_FORMATS.get(path.suffix.lstrip(".").lower())
+        if image_format != expected_format:
+            raise ImageCheckError(f"{image_format} image stored as {path.suffix}", corrupt=False)
+    except ImageCheckError as e:
+        e.size, e.sha256 = size, sha256
+        raise
+    return size, sha256
+
+
+class ImageVerifier:
+    """
+    Verifies the downloaded images of the manifest on a thread pool. Images whose
+    size and mtime match their last verification are skipped. With `requeue`,
+    corrupt and missing images are deleted and set back to pending in the manifest,
+    so the downloader fetches them again. `stats` counts the results.
+    """
+
+    def __init__(self, manifest: ArchiveManifest, workers: int = 4, requeue: bool = True):
+        self.manifest = manifest
+        self.workers = max(1, workers)
+        self.requeue = requeue
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def verify_all(self):
+        slots = threading.BoundedSemaphore(self.workers * 4)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mj-verify") as executor:
+            for image in self.manifest.iter_downloaded_images():
+                try:
+                    stat = image.path.stat()
+                except FileNotFoundError:
+                    self._image_missing(image)
+                    continue
+                if (image.checked_size, image.checked_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    self._count("skipped_unchanged")
+                    continue
+                slots.acquire()
+                future = executor.submit(self._verify, image, stat)
+                future.add_done_callback(lambda _: slots.release())
+        self.manifest.commit()
+
+    def _verify(self, image: DownloadedImage, stat: os.stat_result):
+        try:
+            size, sha256 = check_image(image.path)
+        except ImageCheckError as e:
+            self._image_invalid(image, stat, e)
+        except OSError as e:
+            _log.error(f"Cannot read {image.path}: {e}")
+            self._count("error_file_read")
+        except Exception as e:
+            _log.error(f"Unexpected error verifying {image.path}: {e}", exc_info=True)
+            self._count("error_unexpected_verify")
+        else:
+            self.manifest.record_image_check(image.path, size, stat.st_mtime_ns, sha256, None)
+            self._count("verified_ok")
+            self._count("verified_bytes", size)
+
+    def _image_invalid(self, image: DownloadedImage, stat: os.stat_result, error: ImageCheckError):
+        if not error.corrupt:
+            _log.warning(f"{image.path}: {error}")
+            self.manifest.record_image_check(image.path, error.size, stat.st_mtime_ns, error.sha256, str(error))
+            self._count("wrong_extension")
+            return
+        _log.error(f"Corrupt image {image.path}: {error}")
+        self._count("corrupt")
+        if not self.requeue:
+            self.manifest.record_image_check(image.path, error.size, stat.st_mtime_ns, error.sha256, str(error))
+            return
+        try:
+            image.path.unlink()
+        except OSError as e:
+            _log.error(f"Cannot delete corrupt image {image.path}: {e}")
+            self._count("error_file_delete")
+            return
+        object_path = self.manifest.forget_store_object(image.path) # Else the downloader links the same bytes again
+        if object_path is not None:
+            try:
+                object_path.unlink(missing_ok=True)
+                self._count("store_objects_dropped")
+            except OSError as e:
+                _log.error(f"Cannot delete corrupt store object {object_path}: {e}")
+                self._count("error_file_delete")
+        self._requeue(image, f"corrupt: {error}")
+
+    def _image_missing(self, image: DownloadedImage):
+        _log.warning(f"Downloaded image is missing: {image.path}")
+        self._count("missing")
+        if self.requeue:
+            self._requeue(image, "missing after download")
+
+    def _requeue(self, image: DownloadedImage, reason: str):
+        self.manifest.forget_image_check(image.path)
+        self.manifest.set_image_state(image.job_id, image.image_index, image.url, image.path, IMAGE_STATE_PENDING, reason)
+        self._count("requeued")
+
+    def has_errors(self) -> bool:
+        return any(self.stats.get(key, 0) > 0 for key in ("error_file_read", "error_unexpected_verify", "error_file_delete"))